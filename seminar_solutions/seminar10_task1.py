@@ -0,0 +1,129 @@
+import numpy as np
+
+
+class ExperimentsService:
+
+    def apply_multiple_testing(self, pvalues, method='holm', alpha=0.05):
+        """Проверяет значимость с поправкой на множественное тестирование сразу для многих наборов гипотез.
+
+        Каждая строка pvalues - отдельный набор гипотез, например одна итерация симуляции.
+        Поправки с упорядочиванием p-value считаются одной сортировкой всех строк:
+            'baseline' - без поправки, p <= alpha
+            'bonferroni' - p <= alpha / m
+            'holm' - нисходящая процедура: отвергаются гипотезы с наименьшими p-value,
+                пока p_(k) < alpha / (m - k + 1), как method_holm из 10_sequential_testing
+            'bh' - Бенджамини-Хохберг: отвергаются k гипотез с наименьшими p-value,
+                где k - наибольший номер с p_(k) <= k * alpha / m
+            'by' - Бенджамини-Иекутиели: как 'bh' с уровнем alpha / (1 + 1/2 + ... + 1/m)
+
+        :param pvalues (np.ndarray): значения p-value, shape=(n_sims, m) или shape=(m,).
+        :param method (str): поправка. ['baseline', 'bonferroni', 'holm', 'bh', 'by']
+        :param alpha (float): уровень значимости (для 'bh' и 'by' - допустимый FDR).
+        :return (np.ndarray): True - эффект есть, False - эффекта нет, shape как у pvalues.
+        """
+        pvalues = np.asarray(pvalues, dtype=float)
+        m = pvalues.shape[-1]
+        if method == 'baseline':
+            return pvalues <= alpha
+        elif method == 'bonferroni':
+            return pvalues <= alpha / m
+        elif method not in ['holm', 'bh', 'by']:
+            raise ValueError('Неверный method')
+
+        order = np.argsort(pvalues, axis=-1, kind='stable')
+        sorted_pvalues = np.take_along_axis(pvalues, order, axis=-1)
+        ranks = np.arange(1, m + 1)
+        if method == 'holm':
+            # количество отвергнутых - длина начального отрезка, на котором p_(k) < alpha / (m - k + 1)
+            is_passed = sorted_pvalues < alpha / (m - ranks + 1)
+            n_rejected = np.logical_and.accumulate(is_passed, axis=-1).sum(axis=-1)
+        else:
+            level = alpha if method == 'bh' else alpha / np.sum(1 / ranks)
+            is_passed = sorted_pvalues <= ranks * level / m
+            # количество отвергнутых - наибольший номер k, для которого выполнено условие
+            n_rejected = np.where(is_passed.any(axis=-1), m - np.argmax(is_passed[..., ::-1], axis=-1), 0)
+
+        decisions = np.zeros(pvalues.shape, dtype=bool)
+        np.put_along_axis(decisions, order, ranks <= n_rejected[..., None], axis=-1)
+        return decisions
+
+    def get_error_rates(self, decisions, is_effect):
+        """Оценивает вероятности ошибок по результатам многих наборов гипотез.
+
+        :param decisions (np.ndarray): результаты проверки гипотез, shape=(n_sims, m), True - эффект есть.
+        :param is_effect (np.ndarray): есть ли эффект на самом деле, shape=(m,) или shape=(n_sims, m).
+        :return (dict): оценки по наборам гипотез
+            'fwer' - вероятность хотя бы одной ошибки I рода, P(FP > 0)
+            'fdr' - средняя доля ложных среди отвергнутых гипотез, FP / max(R, 1)
+            'power' - средняя доля обнаруженных эффектов среди гипотез с эффектом
+            'p_fn' - вероятность хотя бы одной ошибки II рода, P(FN > 0)
+        """
+        decisions = np.asarray(decisions, dtype=bool)
+        is_effect = np.broadcast_to(np.asarray(is_effect, dtype=bool), decisions.shape)
+        false_positives = (decisions & ~is_effect).sum(axis=-1)
+        true_positives = (decisions & is_effect).sum(axis=-1)
+        n_effects = is_effect.sum(axis=-1)
+        n_rejected = decisions.sum(axis=-1)
+        power = np.mean(true_positives / n_effects) if n_effects.all() else np.nan
+        return {
+            'fwer': np.mean(false_positives > 0),
+            'fdr': np.mean(false_positives / np.maximum(n_rejected, 1)),
+            'power': power,
+            'p_fn': np.mean(true_positives < n_effects),
+        }
+
+
+if __name__ == '__main__':
+    def method_holm(pvalues, alpha=0.05):
+        """Метод Холма из ноутбука 10_sequential_testing."""
+        m = len(pvalues)
+        array_alpha = alpha / np.arange(m, 0, -1)
+        res = np.zeros(m)
+        for idx, pvalue_index in enumerate(np.argsort(pvalues)):
+            if pvalues[pvalue_index] < array_alpha[idx]:
+                res[pvalue_index] = 1
+            else:
+                break
+        return res.astype(bool)
+
+    def method_step_up(pvalues, alpha=0.05):
+        """Процедура Бенджамини-Хохберга циклом по отсортированным p-value."""
+        m = len(pvalues)
+        order = np.argsort(pvalues)
+        n_rejected = 0
+        for k in range(m, 0, -1):
+            if pvalues[order[k - 1]] <= k * alpha / m:
+                n_rejected = k
+                break
+        res = np.zeros(m, dtype=bool)
+        res[order[:n_rejected]] = True
+        return res
+
+    rng = np.random.default_rng(0)
+    n_sims, m, n_effects = 2000, 20, 5
+    is_effect = np.arange(m) >= m - n_effects
+    pvalues = rng.uniform(size=(n_sims, m))
+    pvalues[:, is_effect] = pvalues[:, is_effect] ** 6
+
+    experiments_service = ExperimentsService()
+    holm = experiments_service.apply_multiple_testing(pvalues, 'holm')
+    assert (holm == np.array([method_holm(row) for row in pvalues])).all(), 'Неверный метод Холма'
+    bh = experiments_service.apply_multiple_testing(pvalues, 'bh')
+    assert (bh == np.array([method_step_up(row) for row in pvalues])).all(), 'Неверный метод BH'
+    by = experiments_service.apply_multiple_testing(pvalues, 'by')
+    ideal_by = np.array([method_step_up(row, 0.05 / np.sum(1 / np.arange(1, m + 1))) for row in pvalues])
+    assert (by == ideal_by).all(), 'Неверный метод BY'
+    assert (experiments_service.apply_multiple_testing(pvalues[0], 'holm') == holm[0]).all()
+
+    null_pvalues = rng.uniform(size=(10000, m))
+    for method in ['bonferroni', 'holm', 'bh', 'by']:
+        decisions = experiments_service.apply_multiple_testing(null_pvalues, method)
+        error_rates = experiments_service.get_error_rates(decisions, np.zeros(m, dtype=bool))
+        assert error_rates['fwer'] <= 0.06, f'FWER метода {method} больше alpha'
+    error_rates = {}
+    for method in ['baseline', 'bonferroni', 'holm', 'bh']:
+        decisions = experiments_service.apply_multiple_testing(pvalues, method)
+        error_rates[method] = experiments_service.get_error_rates(decisions, is_effect)
+    assert error_rates['bh']['fdr'] <= 0.05 and error_rates['baseline']['fwer'] > 0.5
+    assert error_rates['bonferroni']['power'] <= error_rates['holm']['power'] <= error_rates['bh']['power']
+    print('simple test passed')
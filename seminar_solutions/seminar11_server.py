@@ -0,0 +1,275 @@
+import time
+import json
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from seminar11_task2 import Experiment, SplittingService
+
+
+class AssignmentServer:
+
+    def __init__(self, splitting_service, max_batch_size=1024, max_delay=0.002, cache_size=100_000):
+        """Асинхронный сервер распределения пользователей по экспериментам.
+
+        Запросы от всех клиентов собираются в микро-пачки: пачка обрабатывается одним вызовом
+        SplittingService.process_users, когда в ней набралось max_batch_size пользователей
+        или прошло max_delay секунд с первого запроса в пачке. Пачки обрабатываются по очереди
+        в отдельном потоке, чтобы большая пачка не блокировала цикл событий.
+        Результаты для недавних пользователей хранятся в LRU-кэше.
+
+        Протокол: клиент присылает user_id, по одному на строку. На каждую строку сервер
+        в том же порядке отвечает строкой json: {"bucket_id": 8, "experiment_groups": [[194, "A"], [73, "B"]]}.
+        Если обработка пачки завершилась ошибкой, ответ на запросы пачки - {"error": "текст ошибки"}.
+
+        :param splitting_service (SplittingService): объект для распределения пользователей.
+        :param max_batch_size (int): максимальный размер пачки.
+        :param max_delay (float): максимальное время ожидания пачки в секундах.
+        :param cache_size (int): количество пользователей в кэше.
+        """
+        self.splitting_service = splitting_service
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = []
+        self.timer = None
+        self.server = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_tasks = set()
+        self.connection_tasks = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Запускает сервер, возвращает (host, port), на которых он слушает."""
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        """Перестаёт принимать соединения и ждёт, пока клиенты закроют открытые соединения."""
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.gather(*self.connection_tasks)
+
+    def assign(self, user_id):
+        """Возвращает future с результатом process_user для пользователя."""
+        future = asyncio.get_running_loop().create_future()
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            future.set_result(self.cache[user_id])
+            return future
+        self.pending.append((user_id, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush)
+        return future
+
+    def _flush(self):
+        """Отправляет накопленную пачку запросов на обработку одним пакетным вычислением."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        task = asyncio.create_task(self._process_batch(pending))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def _process_batch(self, pending):
+        """Вычисляет результаты пачки в потоке executor и завершает futures запросов."""
+        user_ids = list(dict.fromkeys(user_id for user_id, _ in pending))
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._process_users, user_ids
+            )
+        except Exception as exc:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        self.cache.update(results)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        for user_id, future in pending:
+            if not future.done():
+                future.set_result(results[user_id])
+
+    def _process_users(self, user_ids):
+        """Возвращает словарь user_id -> результат process_user для пачки пользователей."""
+        bucket_ids, user_index, experiment_ids, groups = self.splitting_service.process_users(user_ids)
+        bounds = np.searchsorted(user_index, np.arange(len(user_ids) + 1))
+        results = {}
+        for index, user_id in enumerate(user_ids):
+            begin, end = bounds[index], bounds[index + 1]
+            experiment_groups = list(zip(experiment_ids[begin:end].tolist(), groups[begin:end].tolist()))
+            results[user_id] = (int(bucket_ids[index]), experiment_groups)
+        return results
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        task.add_done_callback(self.connection_tasks.discard)
+        # ответы отправляются в порядке запросов, поэтому клиент может не ждать ответа перед новым запросом
+        responses = asyncio.Queue()
+
+        async def write_responses():
+            while True:
+                future = await responses.get()
+                if future is None:
+                    break
+                try:
+                    bucket_id, experiment_groups = await future
+                    message = {'bucket_id': bucket_id, 'experiment_groups': experiment_groups}
+                except Exception as exc:
+                    message = {'error': f'{type(exc).__name__}: {exc}'}
+                writer.write((json.dumps(message) + '\n').encode())
+                if responses.empty():
+                    await writer.drain()
+
+        writer_task = asyncio.create_task(write_responses())
+        try:
+            while line := await reader.readline():
+                responses.put_nowait(self.assign(line.decode().rstrip('\n')))
+        finally:
+            responses.put_nowait(None)
+            await writer_task
+            writer.close()
+
+
+class AssignmentClient:
+
+    def __init__(self):
+        """Клиент сервера распределения. Запросы одного клиента можно отправлять конкурентно."""
+        self.reader = None
+        self.writer = None
+        self.futures = None
+        self.reader_task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.futures = asyncio.Queue()
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.reader_task.cancel()
+
+    async def _read_responses(self):
+        while line := await self.reader.readline():
+            message = json.loads(line)
+            future = self.futures.get_nowait()
+            if 'error' in message:
+                future.set_exception(RuntimeError(message['error']))
+                continue
+            future.set_result(
+                (message['bucket_id'], [tuple(pair) for pair in message['experiment_groups']])
+            )
+
+    async def process_user(self, user_id):
+        """Определяет в какие эксперименты попадает пользователь, см. SplittingService.process_user."""
+        future = asyncio.get_running_loop().create_future()
+        self.futures.put_nowait(future)
+        self.writer.write((user_id + '\n').encode())
+        await self.writer.drain()
+        return await future
+
+
+async def run_load(host, port, user_ids, n_clients=8, concurrency=64):
+    """Нагрузочный тест: отправляет запросы по всем user_ids и измеряет задержки.
+
+    :param host, port: адрес сервера.
+    :param user_ids (list[str]): идентификаторы пользователей, запросы отправляются в этом порядке.
+    :param n_clients (int): количество соединений.
+    :param concurrency (int): количество одновременных запросов на одно соединение.
+    :return stats, results:
+        stats (dict) - p50 и p99 задержки в миллисекундах, пропускная способность в запросах в секунду
+        results (list[tuple]) - ответы сервера в порядке user_ids
+    """
+    clients = [AssignmentClient() for _ in range(n_clients)]
+    await asyncio.gather(*(client.connect(host, port) for client in clients))
+    latencies = np.zeros(len(user_ids))
+    results = [None] * len(user_ids)
+    semaphore = asyncio.Semaphore(n_clients * concurrency)
+
+    async def send(index):
+        async with semaphore:
+            start = time.perf_counter()
+            results[index] = await clients[index % n_clients].process_user(user_ids[index])
+            latencies[index] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(len(user_ids))))
+    duration = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in clients))
+    stats = {
+        'p50_ms': np.percentile(latencies, 50) * 1000,
+        'p99_ms': np.percentile(latencies, 99) * 1000,
+        'rps': len(user_ids) / duration,
+    }
+    return stats, results
+
+
+async def _main():
+    # раскладка как в рабочей системе: 500 экспериментов по 100 бакетов из 5000, в среднем 10 на пользователя
+    rng = np.random.default_rng(0)
+    n_experiments, n_buckets = 500, 5000
+    id2experiment = {exp_id: Experiment(id=exp_id, salt=str(exp_id)) for exp_id in range(n_experiments)}
+    buckets = [[] for _ in range(n_buckets)]
+    for exp_id in range(n_experiments):
+        for b_id in rng.choice(n_buckets, 100, replace=False):
+            buckets[b_id].append(exp_id)
+    splitting_service = SplittingService(len(buckets), 'a2N4', buckets, id2experiment)
+    user_ids = pd.read_csv('data/experiment_users.csv')['user_id'].astype(str).tolist()
+
+    server = AssignmentServer(splitting_service, cache_size=5000)
+    host, port = await server.start()
+    stats, results = await run_load(host, port, user_ids)
+    await server.stop()
+
+    # без микро-пачек каждый запрос обрабатывается отдельным вызовом process_users
+    unbatched_server = AssignmentServer(splitting_service, max_batch_size=1, cache_size=0)
+    host, port = await unbatched_server.start()
+    unbatched_stats, _ = await run_load(host, port, user_ids[-3000:])
+    await unbatched_server.stop()
+    assert stats['rps'] > unbatched_stats['rps'], 'Микро-пачки должны увеличивать пропускную способность'
+
+    start = time.perf_counter()
+    for user_id, result in zip(user_ids[:1000], results[:1000]):
+        assert result == splitting_service.process_user(user_id), 'Ответ сервера не совпадает с process_user'
+    process_user_rps = 1000 / (time.perf_counter() - start)
+    assert len(server.cache) == 5000, 'Неверный размер кэша'
+
+    class FailingSplittingService(SplittingService):
+        def process_users(self, user_ids, n_jobs=1, chunk_size=100_000):
+            if 'fail' in user_ids:
+                raise ValueError('bad user_id')
+            return super().process_users(user_ids, n_jobs, chunk_size)
+
+    # ошибка в пачке завершает её запросы ошибкой, а не оставляет клиентов ждать
+    failing_service = FailingSplittingService(len(buckets), 'a2N4', buckets, id2experiment)
+    server = AssignmentServer(failing_service, max_delay=0.05)
+    host, port = await server.start()
+    client = AssignmentClient()
+    await client.connect(host, port)
+    results = await asyncio.wait_for(
+        asyncio.gather(client.process_user('fail'), client.process_user(user_ids[0]), return_exceptions=True), 5
+    )
+    assert all(isinstance(result, RuntimeError) for result in results), 'Запросы пачки должны завершиться ошибкой'
+    result = await asyncio.wait_for(client.process_user(user_ids[0]), 5)
+    assert result == splitting_service.process_user(user_ids[0]), 'Сервер должен работать после ошибки'
+    await client.close()
+    await server.stop()
+    print(
+        f"p50={stats['p50_ms']:0.2f} ms, p99={stats['p99_ms']:0.2f} ms, {stats['rps']:0.0f} rps "
+        f"(без пачек: {unbatched_stats['rps']:0.0f} rps, process_user в цикле без сети: {process_user_rps:0.0f} rps)"
+    )
+    print('simple test passed')
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
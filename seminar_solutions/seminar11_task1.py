@@ -3,6 +3,9 @@
 # Реализуйте метод для распределения экспериментов по бакетам.
 # Реализуйте метод add_experiment класса SplittingService.
 
+from collections import defaultdict
+
+import numpy as np
 from pydantic import BaseModel
 
 
@@ -23,10 +26,44 @@ class SplittingService:
     def __init__(self, buckets_count):
         """Класс для распределения экспериментов и пользователей по бакетам.
 
+        Помимо списка бакетов хранит индекс конфликтов: для каждого размещённого эксперимента
+        битовую маску его бакетов (int, бит b выставлен, если эксперимент проводится в бакете b)
+        и симметричный граф конфликтов. Запрещённые для эксперимента бакеты - это OR масок
+        конфликтующих с ним экспериментов.
+
         :param buckets_count (int): количество бакетов.
         """
         self.buckets_count = buckets_count
         self.buckets = [[] for _ in range(buckets_count)]
+        self.all_buckets = (1 << buckets_count) - 1
+        self.experiment2bitset = {}
+        self.conflicts = defaultdict(set)
+
+    def _get_free_buckets(self, experiment):
+        """Возвращает битовую маску бакетов, в которых нет конфликтующих экспериментов.
+
+        Учитываются и конфликты эксперимента, и уже размещённые эксперименты,
+        в конфликтах которых указан этот эксперимент.
+        """
+        forbidden = 0
+        for conflict in set(experiment.conflicts) | self.conflicts[experiment.id]:
+            forbidden |= self.experiment2bitset.get(conflict, 0)
+        return self.all_buckets & ~forbidden
+
+    def _bitset_to_array(self, bitset):
+        """Переводит битовую маску бакетов в массив np.bool_ длины buckets_count."""
+        bitset_bytes = bitset.to_bytes((self.buckets_count + 7) // 8, 'little')
+        bits = np.unpackbits(np.frombuffer(bitset_bytes, dtype=np.uint8), bitorder='little')
+        return bits[:self.buckets_count].astype(bool)
+
+    def _place_experiment(self, experiment, bitset):
+        """Размещает эксперимент в бакетах из битовой маски и обновляет индекс конфликтов."""
+        self.experiment2bitset[experiment.id] = bitset
+        for conflict in experiment.conflicts:
+            self.conflicts[conflict].add(experiment.id)
+            self.conflicts[experiment.id].add(conflict)
+        for b_id in _iter_bits(bitset):
+            self.buckets[b_id].append(experiment.id)
 
     def add_experiment(self, experiment):
         """Проверяет можно ли добавить эксперимент, добавляет если можно.
@@ -38,21 +75,86 @@ class SplittingService:
                 которые в нём проводятся.
         """
         # YOUR_CODE_HERE
-        ok_buckets = []
+        free_buckets = self._get_free_buckets(experiment)
+        free_count = free_buckets.bit_count()
 
-        for b_id in range(len(self.buckets)):
-            conflicts_in_bucket = [conflict for conflict in experiment.conflicts if conflict in self.buckets[b_id]]
-            if not conflicts_in_bucket:
-                ok_buckets.append(b_id)
-
-        if len(ok_buckets) < experiment.buckets_count or len(ok_buckets) == 0:
+        if free_count < experiment.buckets_count or free_count == 0:
             return False, self.buckets
         else:
-            for b_id in ok_buckets[:experiment.buckets_count]:
-                self.buckets[b_id].append(experiment.id)
-
+            self._place_experiment(experiment, _lowest_bits(free_buckets, experiment.buckets_count))
             return True, self.buckets
 
+    def plan_experiments(self, experiments):
+        """Размещает пачку экспериментов, стараясь добавить как можно больше из них.
+
+        Эксперименты размещаются по возрастанию необходимого количества бакетов, при равенстве -
+        сначала эксперименты с большим числом конфликтов внутри пачки. Для каждого эксперимента
+        выбираются свободные бакеты, занятие которых отнимает меньше всего свободных бакетов
+        у ещё не размещённых конфликтующих с ним экспериментов.
+
+        :param experiments (list[Experiment]): эксперименты, которые нужно запустить.
+        :return successes, buckets:
+            successes (list[boolean]) - для каждого эксперимента из experiments, добавлен ли он
+            buckets (list[list[int]]]) - список бакетов, в каждом бакете перечислены идентификаторы экспериментов,
+                которые в нём проводятся.
+        """
+        id2experiment = {experiment.id: experiment for experiment in experiments}
+        batch_conflicts = defaultdict(set)
+        for experiment in experiments:
+            for conflict in experiment.conflicts:
+                if conflict in id2experiment:
+                    batch_conflicts[experiment.id].add(conflict)
+                    batch_conflicts[conflict].add(experiment.id)
+
+        order = sorted(
+            range(len(experiments)),
+            key=lambda i: (experiments[i].buckets_count, -len(batch_conflicts[experiments[i].id]))
+        )
+        pending = set(id2experiment)
+        successes = [False] * len(experiments)
+        for index in order:
+            experiment = experiments[index]
+            pending.discard(experiment.id)
+            free_buckets = self._get_free_buckets(experiment)
+            free_count = free_buckets.bit_count()
+            if free_count < experiment.buckets_count or free_count == 0:
+                continue
+
+            neighbours = batch_conflicts[experiment.id] & pending
+            if free_count > experiment.buckets_count and neighbours:
+                # стоимость бакета - сколько конфликтующих экспериментов потеряют его как свободный
+                cost = np.sum(
+                    [self._bitset_to_array(self._get_free_buckets(id2experiment[n_id])) for n_id in neighbours],
+                    axis=0
+                )
+                candidates = np.flatnonzero(self._bitset_to_array(free_buckets))
+                chosen = candidates[np.argsort(cost[candidates], kind='stable')[:experiment.buckets_count]]
+                bitset = sum(1 << int(b_id) for b_id in chosen)
+            else:
+                bitset = _lowest_bits(free_buckets, experiment.buckets_count)
+            self._place_experiment(experiment, bitset)
+            successes[index] = True
+
+        return successes, self.buckets
+
+
+def _iter_bits(bitset):
+    """Перебирает номера выставленных битов по возрастанию."""
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def _lowest_bits(bitset, count):
+    """Возвращает маску из count младших выставленных битов."""
+    result = 0
+    for _ in range(count):
+        lowest = bitset & -bitset
+        result |= lowest
+        bitset ^= lowest
+    return result
+
 
 def check_correct_buckets(buckets, experiments):
     for experiment in experiments:
@@ -80,4 +182,33 @@ if __name__ == '__main__':
         if success:
             added_experiments.append(experiment)
         check_correct_buckets(buckets, added_experiments)
+
+    splitting_service = SplittingService(buckets_count=4)
+    successes, buckets = splitting_service.plan_experiments(experiments)
+    assert sum(successes) == 3, 'Пакетное размещение работает неоптимально'
+    check_correct_buckets(buckets, [e for e, success in zip(experiments, successes) if success])
+
+    # последовательное размещение добавит только первый эксперимент, пакетное - два последних
+    experiments = [
+        Experiment(id=1, buckets_count=2, conflicts=[2, 3]),
+        Experiment(id=2, buckets_count=1, conflicts=[1]),
+        Experiment(id=3, buckets_count=1, conflicts=[1]),
+    ]
+    splitting_service = SplittingService(buckets_count=2)
+    successes, buckets = splitting_service.plan_experiments(experiments)
+    assert successes == [False, True, True], 'Пакетное размещение работает неоптимально'
+    check_correct_buckets(buckets, experiments[1:])
+
+    np.random.seed(0)
+    experiments = []
+    for exp_id in range(300):
+        conflicts = np.random.choice(300, 5, False)
+        experiments.append(Experiment(
+            id=exp_id,
+            buckets_count=np.random.randint(1, 40),
+            conflicts=[int(c) for c in conflicts if c != exp_id]
+        ))
+    splitting_service = SplittingService(buckets_count=100)
+    successes, buckets = splitting_service.plan_experiments(experiments)
+    check_correct_buckets(buckets, [e for e, success in zip(experiments, successes) if success])
     print('simple test passed')
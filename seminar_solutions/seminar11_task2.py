@@ -1,5 +1,12 @@
+import os
+import json
+import fcntl
+import tempfile
+
+import numpy as np
 from pydantic import BaseModel
 from hashlib import md5
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Experiment(BaseModel):
@@ -11,9 +18,136 @@ class Experiment(BaseModel):
     salt: str
 
 
+class BucketIndex:
+
+    def __init__(self, path, buckets_count, bucket_salt, merge_factor=4):
+        """Постоянный индекс пользователь -> бакет для одной соли bucket_salt.
+
+        Индекс - несколько уровней, уровень - пара .npy файлов: отсортированные id пользователей
+        и номера их бакетов (int32). Файлы открываются через np.load(..., mmap_mode='r'), поэтому
+        процессы используют одни и те же страницы файлов без копирования и без построения словаря,
+        а бакеты ищутся через np.searchsorted по каждому уровню. Размер id в файле - 4 байта на символ.
+
+        Новые пользователи под файловой блокировкой сливаются с верхними уровнями, пока нижний
+        уровень меньше merge_factor размеров слитого, поэтому уровней O(log n). Слитый уровень
+        пишется в новые файлы, затем атомарно заменяется манифест со списком уровней, поэтому
+        прерванная запись не портит индекс: читатели видят старый или новый набор уровней целиком.
+
+        :param path (str): директория с файлами индекса.
+        :param buckets_count (int): количество бакетов.
+        :param bucket_salt (str): соль для разбиения пользователей по бакетам.
+        :param merge_factor (int): во сколько раз нижний уровень должен быть больше верхнего.
+        """
+        if buckets_count > 2 ** 31:
+            raise ValueError('Слишком большое количество бакетов для индекса')
+        self.path = path
+        self.buckets_count = buckets_count
+        self.bucket_salt = bucket_salt
+        self.merge_factor = merge_factor
+        # номер бакета зависит и от соли, и от количества бакетов
+        key = md5(f'{bucket_salt}_{buckets_count}'.encode()).hexdigest()
+        self.prefix = os.path.join(path, key)
+        self.manifest_path = f'{self.prefix}.json'
+        self.lock_path = f'{self.prefix}.lock'
+        os.makedirs(path, exist_ok=True)
+
+        self.manifest = None
+        self.levels = []
+        self.refresh()
+
+    def __getstate__(self):
+        return self.path, self.buckets_count, self.bucket_salt, self.merge_factor
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return sum(len(ids) for ids, _ in self.levels)
+
+    def _get_level_paths(self, generation):
+        return f'{self.prefix}.{generation}.ids.npy', f'{self.prefix}.{generation}.buckets.npy'
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'levels': [], 'next_generation': 0}
+
+    def refresh(self):
+        """Открывает уровни, записанные другими процессами, если манифест изменился."""
+        while True:
+            manifest = self._read_manifest()
+            if manifest == self.manifest:
+                return
+            try:
+                levels = [
+                    tuple(np.load(level_path, mmap_mode='r') for level_path in self._get_level_paths(generation))
+                    for generation in manifest['levels']
+                ]
+            except FileNotFoundError:
+                # уровни уже заменены слиянием в другом процессе, читаем новый манифест
+                continue
+            self.manifest, self.levels = manifest, levels
+            return
+
+    def get_bucket_ids(self, user_ids):
+        """Возвращает бакеты пользователей, -1 для отсутствующих в индексе.
+
+        :param user_ids (list[str], np.array): идентификаторы пользователей.
+        :return (np.array): массив номеров бакетов, dtype=int64.
+        """
+        user_ids = np.asarray(user_ids, dtype=str)
+        bucket_ids = np.full(len(user_ids), -1, dtype=np.int64)
+        for ids, level_bucket_ids in self.levels:
+            positions = np.minimum(np.searchsorted(ids, user_ids), len(ids) - 1)
+            is_found = ids[positions] == user_ids
+            bucket_ids[is_found] = level_bucket_ids[positions[is_found]]
+        return bucket_ids
+
+    def add(self, user_ids, bucket_ids):
+        """Добавляет в индекс пользователей, которых в нём ещё нет.
+
+        :param user_ids (list[str], np.array): идентификаторы пользователей.
+        :param bucket_ids (np.array): номера бакетов этих пользователей.
+        """
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            user_ids = np.asarray(user_ids, dtype=str)
+            is_new = self.get_bucket_ids(user_ids) < 0
+            ids, first_positions = np.unique(user_ids[is_new], return_index=True)
+            if not len(ids):
+                return
+            level_bucket_ids = np.asarray(bucket_ids)[is_new][first_positions].astype('<i4')
+
+            generations = list(self.manifest['levels'])
+            merged = []
+            while generations and len(self.levels[len(generations) - 1][0]) < self.merge_factor * len(ids):
+                merged.append(generations.pop())
+                lower_ids, lower_bucket_ids = self.levels[len(generations)]
+                ids = np.concatenate([lower_ids, ids])
+                level_bucket_ids = np.concatenate([lower_bucket_ids, level_bucket_ids])
+            order = np.argsort(ids, kind='stable')
+
+            generation = self.manifest['next_generation']
+            ids_path, buckets_path = self._get_level_paths(generation)
+            np.save(ids_path, ids[order])
+            np.save(buckets_path, level_bucket_ids[order])
+            manifest = {'levels': generations + [generation], 'next_generation': generation + 1}
+            with open(f'{self.manifest_path}.tmp', 'w') as file:
+                json.dump(manifest, file)
+            os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+            # открытые другими процессами файлы остаются доступны им до закрытия
+            for old_generation in merged:
+                for level_path in self._get_level_paths(old_generation):
+                    os.remove(level_path)
+            self.refresh()
+
+
 class SplittingService:
 
-    def __init__(self, buckets_count, bucket_salt, buckets=None, id2experiment=None):
+    def __init__(self, buckets_count, bucket_salt, buckets=None, id2experiment=None, index_path=None):
         """Класс для распределения экспериментов и пользователей по бакетам.
 
         :param buckets_count (int): количество бакетов.
@@ -23,6 +157,8 @@ class SplittingService:
         :param buckets (list[list[int]]) - список бакетов, в каждом бакете перечислены идентификаторы
             эксперименты, которые в нём проводятся.
         :param id2experiment (dict[int, Experiment]) - словарь пар: идентификатор эксперимента - эксперимент.
+        :param index_path (None, str) - директория с индексом пользователь -> бакет (BucketIndex).
+            Если None, то бакет пользователя каждый раз вычисляется через md5.
         """
         self.buckets_count = buckets_count
         self.bucket_salt = bucket_salt
@@ -34,7 +170,34 @@ class SplittingService:
             self.id2experiment = id2experiment
         else:
             self.id2experiment = {}
+        if index_path:
+            self.bucket_index = BucketIndex(index_path, buckets_count, bucket_salt)
+        else:
+            self.bucket_index = None
+        self._layout = None
+
+    def _get_layout(self):
+        """Возвращает эксперименты бакетов в CSR-формате, пересчитывает их после изменения бакетов.
 
+        Эксперименты бакета b - позиции offsets[b]:offsets[b + 1] массивов experiment_ids и salt_codes
+        в порядке self.buckets[b]. salt_codes - номера солей экспериментов в списке salts.
+        Сравнение со снимком бакетов и экспериментов выполняется без цикла по бакетам в Python.
+
+        :return offsets, experiment_ids, salt_codes, salts.
+        """
+        experiments = {exp_id: (experiment.id, experiment.salt) for exp_id, experiment in self.id2experiment.items()}
+        if self._layout is not None and self._layout[0] == self.buckets and self._layout[1] == experiments:
+            return self._layout[2]
+        entries = [experiments[exp_id] for bucket in self.buckets for exp_id in bucket]
+        salt2code = {}
+        layout = (
+            np.concatenate([[0], np.cumsum([len(bucket) for bucket in self.buckets])]).astype(np.int64),
+            np.array([exp_id for exp_id, _ in entries], dtype=np.int64),
+            np.array([salt2code.setdefault(salt, len(salt2code)) for _, salt in entries], dtype=np.int64),
+            list(salt2code),
+        )
+        self._layout = ([list(bucket) for bucket in self.buckets], experiments, layout)
+        return layout
 
     def get_bucket(self, value: str, n: int, salt: str=''):
         """Определяет бакет по id.
@@ -45,7 +208,52 @@ class SplittingService:
         """
         hash_value = int(md5((value + salt).encode()).hexdigest(), 16)
         return hash_value % n
-    
+
+    def get_buckets(self, values, n: int, salt: str=''):
+        """Определяет бакеты для массива id, результат совпадает с get_bucket.
+
+        md5 считается по каждому значению, а остаток от деления 128-битного хеша на n
+        вычисляется векторно по двум 64-битным половинам.
+
+        :param values (list[str], np.array): уникальные идентификаторы объектов.
+        :param n (int): количество бакетов.
+        :param salt (str): соль для перемешивания.
+        :return (np.array): массив номеров бакетов, dtype=int64.
+        """
+        digests = b''.join(md5((value + salt).encode()).digest() for value in values)
+        if n > 2 ** 32:
+            hash_values = (
+                int.from_bytes(digests[i:i + 16], 'big') % n for i in range(0, len(digests), 16)
+            )
+            return np.fromiter(hash_values, dtype=np.int64, count=len(digests) // 16)
+        words = np.frombuffer(digests, dtype='>u8').reshape(-1, 2).astype(np.uint64)
+        n_ = np.uint64(n)
+        high, low = words[:, 0] % n_, words[:, 1] % n_
+        base = np.uint64(2 ** 64 % n)
+        return ((high * base + low) % n_).astype(np.int64)
+
+    def get_user_buckets(self, user_ids):
+        """Определяет бакеты пользователей с учётом индекса self.bucket_index.
+
+        Бакеты известных индексу пользователей берутся из массива индекса,
+        для новых пользователей вычисляются и дописываются в индекс.
+
+        :param user_ids (list[str], np.array): идентификаторы пользователей.
+        :return (np.array): массив номеров бакетов, dtype=int64.
+        """
+        if self.bucket_index is None:
+            return self.get_buckets(user_ids, self.buckets_count, self.bucket_salt)
+        user_ids = np.asarray(user_ids, dtype=str)
+        bucket_ids = self.bucket_index.get_bucket_ids(user_ids)
+        is_new = bucket_ids < 0
+        if is_new.any():
+            new_user_ids = np.unique(user_ids[is_new])
+            self.bucket_index.add(
+                new_user_ids, self.get_buckets(new_user_ids, self.buckets_count, self.bucket_salt)
+            )
+            bucket_ids[is_new] = self.bucket_index.get_bucket_ids(user_ids[is_new])
+        return bucket_ids
+
 
     def process_user(self, user_id):
         """Определяет в какие эксперименты попадает пользователь.
@@ -61,7 +269,10 @@ class SplittingService:
             Пример: (8, [(194, 'A'), (73, 'B')])
         """
         # YOUR_CODE_HERE
-        bucket_id = self.get_bucket(user_id, self.buckets_count, self.bucket_salt)
+        if self.bucket_index is None:
+            bucket_id = self.get_bucket(user_id, self.buckets_count, self.bucket_salt)
+        else:
+            bucket_id = int(self.get_user_buckets([user_id])[0])
         
         experiment_groups_num = []
         for exp_id in self.buckets[bucket_id]:
@@ -73,6 +284,55 @@ class SplittingService:
         
         return (bucket_id, experiment_groups)
 
+    def process_users(self, user_ids, n_jobs=1, chunk_size=100_000):
+        """Определяет в какие эксперименты попадают пользователи, пакетная версия process_user.
+
+        Результат возвращается в колоночном виде. Пары (пользователь, эксперимент) упорядочены
+        так же, как их вернул бы process_user для каждого пользователя по очереди.
+
+        :param user_ids (list[str], np.array): идентификаторы пользователей.
+        :param n_jobs (int): количество процессов. Если больше 1, то пользователи
+            разбиваются на части по chunk_size и обрабатываются в пуле процессов.
+        :param chunk_size (int): размер части пользователей для одного процесса.
+        :return bucket_ids, user_index, experiment_ids, groups:
+            - bucket_ids (np.array) - номер бакета каждого пользователя, shape=(len(user_ids),)
+            - user_index (np.array) - индекс пользователя в user_ids для каждой пары
+            - experiment_ids (np.array) - id эксперимента для каждой пары
+            - groups (np.array) - группа 'A' или 'B' для каждой пары
+            Пример: user_ids=['1', '2'] -> ([8, 3], [0, 0], [194, 73], ['A', 'B'])
+        """
+        user_ids = np.asarray(user_ids, dtype=str)
+        if n_jobs > 1 and len(user_ids) > chunk_size:
+            chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(self.process_users, chunks))
+            offsets = np.arange(0, len(user_ids), chunk_size)
+            return (
+                np.concatenate([res[0] for res in results]),
+                np.concatenate([res[1] + offset for res, offset in zip(results, offsets)]),
+                np.concatenate([res[2] for res in results]),
+                np.concatenate([res[3] for res in results]),
+            )
+
+        bucket_ids = self.get_user_buckets(user_ids)
+        offsets, layout_experiment_ids, layout_salt_codes, salts = self._get_layout()
+        # пары (пользователь, эксперимент) - эксперименты бакета каждого пользователя по порядку
+        begins = offsets[bucket_ids]
+        lengths = offsets[bucket_ids + 1] - begins
+        user_index = np.repeat(np.arange(len(user_ids)), lengths)
+        entries = np.repeat(begins - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        experiment_ids = layout_experiment_ids[entries]
+        salt_codes = layout_salt_codes[entries]
+
+        groups_num = np.zeros(len(entries), dtype=np.int64)
+        order = np.argsort(salt_codes, kind='stable')
+        bounds = np.searchsorted(salt_codes[order], np.arange(len(salts) + 1))
+        for code in np.flatnonzero(np.diff(bounds)):
+            pairs = order[bounds[code]:bounds[code + 1]]
+            groups_num[pairs] = self.get_buckets(user_ids[user_index[pairs]], 2, salts[code])
+        return bucket_ids, user_index, experiment_ids, np.array(['A', 'B'])[groups_num]
+
+
 if __name__ == '__main__':
     id2experiment = {
         0: Experiment(id=0, salt='0'),
@@ -91,4 +351,68 @@ if __name__ == '__main__':
         for exp_id, group in experiment_groups:
             assert exp_id in id2experiment, 'Неверный experiment_id'
             assert group in ['A', 'B'], 'Неверная group'
+
+    for n_jobs in [1, 2]:
+        bucket_ids, user_index, experiment_ids, groups = splitting_service.process_users(
+            user_ids, n_jobs=n_jobs, chunk_size=300
+        )
+        ideal_pairs = []
+        for index, user_id in enumerate(user_ids):
+            bucket_id, experiment_groups = splitting_service.process_user(user_id)
+            assert bucket_ids[index] == bucket_id, 'process_users: неверный bucket_id'
+            ideal_pairs += [(index, exp_id, group) for exp_id, group in experiment_groups]
+        pairs = list(zip(user_index.tolist(), experiment_ids.tolist(), groups.tolist()))
+        assert pairs == ideal_pairs, 'process_users: результат не совпадает с process_user'
+
+    # раскладка экспериментов по бакетам пересчитывается после изменения бакетов
+    splitting_service.buckets[2].append(0)
+    splitting_service.id2experiment[2] = Experiment(id=2, salt='2')
+    splitting_service.buckets[3] += [2, 1]
+    _, user_index, experiment_ids, groups = splitting_service.process_users(user_ids)
+    ideal_pairs = [
+        (index, exp_id, group)
+        for index, user_id in enumerate(user_ids) for exp_id, group in splitting_service.process_user(user_id)[1]
+    ]
+    assert list(zip(user_index.tolist(), experiment_ids.tolist(), groups.tolist())) == ideal_pairs, \
+        'process_users не учитывает изменение бакетов'
+    buckets[2].remove(0)
+    buckets[3].clear()
+
+    with tempfile.TemporaryDirectory() as index_path:
+        indexed_service = SplittingService(buckets_count, bucket_salt, buckets, id2experiment, index_path)
+        assert indexed_service.process_users(user_ids[:500])[0].tolist() == bucket_ids[:500].tolist()
+        assert indexed_service.process_user(user_ids[700]) == splitting_service.process_user(user_ids[700])
+        assert len(indexed_service.bucket_index) == 501, 'Неверный размер индекса'
+        # второй процесс видит уже записанный индекс и дописывает только новых пользователей
+        other_service = SplittingService(buckets_count, bucket_salt, buckets, id2experiment, index_path)
+        assert len(other_service.bucket_index) == 501, 'Индекс не прочитан с диска'
+        assert other_service.process_users(user_ids)[0].tolist() == bucket_ids.tolist()
+        indexed_service.bucket_index.refresh()
+        assert len(indexed_service.bucket_index) == len(user_ids), 'Индекс не дописан'
+
+        # запись прервалась до замены манифеста: файлы нового уровня не используются и перезаписываются
+        bucket_index = indexed_service.bucket_index
+        ids_path, buckets_path = bucket_index._get_level_paths(bucket_index.manifest['next_generation'])
+        np.save(ids_path, np.array(['1000', 'broken']))
+        np.save(buckets_path, np.array([3, 3], dtype='<i4'))
+        with open(f'{bucket_index.manifest_path}.tmp', 'w') as file:
+            file.write('{"lev')
+        new_user_ids = [str(x) for x in range(1000, 1300)]
+        ideal_bucket_ids = splitting_service.get_buckets(new_user_ids, buckets_count, bucket_salt)
+        other_service = SplittingService(buckets_count, bucket_salt, buckets, id2experiment, index_path)
+        assert other_service.get_user_buckets(new_user_ids).tolist() == ideal_bucket_ids.tolist()
+        bucket_index.refresh()
+        assert len(bucket_index) == 1300 and bucket_index.get_bucket_ids(['broken'])[0] == -1
+        assert bucket_index.get_bucket_ids(new_user_ids).tolist() == ideal_bucket_ids.tolist(), 'Индекс рассогласован'
+
+        # много маленьких добавлений: уровни сливаются, их количество растёт логарифмически
+        many_user_ids = np.array([f'u{x}' for x in range(5000)])
+        for begin in range(0, len(many_user_ids), 50):
+            other_service.get_user_buckets(many_user_ids[begin:begin + 50])
+        bucket_index.refresh()
+        assert len(bucket_index) == 6300 and len(bucket_index.levels) <= 6, 'Уровни индекса не сливаются'
+        ideal_bucket_ids = splitting_service.get_buckets(many_user_ids, buckets_count, bucket_salt)
+        assert bucket_index.get_bucket_ids(many_user_ids).tolist() == ideal_bucket_ids.tolist()
+        n_files = len([name for name in os.listdir(index_path) if name.endswith('.npy')])
+        assert n_files == 2 * len(bucket_index.levels), 'Файлы слитых уровней должны удаляться'
     print('simple test passed')
@@ -1,6 +1,71 @@
 import numpy as np
 import pandas as pd
 
+from seminar1_task5 import grow_array
+
+
+class RatioAccumulator:
+
+    def __init__(self):
+        """Поюзерные суммы и количества значений метрики отношения.
+
+        Пользователи кодируются порядковыми номерами в порядке появления, суммы и количества
+        хранятся в массивах по кодам. События добавляются пачками через update, аккумуляторы
+        разных шардов объединяются через merge, поэтому сырые события не нужно хранить
+        и агрегировать повторно. Пропущенные значения метрики не учитываются, как в groupby.
+        """
+        self.user2code = {}
+        self.sums = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.user2code)
+
+    def _get_codes(self, user_ids):
+        """Возвращает коды пользователей, новым пользователям выделяет коды; -1 для пропусков."""
+        inverse, uniques = pd.factorize(np.asarray(user_ids))
+        mapping = np.array([self.user2code.setdefault(user_id, len(self.user2code)) for user_id in uniques] + [-1])
+        self.sums = grow_array(self.sums, len(self))
+        self.counts = grow_array(self.counts, len(self))
+        return mapping[inverse]
+
+    def update(self, user_ids, values):
+        """Добавляет пачку событий.
+
+        :param user_ids (np.array, pd.Series): пользователи событий.
+        :param values (np.array, pd.Series): значения метрики событий.
+        """
+        codes = self._get_codes(user_ids)
+        values = np.asarray(values, dtype=float)
+        is_valid = (codes >= 0) & ~np.isnan(values)
+        codes, values = codes[is_valid], values[is_valid]
+        self.sums[:len(self)] += np.bincount(codes, values, minlength=len(self))
+        self.counts[:len(self)] += np.bincount(codes, minlength=len(self))
+        return self
+
+    def merge(self, other):
+        """Добавляет суммы и количества другого аккумулятора, например с другого шарда."""
+        codes = self._get_codes(list(other.user2code))
+        self.sums[codes] += other.sums[:len(other)]
+        self.counts[codes] += other.counts[:len(other)]
+        return self
+
+    def get_sums_counts(self, user_ids=None):
+        """Возвращает суммы и количества для пользователей.
+
+        :param user_ids (None, list): пользователи, если None - все пользователи с событиями по возрастанию id.
+        :return user_ids, sums, counts: массивы одной длины, для пользователей без событий суммы и количества 0.
+        """
+        if user_ids is None:
+            user_ids = np.array(sorted(self.user2code))
+        codes = np.array([self.user2code.get(user_id, -1) for user_id in user_ids], dtype=np.int64)
+        is_known = codes >= 0
+        sums = np.zeros(len(codes))
+        counts = np.zeros(len(codes), dtype=np.int64)
+        sums[is_known] = self.sums[codes[is_known]]
+        counts[is_known] = self.counts[codes[is_known]]
+        return np.asarray(user_ids), sums, counts
+
 
 class MetricsService:
 
@@ -31,49 +96,27 @@ class MetricsService:
         :return lin_control_metrics, lin_pilot_metrics: columns=['user_id', 'metric']
         """
         # YOUR_CODE_HERE
-        if control_user_ids:
-            sum_count_per_user_a = pd.merge(
-                pd.Series(control_user_ids, name='user_id'),
-                control_metrics \
-                    .groupby('user_id')['metric'] \
-                    .agg(['sum','count']) \
-                    .reset_index(),
-                how='left',
-                on='user_id'
-            ).fillna(0)
-            
-        else:
-            sum_count_per_user_a = control_metrics \
-            .groupby('user_id')['metric'] \
-            .agg(['sum','count']) \
-            .reset_index()
-            
-        if pilot_user_ids:
-            sum_count_per_user_b = pd.merge(
-                pd.Series(pilot_user_ids, name='user_id'),
-                pilot_metrics \
-                    .groupby('user_id')['metric'] \
-                    .agg(['sum','count']) \
-                    .reset_index(),
-                how='left',
-                on='user_id'
-            ).fillna(0)
-            
-        else:
-            sum_count_per_user_b = pilot_metrics \
-            .groupby('user_id')['metric'] \
-            .agg(['sum','count']) \
-            .reset_index()
-        
-        sum_a, count_a = sum_count_per_user_a[['sum','count']].sum()
-        sum_b, count_b = sum_count_per_user_b[['sum','count']].sum()
-
-        kappa = sum_a / count_a
-        sum_count_per_user_a['metric'] = sum_count_per_user_a['sum'] - kappa * sum_count_per_user_a['count']
-        sum_count_per_user_b['metric'] = sum_count_per_user_b['sum'] - kappa * sum_count_per_user_b['count']
-        
-        return sum_count_per_user_a[['user_id','metric']], sum_count_per_user_b[['user_id','metric']]
-        
+        control = RatioAccumulator().update(control_metrics['user_id'], control_metrics['metric'])
+        pilot = RatioAccumulator().update(pilot_metrics['user_id'], pilot_metrics['metric'])
+        return self.linearize(control, pilot, control_user_ids or None, pilot_user_ids or None)
+
+    def linearize(self, control, pilot, control_user_ids=None, pilot_user_ids=None):
+        """Считает линеаризованную метрику отношения по накопленным суммам и количествам.
+
+        kappa - отношение суммы к количеству по пользователям control_user_ids контрольной группы.
+
+        :param control, pilot (RatioAccumulator): суммы и количества контрольной и экспериментальной групп.
+        :param control_user_ids, pilot_user_ids (None, list): пользователи групп,
+            если None - все пользователи аккумулятора. Метрика пользователя без событий равна нулю.
+        :return lin_control_metrics, lin_pilot_metrics: columns=['user_id', 'metric']
+        """
+        control_user_ids, control_sums, control_counts = control.get_sums_counts(control_user_ids)
+        pilot_user_ids, pilot_sums, pilot_counts = pilot.get_sums_counts(pilot_user_ids)
+        kappa = control_sums.sum() / control_counts.sum()
+        return (
+            pd.DataFrame({'user_id': control_user_ids, 'metric': control_sums - kappa * control_counts}),
+            pd.DataFrame({'user_id': pilot_user_ids, 'metric': pilot_sums - kappa * pilot_counts}),
+        )
 
 
 def _chech_df(df, df_ideal, sort_by, reindex=False, set_dtypes=False, decimal=None):
@@ -110,4 +153,32 @@ if __name__ == '__main__':
     )
     _chech_df(lin_control_metrics, ideal_lin_control_metrics, ['user_id', 'metric'], True, True, decimal=3)
     _chech_df(lin_pilot_metrics, ideal_lin_pilot_metrics, ['user_id', 'metric'], True, True, decimal=3)
+
+    lin_control_metrics, lin_pilot_metrics = metrics_service.calculate_linearized_metrics(
+        control_metrics, pilot_metrics, [1, 2, 4], [3, 5]
+    )
+    ideal_lin_control_metrics = pd.DataFrame({'user_id': [1, 2, 4], 'metric': [-2, 2, 0],})
+    ideal_lin_pilot_metrics = pd.DataFrame({'user_id': [3, 5], 'metric': [-1, 0],})
+    _chech_df(lin_control_metrics, ideal_lin_control_metrics, ['user_id', 'metric'], True, True, decimal=3)
+    _chech_df(lin_pilot_metrics, ideal_lin_pilot_metrics, ['user_id', 'metric'], True, True, decimal=3)
+
+    # группа без событий: для явно заданных пользователей значения равны 0
+    lin_control_metrics, lin_pilot_metrics = metrics_service.calculate_linearized_metrics(
+        control_metrics, pilot_metrics.iloc[:0], [1, 2], [3, 5]
+    )
+    ideal_lin_pilot_metrics = pd.DataFrame({'user_id': [3, 5], 'metric': [0, 0],})
+    _chech_df(lin_pilot_metrics, ideal_lin_pilot_metrics, ['user_id', 'metric'], True, True, decimal=3)
+
+    rng = np.random.default_rng(0)
+    events = pd.DataFrame({'user_id': rng.integers(0, 1000, 10000).astype(str), 'metric': rng.exponential(5, 10000)})
+    control = RatioAccumulator()
+    shards = [RatioAccumulator() for _ in range(3)]
+    for index, batch in enumerate(np.array_split(np.arange(len(events)), 7)):
+        shards[index % 3].update(events['user_id'].values[batch], events['metric'].values[batch])
+    for shard in shards:
+        control.merge(shard)
+    grouped = events.groupby('user_id')['metric'].agg(['sum', 'count'])
+    user_ids, sums, counts = control.get_sums_counts()
+    assert (user_ids == grouped.index).all() and (counts == grouped['count']).all(), 'Неверные количества'
+    np.testing.assert_allclose(sums, grouped['sum'], err_msg='Неверные суммы')
     print('simple test passed')
\ No newline at end of file
@@ -0,0 +1,111 @@
+import numpy as np
+from scipy import stats
+
+from seminar12_task2 import RatioAccumulator
+
+
+def get_ratio_moments(x, y):
+    """Считает моменты числителя и знаменателя метрики отношения по пользователям.
+
+    :param x (np.ndarray): поюзерные числители, shape=(..., n).
+    :param y (np.ndarray): поюзерные знаменатели, shape=(..., n).
+    :return (np.ndarray): моменты (n, sum(x), sum(y), sum(x^2), sum(y^2), sum(x*y)), shape=(..., 6).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = np.full(x.shape[:-1], x.shape[-1], dtype=float)
+    return np.stack([n, x.sum(-1), y.sum(-1), (x ** 2).sum(-1), (y ** 2).sum(-1), (x * y).sum(-1)], axis=-1)
+
+
+def get_accumulator_moments(accumulator: RatioAccumulator, user_ids=None):
+    """Моменты метрики отношения группы по накопленным суммам и количествам.
+
+    :param accumulator (RatioAccumulator): поюзерные суммы (числитель) и количества (знаменатель).
+    :param user_ids (None, list): пользователи группы, если None - все пользователи аккумулятора.
+    :return (np.ndarray): моменты, shape=(6,), см. get_ratio_moments.
+    """
+    _, sums, counts = accumulator.get_sums_counts(user_ids)
+    return get_ratio_moments(sums, counts)
+
+
+class ExperimentsService:
+
+    def get_pvalues_delta_method(self, moments_a_group, moments_b_group):
+        """Проверяет гипотезы о равенстве метрик отношения дельта-методом.
+
+        Дисперсия метрики отношения sum(x) / sum(y) группы оценивается как
+        (var_x / mean_y^2 + mean_x^2 / mean_y^4 * var_y - 2 * mean_x / mean_y^3 * cov_xy) / n,
+        var_x и var_y - смещённые оценки, cov_xy - несмещённая, как в check_delta_method из 12_linearization.
+        Вычисления используют только моменты, поэтому не зависят от количества событий
+        и выполняются сразу для всех метрик и экспериментов.
+
+        :param moments_a_group (np.ndarray): моменты контрольной группы, shape=(..., 6), см. get_ratio_moments.
+        :param moments_b_group (np.ndarray): моменты экспериментальной группы, shape=(..., 6).
+        :return pvalues, deltas:
+            pvalues (np.ndarray) - значения p-value, shape=(...)
+            deltas (np.ndarray) - разности метрик отношения группы B и группы A, shape=(...)
+        """
+        metric_a, var_a = _get_ratio_mean_var(np.asarray(moments_a_group, dtype=float))
+        metric_b, var_b = _get_ratio_mean_var(np.asarray(moments_b_group, dtype=float))
+        deltas = metric_b - metric_a
+        statistic = deltas / np.sqrt(var_a + var_b)
+        pvalues = (1 - stats.norm.cdf(np.abs(statistic))) * 2
+        return pvalues, deltas
+
+
+def _get_ratio_mean_var(moments):
+    """Значение метрики отношения и дисперсия её оценки по моментам, shape=(...)."""
+    n, sum_x, sum_y, sum_x2, sum_y2, sum_xy = np.moveaxis(moments, -1, 0)
+    mean_x = sum_x / n
+    mean_y = sum_y / n
+    var_x = sum_x2 / n - mean_x ** 2
+    var_y = sum_y2 / n - mean_y ** 2
+    cov_xy = (sum_xy - n * mean_x * mean_y) / (n - 1)
+    var_metric = (
+        var_x / mean_y ** 2
+        + mean_x ** 2 / mean_y ** 4 * var_y
+        - 2 * mean_x / mean_y ** 3 * cov_xy
+    ) / n
+    return sum_x / sum_y, var_metric
+
+
+if __name__ == '__main__':
+    def check_delta_method(a, b):
+        """Дельта-метод из ноутбука 12_linearization по поюзерным массивам длин сессий."""
+        dict_stats = {'a': {'data': a}, 'b': {'data': b}}
+        for dict_ in dict_stats.values():
+            x = np.array([np.sum(row) for row in dict_['data']])
+            y = np.array([len(row) for row in dict_['data']])
+            dict_['metric'] = np.sum(x) / np.sum(y)
+            dict_['var_metric'] = (
+                np.std(x) ** 2 / np.mean(y) ** 2
+                + np.mean(x) ** 2 / np.mean(y) ** 4 * np.std(y) ** 2
+                - 2 * np.mean(x) / np.mean(y) ** 3 * np.cov(x, y)[0, 1]
+            ) / len(x)
+        delta = dict_stats['b']['metric'] - dict_stats['a']['metric']
+        statistic = delta / np.sqrt(dict_stats['b']['var_metric'] + dict_stats['a']['var_metric'])
+        return (1 - stats.norm.cdf(np.abs(statistic))) * 2, delta
+
+    rng = np.random.default_rng(0)
+    n_metrics, n_experiments, n_users = 20, 5, 300
+    sessions = [
+        [[rng.normal(100 * (1 + 0.05 * group), 10, rng.integers(3, 10)) for _ in range(n_users)] for group in range(2)]
+        for _ in range(n_metrics * n_experiments)
+    ]
+    moments = np.array([
+        [get_ratio_moments([row.sum() for row in data], [len(row) for row in data]) for data in pair]
+        for pair in sessions
+    ]).reshape(n_metrics, n_experiments, 2, 6)
+
+    experiments_service = ExperimentsService()
+    pvalues, deltas = experiments_service.get_pvalues_delta_method(moments[..., 0, :], moments[..., 1, :])
+    assert pvalues.shape == (n_metrics, n_experiments), 'Неверная размерность результата'
+    ideal_pvalues, ideal_deltas = np.array([check_delta_method(*pair) for pair in sessions]).T
+    np.testing.assert_allclose(pvalues.ravel(), ideal_pvalues, rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(deltas.ravel(), ideal_deltas, rtol=1e-10)
+
+    accumulator = RatioAccumulator()
+    for user_id, row in enumerate(sessions[0][0]):
+        accumulator.update(np.full(len(row), user_id), row)
+    np.testing.assert_allclose(get_accumulator_moments(accumulator), moments[0, 0, 0])
+    print('simple test passed')
@@ -1,8 +1,83 @@
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
 import pandas as pd
 
 from datetime import datetime
 
 
+class IndexedTable:
+
+    def __init__(self, table):
+        """Таблица с индексами для быстрой фильтрации по дате и user_id.
+
+        Строки таблицы упорядочены по date (сортировка устойчивая, строки без даты в конце),
+        поэтому фильтр по интервалу дат - это срез, границы которого ищутся через searchsorted.
+        Индекс по user_id строится при первом фильтре по пользователям: user_id кодируются
+        целыми числами, позиции строк каждого пользователя лежат подряд (CSR-формат).
+
+        :param table (pd.DataFrame): исходная таблица, не изменяется.
+        """
+        self.table = table
+        self.sorted_table = table
+        self.dates = None
+        self.valid_dates_count = len(table)
+        if 'date' in table.columns:
+            if not table['date'].is_monotonic_increasing:
+                self.sorted_table = table.sort_values('date', kind='stable')
+            self.dates = self.sorted_table['date']
+            self.valid_dates_count = int(self.dates.notna().sum())
+        self.user_codes = None
+
+    def _build_user_index(self):
+        codes, uniques = pd.factorize(self.sorted_table['user_id'])
+        self.user_codes = codes
+        self.user_uniques = pd.Index(uniques)
+        order = np.argsort(codes, kind='stable')
+        # строки без user_id имеют код -1 и после сортировки идут первыми
+        self.user_positions = order[(codes < 0).sum():]
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.user_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def get_date_bounds(self, begin_date, end_date):
+        """Возвращает границы среза строк с begin_date <= date < end_date."""
+        if begin_date is None and end_date is None:
+            return 0, len(self.sorted_table)
+        dates = self.dates[:self.valid_dates_count]
+        begin = 0 if begin_date is None else int(dates.searchsorted(begin_date, side='left'))
+        end = len(dates) if end_date is None else int(dates.searchsorted(end_date, side='left'))
+        return begin, max(begin, end)
+
+    def get_positions(self, begin_date, end_date, user_ids=None):
+        """Возвращает позиции строк sorted_table, подходящих под фильтры.
+
+        :return (slice, np.array): срез, если фильтра по user_id нет, иначе отсортированный массив позиций.
+        """
+        begin, end = self.get_date_bounds(begin_date, end_date)
+        if user_ids is None:
+            return slice(begin, end)
+        if self.user_codes is None:
+            self._build_user_index()
+
+        codes = self.user_uniques.get_indexer(pd.Index(user_ids).unique())
+        codes = codes[codes >= 0]
+        lengths = self.user_offsets[codes + 1] - self.user_offsets[codes]
+        if lengths.sum() < end - begin:
+            # строк выбранных пользователей меньше, чем строк в интервале дат - собираем их по индексу
+            shifts = np.repeat(self.user_offsets[codes] - np.cumsum(lengths) + lengths, lengths)
+            positions = self.user_positions[shifts + np.arange(lengths.sum())]
+            positions = positions[(positions >= begin) & (positions < end)]
+            positions.sort()
+            return positions
+        # иначе проверяем коды строк интервала по маске выбранных пользователей, код -1 попадает в False
+        is_selected = np.zeros(len(self.user_uniques) + 1, dtype=bool)
+        is_selected[codes] = True
+        return begin + np.flatnonzero(is_selected[self.user_codes[begin:end]])
+
+
 class DataService:
 
     def __init__(self, table_name_2_table):
@@ -15,10 +90,26 @@ class DataService:
             }. 
         """
         self.table_name_2_table = table_name_2_table
+        self.table_name_2_indexed_table = {}
+
+    def _get_indexed_table(self, table_name):
+        """Возвращает индексы таблицы, строит их при первом обращении или после замены таблицы.
 
-    def get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None):
+        Изменения таблицы на месте не отслеживаются.
+        """
+        table = self.table_name_2_table[table_name]
+        indexed_table = self.table_name_2_indexed_table.get(table_name)
+        if indexed_table is None or indexed_table.table is not table:
+            indexed_table = IndexedTable(table)
+            self.table_name_2_indexed_table[table_name] = indexed_table
+        return indexed_table
+
+    def get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None, copy=False):
         """Возвращает подмножество данных.
 
+        Строки возвращаются в порядке возрастания date. Если фильтра по user_id нет,
+        то результат - срез таблицы без копирования данных.
+
         :param table_name (str): название таблицы с данными.
         :param begin_date (datetime.datetime): дата начала интервала с данными.
             Пример, df[df['date'] >= begin_date].
@@ -32,39 +123,298 @@ class DataService:
         :param columns (None, list[str]): список названий столбцов, по которым нужно предоставить данные.
             Пример, df[columns].
             Если None, то фильтровать по columns не нужно.
+        :param copy (bool): вернуть копию данных, а не срез таблицы.
 
         :return df (pd.DataFrame): датафрейм с подмножеством данных.
         """
         # YOUR_CODE_HERE
-        df = self.table_name_2_table[table_name]
-        
-        # Filtering by date
-        if begin_date is None:
-            if end_date is None:
-                pass
-            else:
-                df = df.loc[df['date'] < end_date]
-        else:
-            if end_date is None:
-                df = df.loc[df['date'] >= begin_date]
-            else:
-                df = df.loc[(df['date'] >= begin_date) & (df['date'] < end_date)]
-        
-        # Filtering by user_id's
-        if user_ids is not None:
-            df = df.loc[df['user_id'].isin(user_ids)]
-        else:
-            pass
-            
-        # Filtering columns to show
+        indexed_table = self._get_indexed_table(table_name)
+        positions = indexed_table.get_positions(begin_date, end_date, user_ids)
+
+        df = indexed_table.sorted_table
         if columns is not None:
             df = df[columns]
+        if isinstance(positions, slice):
+            df = df.iloc[positions]
         else:
-            pass
+            df = df.take(positions)
 
+        if copy:
+            df = df.copy()
         return df
 
 
+class ColumnarStore:
+
+    def __init__(self, path):
+        """Хранилище таблиц в виде колоночных файлов, разбитых на партиции по дням.
+
+        Структура: <path>/<table_name>/date=YYYY-MM-DD/part-NNNNN/<column>.npy, строки без даты
+        лежат в партиции date=null. Внутри части строки упорядочены по date. Строковые столбцы
+        хранятся словарным кодированием: коды int32 (-1 для пропусков) и общий для таблицы
+        словарь <column>.dict.npy. Номер строки в исходной таблице хранится в столбце __row__.
+        Все файлы - обычные .npy, поэтому читаются через np.load(..., mmap_mode='r').
+
+        :param path (str): директория хранилища.
+        """
+        self.path = path
+
+    def write_table(self, table_name, table):
+        """Записывает таблицу целиком, существующая таблица с тем же именем перезаписывается."""
+        self.write_chunks(table_name, [table])
+
+    def write_csv(self, table_name, csv_path, chunksize=1_000_000, dtype=None):
+        """Записывает таблицу из csv-файла, читая его частями по chunksize строк.
+
+        :param dtype (None, dict): типы столбцов для pd.read_csv. Если None, то типы
+            определяются по каждой части и согласуются в write_chunks.
+        """
+        self.write_chunks(
+            table_name, pd.read_csv(csv_path, parse_dates=['date'], chunksize=chunksize, dtype=dtype)
+        )
+
+    def write_chunks(self, table_name, chunks):
+        """Записывает таблицу, заданную последовательностью частей-датафреймов с одинаковыми столбцами.
+
+        Типы числовых столбцов могут отличаться между частями, например целый столбец становится
+        float64 в части с пропусками. Тогда в таблице сохраняется общий тип, к которому при чтении
+        приводятся значения всех частей.
+        """
+        table_path = os.path.join(self.path, table_name)
+        if os.path.exists(table_path):
+            shutil.rmtree(table_path)
+        os.makedirs(table_path)
+
+        meta = None
+        dictionaries = {}
+        partitions = {}
+        row_offset = 0
+        for part_number, chunk in enumerate(chunks):
+            if meta is None:
+                meta = self._get_meta(chunk)
+                dictionaries = {column: {} for column in meta['encoded']}
+            else:
+                self._merge_meta(meta, chunk)
+            rows = np.arange(row_offset, row_offset + len(chunk))
+            row_offset += len(chunk)
+            order = np.argsort(chunk['date'].to_numpy(), kind='stable')
+            arrays = {'__row__': rows[order]}
+            for column in meta['columns']:
+                values = chunk[column].to_numpy()[order]
+                if column in dictionaries:
+                    codes, uniques = pd.factorize(values)
+                    mapping = np.array(
+                        [dictionaries[column].setdefault(value, len(dictionaries[column])) for value in uniques] + [-1],
+                        dtype=np.int32
+                    )
+                    values = mapping[codes]
+                arrays[column] = values
+
+            days = chunk['date'].to_numpy()[order].astype('datetime64[D]')
+            valid_count = int((~np.isnat(days)).sum())
+            unique_days, starts = np.unique(days[:valid_count], return_index=True)
+            bounds = list(starts) + [valid_count]
+            day_names = [str(day) for day in unique_days]
+            if valid_count < len(days):
+                day_names.append('null')
+                bounds.append(len(days))
+            for index, day_name in enumerate(day_names):
+                part_path = os.path.join(table_path, f'date={day_name}', f'part-{part_number:05d}')
+                os.makedirs(part_path)
+                for column, values in arrays.items():
+                    np.save(os.path.join(part_path, f'{column}.npy'), values[bounds[index]:bounds[index + 1]])
+                partitions.setdefault(day_name, []).append(os.path.relpath(part_path, table_path))
+
+        for column, dictionary in dictionaries.items():
+            np.save(os.path.join(table_path, f'{column}.dict.npy'), np.array(list(dictionary), dtype=str))
+        meta['partitions'] = sorted(partitions.items(), key=lambda item: (item[0] == 'null', item[0]))
+        with open(os.path.join(table_path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+    def _get_meta(self, chunk):
+        meta = {'columns': list(chunk.columns), 'dtypes': {}, 'storage_dtypes': {}, 'encoded': []}
+        for column in chunk.columns:
+            dtype = chunk[column].dtype
+            meta['dtypes'][column] = str(dtype)
+            if dtype == object or pd.api.types.is_string_dtype(dtype):
+                meta['encoded'].append(column)
+                meta['storage_dtypes'][column] = 'int32'
+            elif dtype.kind in 'biufcmM':
+                meta['storage_dtypes'][column] = dtype.str
+            else:
+                raise ValueError(f'Неподдерживаемый тип столбца {column}: {dtype}')
+        return meta
+
+    def _merge_meta(self, meta, chunk):
+        """Приводит типы столбцов meta к общим с типами очередной части."""
+        chunk_meta = self._get_meta(chunk)
+        for column in meta['columns']:
+            if column in meta['encoded']:
+                # столбец строк из одних пропусков читается как float64, его коды -1
+                if column in chunk_meta['encoded'] or chunk[column].isna().all():
+                    continue
+            elif column not in chunk_meta['encoded']:
+                dtype = np.result_type(meta['storage_dtypes'][column], chunk_meta['storage_dtypes'][column])
+                if meta['storage_dtypes'][column] != dtype.str:
+                    meta['dtypes'][column] = str(dtype)
+                    meta['storage_dtypes'][column] = dtype.str
+                continue
+            raise ValueError(
+                f'Типы столбца {column} в частях не согласуются: '
+                f'{meta["dtypes"][column]} и {chunk_meta["dtypes"][column]}, задайте dtype в write_csv'
+            )
+
+
+class ColumnarDataService:
+
+    def __init__(self, path):
+        """Класс, предоставляющий доступ к сырым данным из ColumnarStore.
+
+        Интерфейс и результат get_data_subset такие же, как у DataService: читаются только
+        партиции из интервала дат и только нужные столбцы. Индекс результата - номер строки
+        в исходной таблице, что совпадает с DataService для таблиц с RangeIndex.
+
+        :param path (str): директория хранилища ColumnarStore.
+        """
+        self.path = path
+        self.table_name_2_meta = {}
+        self.dictionaries = {}
+
+    def _get_meta(self, table_name):
+        if table_name not in self.table_name_2_meta:
+            with open(os.path.join(self.path, table_name, 'meta.json')) as file:
+                self.table_name_2_meta[table_name] = json.load(file)
+        return self.table_name_2_meta[table_name]
+
+    def _get_dictionary(self, table_name, column):
+        key = (table_name, column)
+        if key not in self.dictionaries:
+            self.dictionaries[key] = np.load(os.path.join(self.path, table_name, f'{column}.dict.npy'))
+        return self.dictionaries[key]
+
+    def _load(self, table_name, part, column):
+        return np.load(os.path.join(self.path, table_name, part, f'{column}.npy'), mmap_mode='r')
+
+    def get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None, copy=False):
+        """Возвращает подмножество данных, параметры как у DataService.get_data_subset.
+
+        :param copy (bool): не используется, результат всегда собирается в новых массивах.
+        :return df (pd.DataFrame): датафрейм с подмножеством данных.
+        """
+        meta = self._get_meta(table_name)
+        columns_ = meta['columns'] if columns is None else list(columns)
+        begin = None if begin_date is None else np.datetime64(pd.Timestamp(begin_date))
+        end = None if end_date is None else np.datetime64(pd.Timestamp(end_date))
+
+        is_selected_user = None
+        if user_ids is not None:
+            dictionary = pd.Index(self._get_dictionary(table_name, 'user_id'))
+            codes = dictionary.get_indexer(pd.Index(user_ids).unique())
+            is_selected_user = np.zeros(len(dictionary) + 1, dtype=bool)
+            is_selected_user[codes[codes >= 0]] = True
+
+        values = {column: [] for column in columns_}
+        rows = []
+        for parts in self._get_partitions(meta, begin, end):
+            partition_rows = []
+            partition_dates = []
+            for part in parts:
+                dates = self._load(table_name, part, 'date')
+                lo = 0 if begin is None else int(dates.searchsorted(begin, side='left'))
+                hi = len(dates) if end is None else int(dates.searchsorted(end, side='left'))
+                positions = np.arange(lo, max(lo, hi))
+                if is_selected_user is not None:
+                    positions = positions[is_selected_user[self._load(table_name, part, 'user_id')[positions]]]
+                partition_rows.append(self._load(table_name, part, '__row__')[positions])
+                partition_dates.append(dates[positions].view(np.int64))
+                for column in columns_:
+                    values[column].append(self._load(table_name, part, column)[positions])
+            # части одной партиции упорядочены по дате каждая отдельно
+            partition_rows = np.concatenate(partition_rows)
+            order = np.lexsort((partition_rows, np.concatenate(partition_dates)))
+            rows.append(partition_rows[order])
+            for column in columns_:
+                values[column][-len(parts):] = [np.concatenate(values[column][-len(parts):])[order]]
+
+        data = {}
+        for column in columns_:
+            if values[column]:
+                data[column] = np.concatenate(values[column])
+            else:
+                data[column] = np.empty(0, dtype=meta['storage_dtypes'][column])
+        index = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        return self._to_frame(table_name, data, index)
+
+    def _get_partitions(self, meta, begin, end):
+        """Возвращает списки частей партиций, пересекающихся с интервалом [begin, end), в порядке дат."""
+        for day_name, parts in meta['partitions']:
+            if day_name == 'null':
+                if begin is not None or end is not None:
+                    continue
+            else:
+                day = np.datetime64(day_name)
+                if begin is not None and day + np.timedelta64(1, 'D') <= begin:
+                    continue
+                if end is not None and day >= end:
+                    continue
+            yield parts
+
+    def _to_frame(self, table_name, data, index):
+        """Собирает датафрейм из хранимых массивов, восстанавливая строки по словарям и исходные типы."""
+        meta = self._get_meta(table_name)
+        for column in data:
+            column_values = data[column]
+            if column in meta['encoded']:
+                dictionary = self._get_dictionary(table_name, column).astype(object)
+                column_values = np.append(dictionary, np.nan)[column_values]
+            data[column] = pd.Series(column_values, dtype=meta['dtypes'][column])
+        df = pd.DataFrame(data, columns=list(data))
+        df.index = pd.Index(index)
+        return df
+
+    def iter_chunks(self, table_name, columns, chunk_rows, begin_date=None, end_date=None):
+        """Читает таблицу частями не больше chunk_rows строк.
+
+        Партиции вне интервала [begin_date, end_date) пропускаются, строки внутри частей
+        дополнительно по дате не фильтруются. Индекс частей - номер строки в исходной таблице.
+
+        :return (iterator[pd.DataFrame]): части таблицы со столбцами columns.
+        """
+        meta = self._get_meta(table_name)
+        begin = None if begin_date is None else np.datetime64(pd.Timestamp(begin_date))
+        end = None if end_date is None else np.datetime64(pd.Timestamp(end_date))
+        for parts in self._get_partitions(meta, begin, end):
+            for part in parts:
+                rows = self._load(table_name, part, '__row__')
+                for start in range(0, len(rows), chunk_rows):
+                    data = {
+                        column: np.array(self._load(table_name, part, column)[start:start + chunk_rows])
+                        for column in columns
+                    }
+                    yield self._to_frame(table_name, data, rows[start:start + chunk_rows])
+
+
+class CsvChunkSource:
+
+    def __init__(self, table_name_2_path):
+        """Чтение таблиц из csv-файлов частями.
+
+        :param table_name_2_path (dict[str, str]): пути к csv-файлам таблиц, в каждой таблице есть столбец 'date'.
+        """
+        self.table_name_2_path = table_name_2_path
+
+    def iter_chunks(self, table_name, columns, chunk_rows, begin_date=None, end_date=None):
+        """Читает таблицу частями не больше chunk_rows строк, параметры как у ColumnarDataService.iter_chunks.
+
+        csv-файл читается целиком, фильтр по дате не применяется. user_id читается строкой,
+        как в таблицах DataService, иначе числовые id превратились бы в int64.
+        """
+        return pd.read_csv(
+            self.table_name_2_path[table_name], usecols=columns, parse_dates=['date'], chunksize=chunk_rows,
+            dtype={'user_id': str}
+        )
+
+
 def _chech_df(df, df_ideal, sort_by):
     assert isinstance(df, pd.DataFrame), 'Функция вернула не pd.DataFrame.'
     assert len(df) == len(df_ideal), 'Неверное количество строк.'
@@ -89,4 +439,52 @@ if __name__ == '__main__':
     data_service = DataService({'table': table})
     res_df = data_service.get_data_subset('table', datetime(2022, 1, 1), datetime(2022, 1, 6))
     _chech_df(res_df, ideal_df, 'date')
+
+    np.random.seed(0)
+    table = pd.DataFrame({
+        'date': pd.to_datetime('2022-01-01') + pd.to_timedelta(np.random.randint(0, 60 * 24, 10000), unit='h'),
+        'user_id': np.random.choice([str(i) for i in range(500)], 10000),
+        'price': np.random.randint(100, 1000, 10000),
+    })
+    table.loc[::97, 'date'] = None
+    data_service = DataService({'table': table})
+    for begin_date, end_date, user_ids, columns in [
+        (None, None, None, None),
+        (datetime(2022, 1, 10), None, None, ['user_id', 'price']),
+        (None, datetime(2022, 2, 10, 6), ['1', '2', 'x'], None),
+        (datetime(2022, 1, 10), datetime(2022, 2, 10), [str(i) for i in range(400)], ['price']),
+        (datetime(2022, 3, 10), datetime(2022, 1, 10), ['1'], None),
+    ]:
+        ideal_df = table
+        if begin_date is not None:
+            ideal_df = ideal_df[ideal_df['date'] >= begin_date]
+        if end_date is not None:
+            ideal_df = ideal_df[ideal_df['date'] < end_date]
+        if user_ids is not None:
+            ideal_df = ideal_df[ideal_df['user_id'].isin(user_ids)]
+        if columns is not None:
+            ideal_df = ideal_df[columns]
+        res_df = data_service.get_data_subset('table', begin_date, end_date, user_ids, columns)
+        assert res_df.sort_index().equals(ideal_df), 'Неверная фильтрация индексированной таблицы'
+
+        with tempfile.TemporaryDirectory() as path:
+            store = ColumnarStore(path)
+            store.write_chunks('table', [table[i:i + 3000] for i in range(0, len(table), 3000)])
+            columnar_df = ColumnarDataService(path).get_data_subset('table', begin_date, end_date, user_ids, columns)
+            assert columnar_df.equals(res_df), 'Колоночное хранилище вернуло другой результат'
+
+    # pandas определяет типы по каждой части csv: в последней части price с пропуском становится float64
+    table['price'] = table['price'].astype('Int64')
+    table.loc[9999, 'price'] = pd.NA
+    table.loc[9000:, 'user_id'] = np.nan
+    with tempfile.TemporaryDirectory() as path:
+        csv_path = os.path.join(path, 'table.csv')
+        table.to_csv(csv_path, index=False)
+        chunks = list(pd.read_csv(csv_path, parse_dates=['date'], chunksize=3000))
+        assert chunks[0]['price'].dtype == np.int64 and chunks[-1]['price'].dtype == np.float64
+        store = ColumnarStore(path)
+        store.write_csv('table', csv_path, chunksize=3000)
+        columnar_df = ColumnarDataService(path).get_data_subset('table', None, None)
+        ideal_df = pd.read_csv(csv_path, parse_dates=['date'])
+        assert columnar_df.sort_index().equals(ideal_df), 'Неверное согласование типов частей'
     print('simple test passed')
\ No newline at end of file
@@ -1,39 +1,301 @@
+import tempfile
+
+import numpy as np
 import pandas as pd
 
-from datetime import datetime
+from hashlib import md5
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
+from seminar1_task4 import DataService as IndexedDataService, CsvChunkSource
 
-class DataService:
 
-    def __init__(self, table_name_2_table):
-        self.table_name_2_table = table_name_2_table
+class DataService(IndexedDataService):
 
     def get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None):
-        df = self.table_name_2_table[table_name]
-        if begin_date:
-            df = df[df['date'] >= begin_date]
-        if end_date:
-            df = df[df['date'] < end_date]
-        if user_ids:
-            df = df[df['user_id'].isin(user_ids)]
-        if columns:
-            df = df[columns]
-        return df.copy()
+        # пустые значения фильтров означают, что фильтровать не нужно
+        return super().get_data_subset(
+            table_name, begin_date or None, end_date or None, user_ids or None, columns or None
+        )
 
 
-class MetricsService:
+DAY = timedelta(days=1)
+
+
+class DailyRollups:
 
     def __init__(self, data_service):
+        """Поюзерные дневные агрегаты таблиц 'sales' и 'web-logs'.
+
+        Агрегаты хранятся как таблицы с одной строкой на (date, user_id), где date - начало суток:
+            'sales': columns=['date', 'user_id', 'revenue', 'purchases']
+            'web-logs': columns=['date', 'user_id', 'visits', 'load_time_sum', 'load_time_count']
+        Запросы за целые сутки отвечаются по агрегатам, неполные сутки на краях интервала
+        дочитываются из сырых данных.
+
+        :param data_service (DataService): объект класса, предоставляющий доступ к сырым данным.
+            Агрегаты строятся по всем данным в момент создания, новые события добавляются через update.
+        """
+        self.data_service = data_service
+        self.data_service_rollups = DataService({
+            table_name: self._aggregate(table_name, data_service.get_data_subset(table_name, None, None))
+            for table_name in ['sales', 'web-logs']
+        })
+
+    def _aggregate(self, table_name, events):
+        events = events[events['date'].notna()]
+        keys = [events['date'].dt.floor('D'), events['user_id']]
+        if table_name == 'sales':
+            rollup = events.groupby(keys)['price'].agg(revenue='sum', purchases='size')
+        else:
+            rollup = events.groupby(keys)['user_id'].agg(visits='size')
+            if 'load_time' in events.columns:
+                load_time = events.groupby(keys)['load_time'].agg(load_time_sum='sum', load_time_count='count')
+                rollup = rollup.join(load_time)
+        return rollup.reset_index()
+
+    def update(self, table_name, events):
+        """Добавляет в агрегаты новые события, которых ещё не было в сырых данных при построении.
+
+        :param table_name (str): 'sales' или 'web-logs'.
+        :param events (pd.DataFrame): новые строки сырой таблицы.
+        """
+        rollups = self.data_service_rollups.table_name_2_table
+        rollup = pd.concat([rollups[table_name], self._aggregate(table_name, events)])
+        rollups[table_name] = rollup.groupby(['date', 'user_id'], as_index=False).sum()
+
+    def _split_window(self, begin_date, end_date):
+        """Разбивает интервал на части (begin, end, is_whole_days): неполные сутки по краям и целые сутки."""
+        whole_begin = begin_date
+        if begin_date is not None:
+            whole_begin = begin_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            if whole_begin < begin_date:
+                whole_begin += DAY
+        whole_end = end_date
+        if end_date is not None:
+            whole_end = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if whole_begin is not None and whole_end is not None and whole_begin >= whole_end:
+            return [(begin_date, end_date, False)]
+        parts = [(whole_begin, whole_end, True)]
+        if begin_date is not None and begin_date < whole_begin:
+            parts.insert(0, (begin_date, whole_begin, False))
+        if end_date is not None and whole_end < end_date:
+            parts.append((whole_end, end_date, False))
+        return parts
+
+    def get_visitors(self, begin_date, end_date, user_ids=None):
+        """Возвращает отсортированные user_id пользователей, заходивших на сайт в [begin_date, end_date)."""
+        users = []
+        for begin, end, is_whole_days in self._split_window(begin_date, end_date):
+            data_service = self.data_service_rollups if is_whole_days else self.data_service
+            users.append(data_service.get_data_subset('web-logs', begin, end, user_ids, ['user_id'])['user_id'])
+        return pd.Index(pd.concat(users)).dropna().unique().sort_values()
+
+    def get_revenue(self, begin_date, end_date, user_ids=None):
+        """Возвращает суммарную выручку пользователей за [begin_date, end_date), columns=['user_id', 'price']."""
+        sales = []
+        for begin, end, is_whole_days in self._split_window(begin_date, end_date):
+            if is_whole_days:
+                sales.append(
+                    self.data_service_rollups.get_data_subset('sales', begin, end, user_ids, ['user_id', 'revenue'])
+                    .rename(columns={'revenue': 'price'})
+                )
+            else:
+                sales.append(self.data_service.get_data_subset('sales', begin, end, user_ids, ['user_id', 'price']))
+        return pd.concat(sales).groupby('user_id', as_index=False).price.sum()
+
+    def get_activity(self, begin_date, end_date, user_ids=None):
+        """Возвращает выручку, количество покупок и заходов на сайт пользователей, см. get_activity."""
+        parts = []
+        for begin, end, is_whole_days in self._split_window(begin_date, end_date):
+            if is_whole_days:
+                parts += [
+                    self.data_service_rollups.get_data_subset(
+                        'sales', begin, end, user_ids, ['user_id', 'revenue', 'purchases']
+                    ),
+                    self.data_service_rollups.get_data_subset('web-logs', begin, end, user_ids, ['user_id', 'visits']),
+                ]
+            else:
+                parts.append(get_activity(self.data_service, begin, end, user_ids).reset_index())
+        return _sum_activity(parts)
+
+
+def get_activity(data_service, begin_date, end_date, user_ids=None):
+    """Возвращает выручку, количество покупок и заходов на сайт пользователей за [begin_date, end_date).
+
+    :return (pd.DataFrame): index - user_id, columns=['revenue', 'purchases', 'visits'], dtype float64.
+    """
+    sales = data_service.get_data_subset('sales', begin_date, end_date, user_ids, ['user_id', 'price'])
+    visits = data_service.get_data_subset('web-logs', begin_date, end_date, user_ids, ['user_id'])
+    return _sum_activity([
+        sales.rename(columns={'price': 'revenue'}).assign(purchases=1),
+        visits.assign(visits=1),
+    ])
+
+
+def _sum_activity(parts):
+    activity = pd.concat(parts).groupby('user_id')[['revenue', 'purchases', 'visits']].sum()
+    return activity.astype(float)
+
+
+class MetricsCache:
+
+    def __init__(self, max_bytes):
+        """LRU-кэш промежуточных результатов MetricsService.
+
+        Ключ - (название метрики, отпечаток списка пользователей, begin_date, end_date),
+        значение - поюзерные частичные агрегаты метрики. Суммарный размер значений
+        ограничен max_bytes, при переполнении удаляются давно не использованные записи.
+
+        :param max_bytes (int): максимальный размер кэша в байтах. 0 - кэш выключен.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def find_extendable(self, metric_name, fingerprint, begin_date, end_date):
+        """Ищет запись, интервал которой лежит внутри [begin_date, end_date) и отличается от него на целые дни.
+
+        :return key (tuple, None): ключ записи с самым длинным интервалом.
+        """
+        best_key = None
+        for key in self.entries:
+            if key[:2] != (metric_name, fingerprint):
+                continue
+            left, right = key[2] - begin_date, end_date - key[3]
+            if min(left, right) < timedelta(0) or left % DAY or right % DAY:
+                continue
+            if best_key is None or key[3] - key[2] > best_key[3] - best_key[2]:
+                best_key = key
+        return best_key
+
+    def put(self, key, state):
+        size = _get_size(state)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (state, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+
+def _get_size(state):
+    """Оценивает размер частичных агрегатов метрики в байтах."""
+    if isinstance(state, tuple):
+        return sum(_get_size(item) for item in state if item is not None)
+    if isinstance(state, pd.DataFrame):
+        return int(state.memory_usage(deep=True).sum())
+    return int(state.memory_usage(deep=True))
+
+
+def _get_fingerprint(user_ids):
+    """Отпечаток списка пользователей, не зависящий от порядка и повторов."""
+    if not user_ids:
+        return None
+    return md5('\0'.join(sorted(set(map(str, user_ids)))).encode()).hexdigest()
+
+
+class MetricsService:
+
+    def __init__(self, data_service, cache_max_bytes=0, rollups=None):
         """Класс для вычисления метрик.
 
+        Каждая метрика считается в два шага: частичные поюзерные агрегаты за интервал
+        (_aggregate_*) и итоговая таблица по ним (_finalize_*). Агрегаты соседних
+        интервалов объединяются (_merge_*), поэтому при включённом кэше расширение
+        интервала на целые дни считает только новые дни.
+
         :param data_service (DataService): объект класса, предоставляющий доступ к данным.
+        :param cache_max_bytes (int): размер кэша результатов в байтах, 0 - не кэшировать.
+            Кэш не отслеживает изменения данных, после них нужно вызвать clear_cache.
+        :param rollups (None, DailyRollups): дневные агрегаты, по которым считается выручка за целые сутки.
         """
         self.data_service = data_service
+        self.cache = MetricsCache(cache_max_bytes)
+        self.rollups = rollups
+
+    def clear_cache(self):
+        self.cache.clear()
 
     def _get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None):
         """Возвращает часть таблицы с данными."""
         return self.data_service.get_data_subset(table_name, begin_date, end_date, user_ids, columns)
 
+    def _aggregate_response_time(self, begin_date, end_date, user_ids):
+        """Значения user_id и load_time из 'web-logs' за интервал, в порядке возрастания date."""
+        web_logs = self._get_data_subset('web-logs', begin_date, end_date, user_ids=user_ids, columns=['date','load_time','user_id'])
+            
+        web_logs = web_logs \
+            .loc[(web_logs['date'] >= begin_date) & (web_logs['date'] < end_date)] \
+            .rename(columns={'load_time': 'metric'})
+        
+        return web_logs[['user_id','metric']].copy()
+
+    def _merge_response_time(self, states):
+        """Объединяет значения соседних интервалов, states упорядочены по времени."""
+        return pd.concat(states)
+
+    def _aggregate_revenue(self, begin_date, end_date, user_ids, visits_begin_date, visits_end_date):
+        """Частичные агрегаты выручки.
+
+        :param begin_date, end_date (datetime): период, за который считается выручка.
+        :param visits_begin_date, visits_end_date (None, datetime): период, за который выбираются
+            пользователи, заходившие на сайт. Если visits_begin_date == visits_end_date, то пользователи не выбираются.
+        :return users, sales:
+            users (None, pd.Index) - отсортированные user_id заходивших на сайт
+            sales (pd.DataFrame) - суммарная выручка пользователей, columns=['user_id', 'price']
+        """
+        if visits_begin_date is not None and visits_begin_date == visits_end_date:
+            users = None
+        elif self.rollups is not None:
+            users = self.rollups.get_visitors(visits_begin_date, visits_end_date, user_ids)
+        else:
+            web_logs = self._get_data_subset('web-logs', visits_begin_date, visits_end_date, user_ids=user_ids, columns=['user_id'])
+            users = pd.Index(web_logs['user_id']).dropna().unique().sort_values()
+
+        if self.rollups is not None:
+            return users, self.rollups.get_revenue(begin_date, end_date, user_ids)
+
+        df_sales = self._get_data_subset('sales', begin_date, end_date, user_ids=user_ids, columns=['sale_id','date','price','user_id'])
+        sales = df_sales[(df_sales.date >= begin_date) & (df_sales.date < end_date)] \
+            .groupby('user_id',as_index=False) \
+            .price.sum()
+        return users, sales
+
+    def _merge_revenue(self, states):
+        users = None
+        for other_users, _ in states:
+            if users is None:
+                users = other_users
+            elif other_users is not None:
+                users = users.union(other_users)
+        sales = pd.concat([sales for _, sales in states]) \
+            .groupby('user_id',as_index=False) \
+            .price.sum()
+        return users, sales
+
+    def _finalize_revenue(self, state, fill_zero):
+        users, sales = state
+        merged = pd.DataFrame({'user_id': users}) \
+            .merge(sales, how='left', on='user_id') \
+            .rename(columns={'price':'metric'})
+        if fill_zero:
+            merged = merged.fillna(0)
+        return merged[['user_id','metric']]
+
     def _calculate_response_time(self, begin_date, end_date, user_ids):
         """Вычисляет значения времени обработки запроса сервером.
         
@@ -46,13 +308,7 @@ class MetricsService:
         :return (pd.DataFrame): датафрейм с двумя столбцами ['user_id', 'metric']
         """
         # YOUR_CODE_HERE
-        web_logs = self._get_data_subset('web-logs', begin_date, end_date, user_ids=user_ids, columns=['date','load_time','user_id'])
-            
-        web_logs = web_logs \
-            .loc[(web_logs['date'] >= begin_date) & (web_logs['date'] < end_date)] \
-            .rename(columns={'load_time': 'metric'})
-        
-        return web_logs[['user_id','metric']].copy()
+        return self._aggregate_response_time(begin_date, end_date, user_ids)
 
     def _calculate_revenue_web(self, begin_date, end_date, user_ids):
         """Вычисляет значения выручки с пользователя за указанный период
@@ -72,23 +328,8 @@ class MetricsService:
         :return (pd.DataFrame): датафрейм с двумя столбцами ['user_id', 'metric']
         """
         # YOUR_CODE_HERE
-        df_sales_web = self._get_data_subset('sales', begin_date, end_date, user_ids=user_ids, columns=['sale_id','date','price','user_id'])
-        web_logs_web = self._get_data_subset('web-logs', begin_date, end_date, user_ids=user_ids, columns=['date','load_time','user_id'])
-            
-        logs_web = web_logs_web[(web_logs_web.date >= begin_date) & (web_logs_web.date < end_date)] \
-            .groupby('user_id',as_index=False) \
-            .nunique()
-        
-        sales_web = df_sales_web[(df_sales_web.date >= begin_date) & (df_sales_web.date < end_date)] \
-            .groupby('user_id',as_index=False) \
-            .price.sum()
-        
-        merged_web = logs_web \
-            .merge(sales_web, how='left', on='user_id') \
-            .rename(columns={'price':'metric'})
-        
-        revenue_web = merged_web[['user_id','metric']]
-        return revenue_web
+        state = self._aggregate_revenue(begin_date, end_date, user_ids, begin_date, end_date)
+        return self._finalize_revenue(state, fill_zero=False)
         
 
     def _calculate_revenue_all(self, begin_date, end_date, user_ids):
@@ -110,26 +351,66 @@ class MetricsService:
         :return (pd.DataFrame): датафрейм с двумя столбцами ['user_id', 'metric']
         """
         # YOUR_CODE_HERE
-        df_sales_all = self._get_data_subset('sales', begin_date, end_date, user_ids=user_ids, columns=['sale_id','date','price','user_id'])
-        web_logs_all = self._get_data_subset('web-logs', None, end_date, user_ids=user_ids, columns=['date','load_time','user_id'])
-            
-        logs_all = web_logs_all[(web_logs_all.date < end_date)] \
-            .groupby('user_id',as_index=False) \
-            .nunique()
-        
-        sales_all = df_sales_all[(df_sales_all.date >= begin_date) & (df_sales_all.date < end_date)] \
-            .groupby('user_id',as_index=False) \
-            .price.sum()
-        
-        merged_all = logs_all \
-            .merge(sales_all, how='left', on='user_id') \
-            .rename(columns={'price':'metric'}) \
-            .fillna(0)
-        
-        revenue_all = merged_all[['user_id','metric']]
-        print(logs_all.user_id)
-        print(revenue_all.user_id)
-        return revenue_all
+        state = self._aggregate_revenue(begin_date, end_date, user_ids, None, end_date)
+        return self._finalize_revenue(state, fill_zero=True)
+
+    def _aggregate_metric(self, metric_name, begin_date, end_date, user_ids, extend_from=None):
+        """Считает частичные агрегаты метрики за интервал.
+
+        :param extend_from (None, tuple): (begin, end) интервала уже посчитанных агрегатов внутри
+            [begin_date, end_date). Если задан, то возвращаются агрегаты только для дней слева и справа от него,
+            в порядке (левый, правый), отсутствующие части равны None.
+        """
+        if extend_from is None:
+            pieces = [(begin_date, end_date)]
+        else:
+            pieces = [(begin_date, extend_from[0]), (extend_from[1], end_date)]
+
+        states = []
+        for index, (begin, end) in enumerate(pieces):
+            if extend_from is not None and begin == end:
+                states.append(None)
+            elif metric_name == 'response time':
+                states.append(self._aggregate_response_time(begin, end, user_ids))
+            elif metric_name == 'revenue (web)':
+                states.append(self._aggregate_revenue(begin, end, user_ids, begin, end))
+            elif metric_name == 'revenue (all)':
+                # пользователи до начала расширяемого интервала уже учтены в его агрегатах
+                if extend_from is None:
+                    visits_begin_date = None
+                else:
+                    visits_begin_date = end if index == 0 else begin
+                states.append(self._aggregate_revenue(begin, end, user_ids, visits_begin_date, end))
+            else:
+                raise ValueError('Wrong metric name')
+        return states[0] if extend_from is None else states
+
+    def _merge_metric(self, metric_name, states):
+        if metric_name == 'response time':
+            return self._merge_response_time(states)
+        return self._merge_revenue(states)
+
+    def _finalize_metric(self, metric_name, state):
+        if metric_name == 'response time':
+            return state.copy()
+        return self._finalize_revenue(state, fill_zero=metric_name == 'revenue (all)')
+
+    def _calculate_metric_cached(self, metric_name, begin_date, end_date, user_ids):
+        fingerprint = _get_fingerprint(user_ids)
+        key = (metric_name, fingerprint, begin_date, end_date)
+        state = self.cache.get(key)
+        if state is None:
+            cached_key = self.cache.find_extendable(metric_name, fingerprint, begin_date, end_date)
+            if cached_key is None:
+                state = self._aggregate_metric(metric_name, begin_date, end_date, user_ids)
+            else:
+                left, right = self._aggregate_metric(
+                    metric_name, begin_date, end_date, user_ids, extend_from=cached_key[2:]
+                )
+                states = [left, self.cache.get(cached_key), right]
+                state = self._merge_metric(metric_name, [s for s in states if s is not None])
+            self.cache.put(key, state)
+        return self._finalize_metric(metric_name, state)
 
     def calculate_metric(self, metric_name, begin_date, end_date, user_ids=None):
         """Считает значения для вычисления метрик.
@@ -141,6 +422,8 @@ class MetricsService:
             Если None, то вычисляет значения для всех пользователей.
         :return df: columns=['user_id', 'metric']
         """
+        if self.cache.max_bytes > 0 and metric_name in ('response time', 'revenue (web)', 'revenue (all)'):
+            return self._calculate_metric_cached(metric_name, begin_date, end_date, user_ids)
         if metric_name == 'response time':
             return self._calculate_response_time(begin_date, end_date, user_ids)
         elif metric_name == 'revenue (web)':
@@ -151,6 +434,197 @@ class MetricsService:
             raise ValueError('Wrong metric name')
 
 
+    def calculate_metrics(self, metric_names, begin_date, end_date, user_ids=None):
+        """Считает значения нескольких метрик за один проход по каждой таблице.
+
+        'web-logs' читается один раз с началом begin_date (или с самого начала, если нужна 'revenue (all)'),
+        'sales' - один раз за [begin_date, end_date). Результат совпадает с вызовами calculate_metric.
+        Если включены кэш или дневные агрегаты, то метрики считаются через calculate_metric.
+
+        :param metric_names (list[str]): названия метрик.
+        :param begin_date (datetime): дата начала периода (включая границу)
+        :param end_date (datetime): дата окончания периода (не включая границу)
+        :param user_ids (list[str], None): список пользователей.
+            Если None, то вычисляет значения для всех пользователей.
+        :return (dict[str, pd.DataFrame]): название метрики -> df, columns=['user_id', 'metric']
+        """
+        if set(metric_names) - {'response time', 'revenue (web)', 'revenue (all)'}:
+            raise ValueError('Wrong metric name')
+        if self.cache.max_bytes > 0 or self.rollups is not None:
+            return {
+                metric_name: self.calculate_metric(metric_name, begin_date, end_date, user_ids)
+                for metric_name in metric_names
+            }
+
+        web_columns = ['date', 'user_id']
+        if 'response time' in metric_names:
+            web_columns.append('load_time')
+        web_begin_date = None if 'revenue (all)' in metric_names else begin_date
+        web_logs = self._get_data_subset('web-logs', web_begin_date, end_date, user_ids=user_ids, columns=web_columns)
+        web_logs_window = web_logs.loc[(web_logs['date'] >= begin_date) & (web_logs['date'] < end_date)]
+
+        if 'revenue (web)' in metric_names or 'revenue (all)' in metric_names:
+            df_sales = self._get_data_subset('sales', begin_date, end_date, user_ids=user_ids, columns=['date','price','user_id'])
+            sales = df_sales[(df_sales.date >= begin_date) & (df_sales.date < end_date)] \
+                .groupby('user_id',as_index=False) \
+                .price.sum()
+
+        metrics = {}
+        for metric_name in metric_names:
+            if metric_name == 'response time':
+                metrics[metric_name] = web_logs_window \
+                    .rename(columns={'load_time': 'metric'})[['user_id','metric']] \
+                    .copy()
+            elif metric_name == 'revenue (web)':
+                users = pd.Index(web_logs_window['user_id']).dropna().unique().sort_values()
+                metrics[metric_name] = self._finalize_revenue((users, sales), fill_zero=False)
+            else:
+                users = pd.Index(web_logs['user_id']).dropna().unique().sort_values()
+                metrics[metric_name] = self._finalize_revenue((users, sales), fill_zero=True)
+        return metrics
+
+
+class StreamingMetricsService:
+
+    def __init__(self, chunk_source, memory_budget_bytes=2 ** 28):
+        """Класс для вычисления метрик проходом по таблицам частями ограниченного размера.
+
+        По каждой таблице делается один проход для всех запрошенных метрик. Для пользователей
+        копятся поюзерные агрегаты в массивах по кодам пользователей (флаги посещений,
+        суммы и количества покупок), поэтому память, кроме одной части таблицы, пропорциональна
+        числу пользователей. Исключение - 'response time': результат содержит все запросы
+        за период, его размер пропорционален числу событий.
+
+        :param chunk_source (ColumnarDataService, CsvChunkSource): источник с методом iter_chunks.
+        :param memory_budget_bytes (int): примерный объём памяти на одну читаемую часть таблицы.
+        """
+        self.chunk_source = chunk_source
+        self.memory_budget_bytes = memory_budget_bytes
+
+    def _get_chunk_rows(self, columns):
+        # грубая оценка: 8 байт на число или дату, около 64 байт на строковый user_id
+        bytes_per_row = sum(64 if column == 'user_id' else 8 for column in columns)
+        return max(1, self.memory_budget_bytes // bytes_per_row)
+
+    def _get_windows(self, metric_name, begin_date, end_date):
+        """Возвращает периоды (begin, end) посещений и покупок, которые нужны для метрики."""
+        if metric_name == 'response time':
+            return {'rows': (begin_date, end_date)}
+        elif metric_name == 'revenue (web)':
+            return {'visits': (begin_date, end_date), 'sales': (begin_date, end_date)}
+        elif metric_name == 'revenue (all)':
+            return {'visits': (None, end_date), 'sales': (begin_date, end_date)}
+        elif metric_name == 'previous week revenue':
+            begin_cov_date = begin_date.replace(hour=0, minute=0, second=0, microsecond=0) - 7 * DAY
+            return {'visits': (begin_cov_date, begin_date), 'sales': (begin_cov_date, begin_date)}
+        else:
+            raise ValueError('Wrong metric name')
+
+    def _iter_chunks(self, table_name, columns, windows, user_ids, user2code):
+        """Читает части таблицы, покрывающие все windows, и кодирует в них user_id.
+
+        :return (iterator[tuple]): (часть таблицы, коды пользователей, {window: маска строк периода}).
+        """
+        begins = [begin for begin, _ in windows]
+        scan_begin = None if None in begins else min(begins)
+        scan_end = max(end for _, end in windows)
+        chunk_rows = self._get_chunk_rows(columns)
+        for chunk in self.chunk_source.iter_chunks(table_name, columns, chunk_rows, scan_begin, scan_end):
+            if user_ids is not None:
+                chunk = chunk[chunk['user_id'].isin(user_ids)]
+            local_codes, uniques = pd.factorize(chunk['user_id'])
+            mapping = np.array([user2code.setdefault(user_id, len(user2code)) for user_id in uniques] + [-1])
+            codes = mapping[local_codes]
+            dates = chunk['date']
+            masks = {}
+            for begin, end in windows:
+                mask = (dates < end).to_numpy() & (codes >= 0)
+                if begin is not None:
+                    mask &= (dates >= begin).to_numpy()
+                masks[(begin, end)] = mask
+            yield chunk, codes, masks
+
+    def calculate_metrics(self, metric_names, begin_date, end_date, user_ids=None):
+        """Считает значения метрик, аналог MetricsService.calculate_metrics.
+
+        Кроме метрик MetricsService поддерживается 'previous week revenue' - ковариата CUPED:
+        выручка за 7 дней до begin_date для заходивших на сайт в эти дни, columns=['user_id', 'cov'].
+        Значения выручки имеют тип float64, пользователи упорядочены по user_id.
+
+        :param metric_names (list[str]): названия метрик.
+        :param begin_date (datetime): дата начала периода (включая границу)
+        :param end_date (datetime): дата окончания периода (не включая границу)
+        :param user_ids (list[str], None): список пользователей.
+            Если None, то вычисляет значения для всех пользователей.
+        :return (dict[str, pd.DataFrame]): название метрики -> df, columns=['user_id', 'metric']
+        """
+        windows = {metric_name: self._get_windows(metric_name, begin_date, end_date) for metric_name in metric_names}
+        user2code = {}
+        visited = {}
+        rows = {}
+        web_windows = {w[kind] for w in windows.values() for kind in ('visits', 'rows') if kind in w}
+        if web_windows:
+            columns = ['date', 'user_id']
+            if 'response time' in metric_names:
+                columns.append('load_time')
+            for chunk, codes, masks in self._iter_chunks('web-logs', columns, web_windows, user_ids, user2code):
+                for window, mask in masks.items():
+                    visited[window] = grow_array(visited.get(window, np.zeros(0, dtype=bool)), len(user2code))
+                    visited[window][codes[mask]] = True
+                    if window == windows.get('response time', {}).get('rows'):
+                        rows.setdefault(window, []).append(chunk.loc[mask, ['date', 'user_id', 'load_time']])
+
+        sums = {}
+        counts = {}
+        sales_windows = {w['sales'] for w in windows.values() if 'sales' in w}
+        if sales_windows:
+            columns = ['date', 'user_id', 'price']
+            for chunk, codes, masks in self._iter_chunks('sales', columns, sales_windows, user_ids, user2code):
+                price = chunk['price'].to_numpy(dtype=float)
+                for window, mask in masks.items():
+                    sums[window] = grow_array(sums.get(window, np.zeros(0)), len(user2code))
+                    counts[window] = grow_array(counts.get(window, np.zeros(0, dtype=np.int64)), len(user2code))
+                    sums[window][:len(user2code)] += np.bincount(codes[mask], price[mask], len(user2code))
+                    counts[window][:len(user2code)] += np.bincount(codes[mask], minlength=len(user2code))
+
+        users = np.array(list(user2code), dtype=object)
+        metrics = {}
+        for metric_name, metric_windows in windows.items():
+            if metric_name == 'response time':
+                parts = rows.get(metric_windows['rows'])
+                df = pd.concat(parts) if parts else pd.DataFrame(columns=['date', 'user_id', 'load_time'])
+                df = df.iloc[np.lexsort((df.index.to_numpy(), df['date'].to_numpy()))]
+                metrics[metric_name] = df.rename(columns={'load_time': 'metric'})[['user_id', 'metric']]
+                continue
+            visits_window, sales_window = metric_windows['visits'], metric_windows['sales']
+            is_visitor = grow_array(visited.get(visits_window, np.zeros(0, dtype=bool)), len(users))[:len(users)]
+            codes = np.flatnonzero(is_visitor)
+            codes = codes[np.argsort(users[codes], kind='stable')]
+            revenue = grow_array(sums.get(sales_window, np.zeros(0)), len(users))[codes]
+            purchases = grow_array(counts.get(sales_window, np.zeros(0, dtype=np.int64)), len(users))[codes]
+            if metric_name == 'revenue (web)':
+                revenue = np.where(purchases > 0, revenue, np.nan)
+            column = 'cov' if metric_name == 'previous week revenue' else 'metric'
+            metrics[metric_name] = pd.DataFrame({'user_id': users[codes], column: revenue})
+        return metrics
+
+    def calculate_metric(self, metric_name, begin_date, end_date, user_ids=None):
+        """Считает значения метрики, см. calculate_metrics."""
+        return self.calculate_metrics([metric_name], begin_date, end_date, user_ids)[metric_name]
+
+
+def grow_array(array, size):
+    """Возвращает массив длины не меньше size, дополненный нулями; ёмкость растёт вдвое.
+
+    Используется для поюзерных массивов, которые дописываются по мере появления пользователей.
+    """
+    if len(array) >= size:
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
 def _chech_df(df, df_ideal, sort_by, reindex=False, set_dtypes=False):
     assert isinstance(df, pd.DataFrame), 'Функция вернула не pd.DataFrame.'
     assert len(df) == len(df_ideal), 'Неверное количество строк.'
@@ -197,4 +671,43 @@ if __name__ == '__main__':
     _chech_df(df_response_time, ideal_response_time, ['user_id', 'metric'], True, True)
     _chech_df(df_revenue_web, ideal_revenue_web, ['user_id', 'metric'], True, True)
     _chech_df(df_revenue_all, ideal_revenue_all, ['user_id', 'metric'], True, True)
+
+    cached_metrics_service = MetricsService(data_service, cache_max_bytes=2 ** 20)
+    for metric_name in ['response time', 'revenue (web)', 'revenue (all)']:
+        for begin_date_, end_date_ in [
+            (begin_date, begin_date + DAY), (begin_date, end_date), (begin_date - DAY, end_date + DAY)
+        ]:
+            df_cached = cached_metrics_service.calculate_metric(metric_name, begin_date_, end_date_)
+            df_ideal = metrics_service.calculate_metric(metric_name, begin_date_, end_date_)
+            assert df_cached.equals(df_ideal), 'Результат из кэша не совпадает с вычисленным заново'
+
+    metric_names = ['response time', 'revenue (web)', 'revenue (all)']
+    for metric_names_ in [metric_names, metric_names[1:], metric_names[:1]]:
+        metrics = metrics_service.calculate_metrics(metric_names_, begin_date, end_date, ['1', '3'])
+        for metric_name in metric_names_:
+            df_ideal = metrics_service.calculate_metric(metric_name, begin_date, end_date, ['1', '3'])
+            assert metrics[metric_name].equals(df_ideal), 'calculate_metrics не совпадает с calculate_metric'
+
+    with tempfile.TemporaryDirectory() as path:
+        table_name_2_path = {'sales': f'{path}/sales.csv', 'web-logs': f'{path}/web-logs.csv'}
+        df_sales.to_csv(table_name_2_path['sales'], index=False)
+        df_web_logs.to_csv(table_name_2_path['web-logs'], index=False)
+        streaming_metrics_service = StreamingMetricsService(CsvChunkSource(table_name_2_path), memory_budget_bytes=100)
+        for user_ids in [None, ['1', '3']]:
+            metrics = streaming_metrics_service.calculate_metrics(metric_names, begin_date, end_date, user_ids)
+            for metric_name in metric_names:
+                df_ideal = metrics_service.calculate_metric(metric_name, begin_date, end_date, user_ids)
+                df_ideal['metric'] = df_ideal['metric'].astype(float)
+                assert len(df_ideal) > 0
+                _chech_df(metrics[metric_name], df_ideal, ['user_id', 'metric'], True)
+
+    rollups = DailyRollups(data_service)
+    rollups_metrics_service = MetricsService(data_service, rollups=rollups)
+    for metric_name in ['revenue (web)', 'revenue (all)']:
+        for begin_date_, end_date_ in [
+            (begin_date, end_date), (datetime(2022, 3, 11), datetime(2022, 3, 13)), (begin_date, begin_date + DAY / 2)
+        ]:
+            df_rollups = rollups_metrics_service.calculate_metric(metric_name, begin_date_, end_date_)
+            df_ideal = metrics_service.calculate_metric(metric_name, begin_date_, end_date_)
+            assert df_rollups.equals(df_ideal), 'Результат по дневным агрегатам не совпадает с сырыми данными'
     print('simple test passed')
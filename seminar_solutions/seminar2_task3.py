@@ -25,6 +25,92 @@ class ExperimentsService:
         else:
             raise ValueError('Неверный design.statistical_test')
 
+    def get_pvalues_ragged(self, values_a, offsets_a, values_b, offsets_b, equal_var=True):
+        """Применяет t-тест к набору пар групп разной длины, возвращает t-статистики и p-value.
+
+        Группы заданы в CSR-формате: значения i-й группы A - values_a[offsets_a[i]:offsets_a[i + 1]].
+        Значения вне [offsets[0], offsets[-1]) не используются.
+
+        :param values_a, values_b (np.array): значения метрик всех групп A и всех групп B подряд.
+        :param offsets_a, offsets_b (np.array): границы групп, shape=(k + 1,), k - количество пар.
+        :param equal_var (bool): True - t-тест Стьюдента (как stats.ttest_ind), False - t-тест Уэлча.
+        :return tstats, pvalues (np.array, np.array): shape=(k,)
+        """
+        values_a, offsets_a = _slice_csr(values_a, offsets_a)
+        values_b, offsets_b = _slice_csr(values_b, offsets_b)
+        lengths_a, lengths_b = np.diff(offsets_a), np.diff(offsets_b)
+        pair_ids_a = np.repeat(np.arange(len(lengths_a)), lengths_a)
+        pair_ids_b = np.repeat(np.arange(len(lengths_b)), lengths_b)
+        # сдвиг на первое значение пары не меняет статистику, но уменьшает ошибку округления в сумме квадратов
+        shift = np.zeros(len(lengths_a))
+        has_a = lengths_a > 0
+        shift[has_a] = values_a[offsets_a[:-1][has_a]]
+        values_a = values_a - shift[pair_ids_a]
+        values_b = values_b - shift[pair_ids_b]
+        moments_a = _get_moments(values_a, pair_ids_a, len(lengths_a))
+        moments_b = _get_moments(values_b, pair_ids_b, len(lengths_b))
+        return _ttest_from_moments(*moments_a, *moments_b, equal_var)
+
+    def get_pvalues_padded(self, values_a, lengths_a, values_b, lengths_b, equal_var=True):
+        """Применяет t-тест к набору пар групп, записанных в строки дополненных матриц.
+
+        :param values_a, values_b (np.ndarray): shape=(k, max_length), в i-й строке первые lengths[i]
+            значений - метрики группы, остальные игнорируются.
+        :param lengths_a, lengths_b (np.array): размеры групп, shape=(k,).
+        :param equal_var (bool): True - t-тест Стьюдента (как stats.ttest_ind), False - t-тест Уэлча.
+        :return tstats, pvalues (np.array, np.array): shape=(k,)
+        """
+        values_a, values_b = np.asarray(values_a, dtype=float), np.asarray(values_b, dtype=float)
+        mask_a = np.arange(values_a.shape[1]) < np.asarray(lengths_a)[:, None]
+        mask_b = np.arange(values_b.shape[1]) < np.asarray(lengths_b)[:, None]
+        shift = values_a[:, :1]
+        values_a = np.where(mask_a, values_a - shift, 0)
+        values_b = np.where(mask_b, values_b - shift, 0)
+        moments_a = (mask_a.sum(axis=1), values_a.sum(axis=1), (values_a ** 2).sum(axis=1))
+        moments_b = (mask_b.sum(axis=1), values_b.sum(axis=1), (values_b ** 2).sum(axis=1))
+        return _ttest_from_moments(*moments_a, *moments_b, equal_var)
+
+
+def _slice_csr(values, offsets):
+    """Возвращает значения групп values[offsets[0]:offsets[-1]] и границы групп от 0."""
+    values, offsets = np.asarray(values, dtype=float), np.asarray(offsets, dtype=np.int64)
+    if offsets.ndim != 1 or len(offsets) == 0:
+        raise ValueError('offsets должен быть одномерным массивом длины k + 1')
+    if offsets[0] < 0 or offsets[-1] > len(values) or (np.diff(offsets) < 0).any():
+        raise ValueError('offsets должен быть неубывающим и не выходить за границы values')
+    return values[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+
+def _get_moments(values, group_ids, groups_count):
+    """Возвращает количество, сумму и сумму квадратов значений по группам."""
+    counts = np.bincount(group_ids, minlength=groups_count)
+    sums = np.bincount(group_ids, values, minlength=groups_count)
+    sums_sq = np.bincount(group_ids, values ** 2, minlength=groups_count)
+    return counts, sums, sums_sq
+
+
+def _ttest_from_moments(n_a, sum_a, sum_sq_a, n_b, sum_b, sum_sq_b, equal_var=True):
+    """Двухвыборочный t-тест по количеству, сумме и сумме квадратов значений групп.
+
+    :return tstats, pvalues (np.array, np.array): статистика mean_a - mean_b и двустороннее p-value.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_a, n_b = np.asarray(n_a, dtype=float), np.asarray(n_b, dtype=float)
+        mean_a, mean_b = sum_a / n_a, sum_b / n_b
+        var_a = np.maximum(sum_sq_a - sum_a * mean_a, 0) / (n_a - 1)
+        var_b = np.maximum(sum_sq_b - sum_b * mean_b, 0) / (n_b - 1)
+        if equal_var:
+            dof = n_a + n_b - 2
+            pooled_var = ((n_a - 1) * var_a + (n_b - 1) * var_b) / dof
+            se = np.sqrt(pooled_var * (1 / n_a + 1 / n_b))
+        else:
+            se_a, se_b = var_a / n_a, var_b / n_b
+            dof = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+            se = np.sqrt(se_a + se_b)
+        tstats = (mean_a - mean_b) / se
+        pvalues = 2 * stats.t.sf(np.abs(tstats), dof)
+    return tstats, pvalues
+
 
 if __name__ == '__main__':
     metrics_a_group = np.array([964, 1123, 962, 1213, 914, 906, 951, 1033, 987, 1082])
@@ -35,4 +121,34 @@ if __name__ == '__main__':
     experiments_service = ExperimentsService()
     pvalue = experiments_service.get_pvalue(metrics_a_group, metrics_b_group, design)
     np.testing.assert_almost_equal(ideal_pvalue, pvalue, decimal=4)
+
+    np.random.seed(0)
+    lengths_a, lengths_b = np.random.randint(2, 50, 100), np.random.randint(2, 50, 100)
+    offsets_a, offsets_b = np.concatenate([[0], np.cumsum(lengths_a)]), np.concatenate([[0], np.cumsum(lengths_b)])
+    values_a = np.random.normal(1000, 100, offsets_a[-1])
+    values_b = np.random.normal(1010, 150, offsets_b[-1])
+    padded_a, padded_b = np.zeros((100, 50)), np.zeros((100, 50))
+    for i in range(100):
+        padded_a[i, :lengths_a[i]] = values_a[offsets_a[i]:offsets_a[i + 1]]
+        padded_b[i, :lengths_b[i]] = values_b[offsets_b[i]:offsets_b[i + 1]]
+    for equal_var in [True, False]:
+        ideal_pvalues = [
+            stats.ttest_ind(
+                values_a[offsets_a[i]:offsets_a[i + 1]], values_b[offsets_b[i]:offsets_b[i + 1]], equal_var=equal_var
+            ).pvalue
+            for i in range(100)
+        ]
+        _, pvalues = experiments_service.get_pvalues_ragged(values_a, offsets_a, values_b, offsets_b, equal_var)
+        np.testing.assert_allclose(ideal_pvalues, pvalues, rtol=1e-9)
+        _, pvalues = experiments_service.get_pvalues_padded(padded_a, lengths_a, padded_b, lengths_b, equal_var)
+        np.testing.assert_allclose(ideal_pvalues, pvalues, rtol=1e-9)
+    # группы занимают только часть массивов значений
+    _, pvalues = experiments_service.get_pvalues_ragged(
+        np.r_[[1e6] * 3, values_a, [1e6]], offsets_a[10:] + 3, values_b, offsets_b[10:]
+    )
+    ideal_pvalues = [
+        stats.ttest_ind(values_a[offsets_a[i]:offsets_a[i + 1]], values_b[offsets_b[i]:offsets_b[i + 1]]).pvalue
+        for i in range(10, 100)
+    ]
+    np.testing.assert_allclose(ideal_pvalues, pvalues, rtol=1e-9)
     print('simple test passed')
\ No newline at end of file
@@ -1,3 +1,5 @@
+from hashlib import md5
+
 import numpy as np
 import pandas as pd
 from pydantic import BaseModel
@@ -18,8 +20,115 @@ class Design(BaseModel):
     beta: float
 
 
+class MetricMoments(BaseModel):
+    """Статистики метрики, нужные для оценки размера выборки и MDE.
+
+    mean - среднее значение метрики
+    std - стандартное отклонение метрики
+    ratio - среднее количество значений метрики на одного пользователя
+    multiple - есть ли у пользователей несколько значений метрики
+    """
+    mean: float
+    std: float
+    ratio: float
+    multiple: bool
+
+
 class ExperimentsService:
 
+    def __init__(self, moments_cache_size=128):
+        """Класс для планирования экспериментов.
+
+        Статистики метрик кэшируются по отпечатку содержимого таблицы метрик, поэтому повторные
+        расчёты по той же таблице считают только хеши строк, а не группировку по пользователям.
+        Чтобы не проходить по данным совсем, вместо таблицы можно передать статистики
+        из get_metric_moments.
+
+        :param moments_cache_size (int): количество таблиц метрик в кэше.
+        """
+        self.moments_cache_size = moments_cache_size
+        self.moments_cache = {}
+
+    def get_metric_moments(self, metrics):
+        """Возвращает статистики метрики, при повторном вызове для той же таблицы - из кэша.
+
+        :param metrics (pd.DataFrame, MetricMoments): датафрейм со значениями метрик из MetricsService,
+            columns=['user_id', 'metric'], или уже посчитанные статистики, они возвращаются без изменений.
+        :return (MetricMoments): статистики метрики.
+        """
+        if isinstance(metrics, MetricMoments):
+            return metrics
+        key = _get_frame_fingerprint(metrics)
+        moments = self.moments_cache.get(key)
+        if moments is None:
+            user_ids = metrics['user_id']
+            n_users = user_ids.nunique()
+            moments = MetricMoments(
+                mean=metrics['metric'].mean(),
+                std=metrics['metric'].std(ddof=0),
+                # то же, что metrics.groupby('user_id')['metric'].count().mean(), но без группировки
+                ratio=metrics.loc[user_ids.notna(), 'metric'].count() / n_users,
+                multiple=n_users < user_ids.count()
+            )
+            if len(self.moments_cache) >= self.moments_cache_size:
+                self.moments_cache.pop(next(iter(self.moments_cache)))
+            self.moments_cache[key] = moments
+        return moments
+
+    def estimate_sample_sizes(self, metrics, effects, alphas, betas):
+        """Оценивает необходимый размер групп для всех сочетаний эффектов и ошибок I и II рода.
+
+        Результат для каждого сочетания совпадает с estimate_sample_size.
+
+        :param metrics (pd.DataFrame, MetricMoments): датафрейм со значениями метрик из MetricsService,
+            columns=['user_id', 'metric'], или статистики метрики, см. get_metric_moments.
+        :param effects (list[float]): размеры эффекта в процентах.
+        :param alphas (list[float]): уровни значимости.
+        :param betas (list[float]): допустимые вероятности ошибки II рода.
+        :return (pd.DataFrame): размеры групп (количество пользователей),
+            index - эффекты, columns - MultiIndex из пар (alpha, beta).
+        """
+        moments = self.get_metric_moments(metrics)
+        effects = np.asarray(effects, dtype=float)
+        z_scores_sum_squared = _get_z_scores_sum(alphas, betas) ** 2
+        # те же операции, что в estimate_sample_size, чтобы результаты совпадали до бита
+        epsilon = (effects / 100 + 1 - 1) * moments.mean
+        sample_sizes = np.ceil(
+            z_scores_sum_squared[None, :] * (2 * moments.std ** 2) / (epsilon[:, None] ** 2)
+        ).astype(int)
+        if moments.multiple:
+            sample_sizes = (sample_sizes / moments.ratio).astype(int) + 1
+        return pd.DataFrame(
+            sample_sizes,
+            index=pd.Index(effects, name='effect'),
+            columns=pd.MultiIndex.from_product([alphas, betas], names=['alpha', 'beta'])
+        )
+
+    def estimate_mdes(self, metrics, sample_sizes, alphas, betas):
+        """Оценивает минимальный обнаруживаемый эффект для всех сочетаний размеров групп и ошибок.
+
+        :param metrics (pd.DataFrame, MetricMoments): датафрейм со значениями метрик из MetricsService,
+            columns=['user_id', 'metric'], или статистики метрики, см. get_metric_moments.
+        :param sample_sizes (list[int]): размеры групп (количество пользователей).
+        :param alphas (list[float]): уровни значимости.
+        :param betas (list[float]): допустимые вероятности ошибки II рода.
+        :return (pd.DataFrame): MDE в процентах от среднего значения метрики,
+            index - размеры групп, columns - MultiIndex из пар (alpha, beta).
+        """
+        moments = self.get_metric_moments(metrics)
+        sample_sizes = np.asarray(sample_sizes)
+        # для метрик с несколькими значениями на пользователя в группе sample_size * ratio наблюдений
+        n_observations = sample_sizes * moments.ratio if moments.multiple else sample_sizes
+        mdes = (
+            _get_z_scores_sum(alphas, betas)[None, :] * np.sqrt(2 * moments.std ** 2)
+            / np.sqrt(n_observations)[:, None] / moments.mean * 100
+        )
+        return pd.DataFrame(
+            mdes,
+            index=pd.Index(sample_sizes, name='sample_size'),
+            columns=pd.MultiIndex.from_product([alphas, betas], names=['alpha', 'beta'])
+        )
+
     def estimate_sample_size(self, metrics, design):
         """Оцениваем необходимый размер выборки для проверки гипотезы о равенстве средних.
         
@@ -39,8 +148,9 @@ class ExperimentsService:
         alpha = design.alpha
         beta = design.beta
         effect = design.effect
-        mean = np.mean(metrics.metric)
-        std = np.std(metrics.metric)
+        moments = self.get_metric_moments(metrics)
+        mean = moments.mean
+        std = moments.std
         
         def get_sample_size_abs(epsilon, std, alpha, beta):
             t_alpha = stats.norm.ppf(1 - alpha / 2, loc=0, scale=1)
@@ -58,15 +168,26 @@ class ExperimentsService:
 
             return get_sample_size_abs(epsilon, std=std, alpha=alpha, beta=beta)
                 
-        if metrics['user_id'].nunique() < metrics['user_id'].count():
-            ratio = metrics.groupby('user_id')['metric'].count().mean()
-            # ratio = metrics.shape[0] / metrics['user_id'].nunique()
-            sample_size = int(get_sample_size_arb(mean, std, (effect / 100) + 1, alpha, beta) / ratio) + 1
+        if moments.multiple:
+            sample_size = int(get_sample_size_arb(mean, std, (effect / 100) + 1, alpha, beta) / moments.ratio) + 1
         else:
             sample_size = get_sample_size_arb(mean, std, (effect / 100) + 1, alpha, beta)
         
         return sample_size
-            
+
+
+def _get_z_scores_sum(alphas, betas):
+    """Суммы квантилей t_alpha + t_beta для всех пар (alpha, beta), alpha - внешний цикл."""
+    t_alpha = stats.norm.ppf(1 - np.asarray(alphas, dtype=float) / 2, loc=0, scale=1)
+    t_beta = stats.norm.ppf(1 - np.asarray(betas, dtype=float), loc=0, scale=1)
+    return (t_alpha[:, None] + t_beta[None, :]).ravel()
+
+
+def _get_frame_fingerprint(metrics):
+    """Отпечаток содержимого таблицы метрик."""
+    hashes = pd.util.hash_pandas_object(metrics[['user_id', 'metric']], index=False).to_numpy()
+    return md5(hashes.tobytes()).hexdigest()
+
 
 if __name__ == '__main__':
     metrics = pd.DataFrame({
@@ -84,4 +205,34 @@ if __name__ == '__main__':
     experiments_service = ExperimentsService()
     sample_size = experiments_service.estimate_sample_size(metrics, design)
     assert sample_size == ideal_sample_size, 'Неверно'
+
+    rng = np.random.default_rng(0)
+    metrics_multiple = pd.DataFrame({
+        'user_id': rng.integers(0, 300, 2000).astype(str),
+        'metric': rng.exponential(100, 2000)
+    })
+    effects, alphas, betas = [1, 2.5, 5], [0.01, 0.05], [0.1, 0.2, 0.3]
+    for data in [metrics, metrics_multiple]:
+        sample_sizes = experiments_service.estimate_sample_sizes(data, effects, alphas, betas)
+        for effect in effects:
+            for alpha in alphas:
+                for beta in betas:
+                    design = Design(statistical_test='ttest', alpha=alpha, beta=beta, effect=effect)
+                    assert sample_sizes.loc[effect, (alpha, beta)] == \
+                        experiments_service.estimate_sample_size(data, design), 'Неверный размер групп'
+        mdes = experiments_service.estimate_mdes(data, [sample_sizes.loc[5., (0.05, 0.2)]], alphas, betas)
+        assert np.isclose(mdes.loc[:, (0.05, 0.2)], 5., rtol=0.01).all(), 'Неверный MDE'
+    assert len(experiments_service.moments_cache) == 2, 'Статистики метрик должны считаться один раз'
+
+    # изменение таблицы на месте меняет отпечаток, статистики пересчитываются
+    design = Design(statistical_test='ttest', alpha=0.05, beta=0.1, effect=3.)
+    sample_size = experiments_service.estimate_sample_size(metrics_multiple, design)
+    metrics_multiple.loc[1:59, 'metric'] *= 10
+    ideal_sample_size = ExperimentsService().estimate_sample_size(metrics_multiple, design)
+    assert ideal_sample_size != sample_size, 'Изменение таблицы должно менять размер групп'
+    assert experiments_service.estimate_sample_size(metrics_multiple, design) == ideal_sample_size, \
+        'Кэш вернул статистики изменённой таблицы'
+    moments = experiments_service.get_metric_moments(metrics_multiple)
+    assert experiments_service.estimate_sample_size(moments, design) == ideal_sample_size
+    assert experiments_service.estimate_sample_sizes(moments, [3.], [0.05], [0.1]).iloc[0, 0] == ideal_sample_size
     print('simple test passed')
\ No newline at end of file
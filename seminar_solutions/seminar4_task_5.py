@@ -10,6 +10,8 @@
 # Это позволит нам детерминировано протестировать правильность решения. 
 # Внутри _estimate_errors использовать генерацию случайных чисел не нужно.
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 from pydantic import BaseModel
@@ -32,6 +34,34 @@ class Design(BaseModel):
     sample_size: int
 
 
+class UserIndex:
+
+    def __init__(self, metrics):
+        """Индекс значений метрики по пользователям в CSR-формате.
+
+        Значения метрики упорядочены по коду пользователя, значения пользователя с кодом i -
+        values[offsets[i]:offsets[i + 1]]. Пропуск в user_id считается отдельным пользователем,
+        как в unique() и isin() исходного генератора групп.
+
+        :param metrics (pd.DataFame): таблица с метриками, columns=['user_id', 'metric'].
+        """
+        codes, user_ids = pd.factorize(metrics['user_id'], use_na_sentinel=False)
+        self.user_ids = user_ids
+        self.users_count = len(user_ids)
+        self.values = metrics['metric'].to_numpy()[np.argsort(codes, kind='stable')]
+        counts = np.bincount(codes, minlength=self.users_count)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.is_one_value_per_user = len(self.values) == self.users_count
+
+    def get_values(self, users):
+        """Возвращает значения метрики пользователей с кодами users."""
+        if self.is_one_value_per_user:
+            return self.values[users]
+        lengths = self.offsets[users + 1] - self.offsets[users]
+        shifts = np.repeat(self.offsets[users] - np.cumsum(lengths) + lengths, lengths)
+        return self.values[shifts + np.arange(lengths.sum())]
+
+
 class ExperimentsService:
 
     def get_pvalue(self, metrics_a_group, metrics_b_group, design):
@@ -48,20 +78,29 @@ class ExperimentsService:
         else:
             raise ValueError('Неверный design.statistical_test')
 
-    def _create_group_generator(self, metrics, sample_size, n_iter):
+    def _create_group_generator(self, metrics, sample_size, n_iter, rng=None):
         """Генератор случайных групп.
 
+        Индекс пользователь -> строки строится один раз, после чего каждая итерация
+        выбирает 2 * sample_size пользователей без возвращения и собирает значения их метрик
+        за O(sample_size + количество их строк), не просматривая всю таблицу.
+
         :param metrics (pd.DataFame): таблица с метриками, columns=['user_id', 'metric'].
         :param sample_size (int): размер групп (количество пользователей в группе).
         :param n_iter (int): количество итераций генерирования случайных групп.
+        :param rng (None, np.random.Generator): генератор случайных чисел.
+            Если None, то создаётся из глобального состояния np.random.
         :return (np.array, np.array): два массива со значениями метрик в группах.
         """
-        user_ids = metrics['user_id'].unique()
+        if rng is None:
+            rng = np.random.default_rng(np.random.randint(2 ** 32))
+        return self._iter_groups(UserIndex(metrics), sample_size, n_iter, rng)
+
+    def _iter_groups(self, user_index, sample_size, n_iter, rng):
+        """Генератор случайных групп по готовому индексу UserIndex, см. _create_group_generator."""
         for _ in range(n_iter):
-            a_user_ids, b_user_ids = np.random.choice(user_ids, (2, sample_size), False)
-            a_metric_values = metrics.loc[metrics['user_id'].isin(a_user_ids), 'metric'].values
-            b_metric_values = metrics.loc[metrics['user_id'].isin(b_user_ids), 'metric'].values
-            yield a_metric_values, b_metric_values
+            users = rng.choice(user_index.users_count, 2 * sample_size, replace=False)
+            yield user_index.get_values(users[:sample_size]), user_index.get_values(users[sample_size:])
 
     def _estimate_errors(self, group_generator, design, effect_add_type):
         """Оцениваем вероятности ошибок I и II рода.
@@ -85,19 +124,19 @@ class ExperimentsService:
         for i in group_generator:
             sample_a, sample_b = i[0], i[1]
             mean = sample_b.mean()
-            p_value = stats.ttest_ind(sample_a, sample_b).pvalue
+            p_value = self.get_pvalue(sample_a, sample_b, design)
             pvalues_aa.append(p_value)
 
             if effect_add_type == 'all_const':
                 sample_b_const = sample_b + (mean * effect / 100)
                 # sample_b += (mean * effect / 100)
-                p_value = stats.ttest_ind(sample_a, sample_b_const).pvalue
+                p_value = self.get_pvalue(sample_a, sample_b_const, design)
                 pvalues_ab.append(p_value)
 
             elif effect_add_type == 'all_percent':
                 sample_b_percent = sample_b * (1 + effect / 100)
                 # sample_b *= (1 + effect / 100)
-                p_value = stats.ttest_ind(sample_a, sample_b_percent).pvalue
+                p_value = self.get_pvalue(sample_a, sample_b_percent, design)
                 pvalues_ab.append(p_value)
 
             # print(pvalues_aa, pvalues_ab)
@@ -110,21 +149,67 @@ class ExperimentsService:
             
         return pvalues_aa, pvalues_ab, first_type_error, second_type_error
 
-    def estimate_errors(self, metrics, design, effect_add_type, n_iter):
+    def estimate_errors(self, metrics, design, effect_add_type, n_iter, seed=None, n_jobs=1, chunk_size=1000):
         """Оцениваем вероятности ошибок I и II рода.
 
+        Итерации разбиваются на части по chunk_size, каждая часть использует свой независимый
+        поток случайных чисел, порождённый из SeedSequence(seed). Результаты частей объединяются
+        в порядке частей, поэтому при заданном seed результат не зависит от n_jobs.
+
         :param metrics (pd.DataFame): таблица с метриками, columns=['user_id', 'metric'].
         :param design (Design): объект с данными, описывающий параметры эксперимента.
         :param effect_add_type (str): способ добавления эффекта для группы B.
             - 'all_const' - увеличить всем значениям в группе B на константу (b_metric_values.mean() * effect / 100).
             - 'all_percent' - увеличить всем значениям в группе B в (1 + effect / 100) раз.
         :param n_iter (int): количество итераций генерирования случайных групп.
+        :param seed (None, int): seed для SeedSequence. Если None, то берётся из глобального состояния np.random.
+        :param n_jobs (int): количество процессов. Индекс метрик передаётся каждому процессу один раз
+            и используется только для чтения. Части считаются копиями self, поэтому переопределённые
+            в наследниках методы используются и при n_jobs > 1.
+        :param chunk_size (int): количество итераций в одной части.
         :return pvalues_aa (list[float]), pvalues_ab (list[float]), first_type_error (float), second_type_error (float):
             - pvalues_aa, pvalues_ab - списки со значениями pvalue
             - first_type_error, second_type_error - оценки вероятностей ошибок I и II рода.
         """
-        group_generator = self._create_group_generator(metrics, design.sample_size, n_iter)
-        return self._estimate_errors(group_generator, design, effect_add_type)
+        if seed is None:
+            seed = np.random.randint(2 ** 32)
+        chunk_sizes = [min(chunk_size, n_iter - start) for start in range(0, n_iter, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+        tasks = [(self, seed_, size, design, effect_add_type) for seed_, size in zip(seeds, chunk_sizes)]
+        user_index = UserIndex(metrics)
+        if n_jobs > 1:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(user_index,)) as executor:
+                results = list(executor.map(_estimate_errors_worker_chunk, tasks))
+        else:
+            results = [_estimate_errors_chunk(task, user_index) for task in tasks]
+
+        pvalues_aa = [pvalue for result in results for pvalue in result[0]]
+        pvalues_ab = [pvalue for result in results for pvalue in result[1]]
+        first_type_error = np.mean(np.array(pvalues_aa) < design.alpha)
+        second_type_error = np.mean(np.array(pvalues_ab) > design.alpha)
+        return pvalues_aa, pvalues_ab, first_type_error, second_type_error
+
+
+_worker_user_index = None
+
+
+def _init_worker(user_index):
+    global _worker_user_index
+    _worker_user_index = user_index
+
+
+def _estimate_errors_worker_chunk(task):
+    """Считает часть итераций в процессе пула с индексом метрик, заданным в _init_worker."""
+    return _estimate_errors_chunk(task, _worker_user_index)
+
+
+def _estimate_errors_chunk(task, user_index):
+    """Считает pvalue для одной части итераций estimate_errors."""
+    experiments_service, seed, n_iter, design, effect_add_type = task
+    group_generator = experiments_service._iter_groups(
+        user_index, design.sample_size, n_iter, np.random.default_rng(seed)
+    )
+    return experiments_service._estimate_errors(group_generator, design, effect_add_type)
 
 
 if __name__ == '__main__':
@@ -147,4 +232,45 @@ if __name__ == '__main__':
     np.testing.assert_almost_equal(ideal_pvalues_ab, pvalues_ab, decimal=4)
     assert ideal_first_type_error == first_type_error
     assert ideal_second_type_error == second_type_error
+
+    metrics = pd.DataFrame({'user_id': ['1', '2', '1', '3', '4', '2'], 'metric': [1., 2, 3, 4, 5, 6]})
+    user2values = {'1': [1., 3], '2': [2., 6], '3': [4.], '4': [5.]}
+    for a_values, b_values in experiments_service._create_group_generator(metrics, 2, 10):
+        assert len(a_values) + len(b_values) == 6, 'Неверное количество значений в группах'
+        values = np.sort(np.concatenate([a_values, b_values]))
+        assert np.array_equal(values, np.arange(1., 7)), 'Пользователи групп пересекаются'
+    user_index = UserIndex(metrics)
+    for code, user_id in enumerate(user_index.user_ids):
+        values = user_index.get_values(np.array([code]))
+        assert list(values) == user2values[user_id], 'Неверные значения пользователя в индексе'
+    metrics.loc[[1, 5], 'user_id'] = np.nan
+    user_index = UserIndex(metrics)
+    assert user_index.users_count == 4, 'Пропуск в user_id должен быть отдельным пользователем'
+    na_code = np.flatnonzero(pd.isna(user_index.user_ids))
+    assert list(user_index.get_values(na_code)) == [2., 6.], 'Неверные значения пользователя без id'
+    for a_values, b_values in experiments_service._create_group_generator(metrics, 2, 10):
+        assert np.array_equal(np.sort(np.concatenate([a_values, b_values])), np.arange(1., 7))
+
+    np.random.seed(0)
+    metrics = pd.DataFrame({'user_id': np.arange(1000), 'metric': np.random.normal(100, 10, 1000)})
+    design = Design(effect=5., sample_size=50)
+    results = [
+        experiments_service.estimate_errors(metrics, design, 'all_percent', 250, seed=42, n_jobs=n_jobs, chunk_size=40)
+        for n_jobs in [1, 3]
+    ]
+    assert results[0] == results[1], 'Результат зависит от количества процессов'
+    assert _worker_user_index is None, 'Последовательный расчёт не должен менять состояние модуля'
+    assert len(results[0][0]) == 250, 'Неверное количество итераций'
+
+    class RoundedExperimentsService(ExperimentsService):
+        def get_pvalue(self, metrics_a_group, metrics_b_group, design):
+            return round(super().get_pvalue(metrics_a_group, metrics_b_group, design), 1)
+
+    rounded_results = [
+        RoundedExperimentsService().estimate_errors(metrics, design, 'all_percent', 250, seed=42, n_jobs=n_jobs,
+                                                    chunk_size=40)
+        for n_jobs in [1, 3]
+    ]
+    assert rounded_results[0] == rounded_results[1], 'Параллельный расчёт не учитывает переопределённый get_pvalue'
+    assert rounded_results[0][0] == [round(pvalue, 1) for pvalue in results[0][0]]
     print('simple test passed')
\ No newline at end of file
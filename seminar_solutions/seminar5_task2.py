@@ -1,3 +1,6 @@
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 from pydantic import BaseModel
@@ -14,6 +17,17 @@ class Design(BaseModel):
     bootstrap_iter - количество итераций бутстрепа
     bootstrap_ci_type - способ построения доверительного интервала. ['normal', 'percentile', 'pivotal']
     bootstrap_agg_func - метрика эксперимента. ['mean', 'quantile 95']
+        Для квантилей можно указать любой уровень в процентах или несколько уровней через пробел,
+        например 'quantile 50 99.5', тогда bootstrap_metrics имеет shape=(bootstrap_iter, количество уровней).
+    bootstrap_method - способ генерации бутстрепных выборок. ['resample', 'poisson', 'multinomial']
+        'resample' - выборка индексов с возвращением,
+        'poisson' - веса наблюдений из Poisson(1), только для 'mean',
+        'multinomial' - количества повторов наблюдений из мультиномиального распределения.
+        Для квантилей группы сортируются один раз, выборки задаются количествами повторов каждого значения,
+        а квантили ищутся по накопленным количествам без построения самих выборок.
+    bootstrap_memory_limit - примерный объём памяти в байтах на одну часть итераций бутстрепа
+    bootstrap_n_jobs - количество процессов для вычисления частей итераций
+    bootstrap_seed - seed генератора случайных чисел, если None - берётся из глобального состояния np.random
     """
     statistical_test: str
     effect: float
@@ -22,12 +36,21 @@ class Design(BaseModel):
     bootstrap_iter: int = 1000
     bootstrap_ci_type: str
     bootstrap_agg_func: str
+    bootstrap_method: str = 'resample'
+    bootstrap_memory_limit: int = 2 ** 28
+    bootstrap_n_jobs: int = 1
+    bootstrap_seed: Optional[int] = None
 
 
 class ExperimentsService:
 
     def _generate_bootstrap_metrics(self, data_one, data_two, design):
         """Генерирует значения метрики, полученные с помощью бутстрепа.
+
+        Итерации считаются частями: размер части выбирается так, чтобы матрицы одной части
+        занимали не больше design.bootstrap_memory_limit байт. Каждая часть использует свой
+        поток случайных чисел из SeedSequence(design.bootstrap_seed), поэтому результат
+        не зависит от design.bootstrap_n_jobs.
         
         :param data_one, data_two (np.array): значения метрик в группах.
         :param design (Design): объект с данными, описывающий параметры эксперимента
@@ -35,30 +58,50 @@ class ExperimentsService:
             bootstrap_metrics (np.array) - значения статистики теста псчитанное по бутстрепным подвыборкам
             pe_metric (float) - значение статистики теста посчитанное по исходным данным
         """
-        bootstrap_data_one = np.random.choice(data_one, (len(data_one), design.bootstrap_iter))
-        bootstrap_data_two = np.random.choice(data_two, (len(data_two), design.bootstrap_iter))
+        quantiles = _parse_quantiles(design.bootstrap_agg_func)
         if design.bootstrap_agg_func == 'mean':
-            bootstrap_metrics = bootstrap_data_two.mean(axis=0) - bootstrap_data_one.mean(axis=0)
             pe_metric = data_two.mean() - data_one.mean()
-            return bootstrap_metrics, pe_metric
-        elif design.bootstrap_agg_func == 'quantile 95':
-            bootstrap_metrics = (
-                np.quantile(bootstrap_data_two, 0.95, axis=0)
-                - np.quantile(bootstrap_data_one, 0.95, axis=0)
-            )
-            pe_metric = np.quantile(data_two, 0.95) - np.quantile(data_one, 0.95)
-            return bootstrap_metrics, pe_metric
         else:
-            raise ValueError('Неверное значение design.bootstrap_agg_func')
+            pe_metric = np.quantile(data_two, quantiles) - np.quantile(data_one, quantiles)
+            if len(quantiles) == 1:
+                pe_metric = pe_metric[0]
+        if design.bootstrap_method not in ['resample', 'poisson', 'multinomial']:
+            raise ValueError('Неверное значение design.bootstrap_method')
+        if design.bootstrap_method == 'poisson' and design.bootstrap_agg_func != 'mean':
+            raise ValueError('Способ design.bootstrap_method доступен только для bootstrap_agg_func="mean"')
+        if quantiles is not None:
+            # ядро для квантилей работает с отсортированными значениями
+            data_one, data_two = np.sort(data_one), np.sort(data_two)
+
+        # на одну итерацию: индексы (или веса) и значения бутстрепной выборки для обеих групп
+        bytes_per_iter = 16 * (len(data_one) + len(data_two))
+        chunk_size = max(1, design.bootstrap_memory_limit // bytes_per_iter)
+        chunk_sizes = [
+            min(chunk_size, design.bootstrap_iter - start) for start in range(0, design.bootstrap_iter, chunk_size)
+        ]
+        seed = np.random.randint(2 ** 32) if design.bootstrap_seed is None else design.bootstrap_seed
+        seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+        tasks = [(seed_, size, quantiles, design.bootstrap_method) for seed_, size in zip(seeds, chunk_sizes)]
+        if design.bootstrap_n_jobs > 1:
+            with ProcessPoolExecutor(
+                design.bootstrap_n_jobs, initializer=_init_worker, initargs=(data_one, data_two)
+            ) as executor:
+                results = list(executor.map(_bootstrap_worker_chunk, tasks))
+        else:
+            results = [_bootstrap_chunk(task, data_one, data_two) for task in tasks]
+        return np.concatenate(results), pe_metric
 
     def _run_bootstrap(self, bootstrap_metrics, pe_metric, design):
         """Строит доверительный интервал и проверяет значимость отличий с помощью бутстрепа.
         
-        :param bootstrap_metrics (np.array): статистика теста, посчитанная на бутстрепных выборках.
-        :param pe_metric (float): значение статистики теста посчитанное по исходным данным.
+        Для нескольких уровней квантилей интервал и pvalue считаются для каждого уровня отдельно.
+
+        :param bootstrap_metrics (np.array): статистика теста, посчитанная на бутстрепных выборках,
+            shape=(bootstrap_iter,) или shape=(bootstrap_iter, количество уровней).
+        :param pe_metric (float, np.array): значение статистики теста посчитанное по исходным данным.
         :return ci, pvalue:
-            ci [float, float] - границы доверительного интервала
-            pvalue (float) - 0 если есть статистически значимые отличия, иначе 1.
+            ci [float, float] - границы доверительного интервала, для нескольких уровней - массивы границ
+            pvalue (float, np.array) - 0 если есть статистически значимые отличия, иначе 1.
                 Настоящее pvalue для произвольного способа построения доверительного интервала с помощью
                 бутстрепа вычислить не тривиально. Поэтому мы будем использовать краевые значения 0 и 1.
         """
@@ -73,7 +116,7 @@ class ExperimentsService:
             return: (left, right) - границы доверительного интервала.
             """
             c = stats.norm.ppf(1 - alpha / 2)
-            se = np.std(boot_metrics)
+            se = np.std(boot_metrics, axis=0)
             left, right = pe_metric - c * se, pe_metric + c * se
             return left, right
 
@@ -87,7 +130,7 @@ class ExperimentsService:
 
             return: (left, right) - границы доверительного интервала.
             """
-            left, right = np.quantile(boot_metrics, [alpha / 2, 1 - alpha / 2])
+            left, right = np.quantile(boot_metrics, [alpha / 2, 1 - alpha / 2], axis=0)
             return left, right
 
 
@@ -100,7 +143,7 @@ class ExperimentsService:
 
             return: (left, right) - границы доверительного интервала.
             """
-            right, left = 2 * pe_metric - np.quantile(boot_metrics, [alpha / 2, 1 - alpha / 2])
+            right, left = 2 * pe_metric - np.quantile(boot_metrics, [alpha / 2, 1 - alpha / 2], axis=0)
             return left, right
         
         if design.bootstrap_ci_type == 'normal':
@@ -112,11 +155,9 @@ class ExperimentsService:
         elif design.bootstrap_ci_type == 'pivotal':
             ci = get_ci_bootstrap_pivotal(bootstrap_metrics, pe_metric, design.alpha)
         
-        if ci[0] <= 0 <= ci[1]:
-            pvalue = 1.0
-            
-        else:
-            pvalue = 0.0
+        pvalue = np.where((ci[0] <= 0) & (0 <= ci[1]), 1.0, 0.0)
+        if pvalue.ndim == 0:
+            pvalue = float(pvalue)
 
         return ci, pvalue
 
@@ -126,7 +167,7 @@ class ExperimentsService:
         :param metrics_a_group (np.array): массив значений метрик группы A
         :param metrics_a_group (np.array): массив значений метрик группы B
         :param design (Design): объект с данными, описывающий параметры эксперимента
-        :return (float): значение p-value
+        :return (float, np.array): значение p-value, для нескольких уровней квантилей - по каждому уровню
         """
         if design.statistical_test == 'ttest':
             _, pvalue = stats.ttest_ind(metrics_a_group, metrics_b_group)
@@ -134,10 +175,101 @@ class ExperimentsService:
         elif design.statistical_test == 'bootstrap':
             bootstrap_metrics, pe_metric = self._generate_bootstrap_metrics(metrics_a_group, metrics_b_group, design)
             _, pvalue = self._run_bootstrap(bootstrap_metrics, pe_metric, design)
+            return pvalue
         else:
             raise ValueError('Неверный design.statistical_test')
 
 
+_worker_data = None
+
+
+def _init_worker(data_one, data_two):
+    global _worker_data
+    _worker_data = (data_one, data_two)
+
+
+def _parse_quantiles(agg_func):
+    """Возвращает уровни квантилей из bootstrap_agg_func, None для 'mean'."""
+    if agg_func == 'mean':
+        return None
+    name, *levels = agg_func.split()
+    if name != 'quantile' or not levels:
+        raise ValueError('Неверное значение design.bootstrap_agg_func')
+    return [float(level) / 100 for level in levels]
+
+
+def _bootstrap_worker_chunk(task):
+    """Считает часть итераций в процессе пула с данными групп, заданными в _init_worker."""
+    return _bootstrap_chunk(task, *_worker_data)
+
+
+def _bootstrap_chunk(task, data_one, data_two):
+    """Считает разности статистик групп для одной части итераций бутстрепа."""
+    seed, size, quantiles, method = task
+    rng = np.random.default_rng(seed)
+    metrics_one = _bootstrap_statistic(data_one, size, quantiles, method, rng)
+    metrics_two = _bootstrap_statistic(data_two, size, quantiles, method, rng)
+    return metrics_two - metrics_one
+
+
+def _bootstrap_statistic(data, size, quantiles, method, rng):
+    """Возвращает значения статистики на size бутстрепных выборках из data.
+
+    :param data (np.array): значения группы, для квантилей отсортированные.
+    :param quantiles (None, list[float]): уровни квантилей, None - среднее.
+    :return (np.array): shape=(size,) для среднего и одного квантиля, иначе shape=(size, len(quantiles)).
+    """
+    n = len(data)
+    if method == 'resample':
+        indexes = rng.integers(0, n, (n, size))
+        if quantiles is None:
+            return data[indexes].mean(axis=0)
+        offsets = np.arange(size) * n
+        counts = np.bincount((indexes + offsets).ravel(), minlength=size * n).reshape(size, n)
+    elif method == 'poisson':
+        weights = rng.poisson(1., (size, n)).astype(float)
+        return weights @ data / weights.sum(axis=1)
+    else:
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=size)
+        if quantiles is None:
+            return counts @ data / n
+    metrics = _quantiles_from_counts(data, counts, quantiles)
+    return metrics[:, 0] if len(quantiles) == 1 else metrics
+
+
+def _quantiles_from_counts(sorted_data, counts, quantiles):
+    """Квантили выборок, заданных количествами повторов отсортированных значений.
+
+    Выборка i содержит counts[i, j] копий sorted_data[j]. Значение с рангом r в отсортированной
+    выборке - sorted_data[j], где j - первая позиция с накопленным количеством больше r.
+    Интерполяция совпадает с np.quantile(..., method='linear').
+
+    :param sorted_data (np.array): отсортированные значения, shape=(n,).
+    :param counts (np.ndarray): количества повторов, shape=(size, n), сумма по строке равна n.
+    :param quantiles (list[float]): уровни квантилей.
+    :return (np.ndarray): shape=(size, len(quantiles)).
+    """
+    size, n = counts.shape
+    quantiles = np.asarray(quantiles, dtype=float)
+    # сдвигаем строки, чтобы искать по всем накопленным количествам одним searchsorted
+    rows = np.arange(size)[:, None]
+    row_shifts = rows * (n + 1)
+    cumcounts = (np.cumsum(counts, axis=1) + row_shifts).ravel()
+
+    virtual_indexes = (n - 1) * quantiles
+    lower_ranks = np.floor(virtual_indexes).astype(int)
+    upper_ranks = np.minimum(lower_ranks + 1, n - 1)
+    gamma = virtual_indexes - lower_ranks
+
+    def get_values(ranks):
+        positions = np.searchsorted(cumcounts, (ranks[None, :] + row_shifts).ravel(), side='right')
+        return sorted_data[positions.reshape(size, -1) - rows * n]
+
+    lower, upper = get_values(lower_ranks), get_values(upper_ranks)
+    diff = upper - lower
+    return np.where(gamma >= 0.5, upper - diff * (1 - gamma), lower + diff * gamma)
+
+
 if __name__ == '__main__':
     bootstrap_metrics = np.arange(-490, 510)
     pe_metric = 5.
@@ -154,4 +286,50 @@ if __name__ == '__main__':
     ci, pvalue = experiments_service._run_bootstrap(bootstrap_metrics, pe_metric, design)
     np.testing.assert_almost_equal(ideal_ci, ci, decimal=4, err_msg='Неверный доверительный интервал')
     assert ideal_pvalue == pvalue, 'Неверный pvalue'
+
+    np.random.seed(0)
+    data_one, data_two = np.random.normal(100, 10, 2000), np.random.normal(101, 10, 2000)
+    ideal_se = (data_one.var() / len(data_one) + data_two.var() / len(data_two)) ** 0.5
+    for method in ['resample', 'poisson', 'multinomial']:
+        results = []
+        for n_jobs in [1, 2]:
+            design = Design(
+                statistical_test='bootstrap', effect=5, bootstrap_ci_type='normal', bootstrap_agg_func='mean',
+                bootstrap_method=method, bootstrap_memory_limit=10 ** 7, bootstrap_n_jobs=n_jobs, bootstrap_seed=1
+            )
+            results.append(experiments_service._generate_bootstrap_metrics(data_one, data_two, design))
+        assert np.array_equal(results[0][0], results[1][0]), 'Результат бутстрепа зависит от количества процессов'
+        assert _worker_data is None, 'Последовательный бутстреп не должен менять состояние модуля'
+        bootstrap_metrics, pe_metric = results[0]
+        assert len(bootstrap_metrics) == design.bootstrap_iter, 'Неверное количество итераций бутстрепа'
+        np.testing.assert_allclose(np.std(bootstrap_metrics), ideal_se, rtol=0.1)
+        experiments_service._run_bootstrap(bootstrap_metrics, pe_metric, design)
+
+    sorted_data = np.sort(data_one[:500])
+    counts = np.random.default_rng(0).multinomial(500, np.full(500, 1 / 500), size=20)
+    quantiles = [0., 0.123, 0.5, 0.95, 1.]
+    ideal_metrics = np.array([np.quantile(np.repeat(sorted_data, row), quantiles) for row in counts])
+    np.testing.assert_array_equal(_quantiles_from_counts(sorted_data, counts, quantiles), ideal_metrics)
+    design = Design(
+        statistical_test='bootstrap', effect=5, bootstrap_ci_type='percentile', bootstrap_agg_func='quantile 50 95',
+        bootstrap_method='multinomial', bootstrap_seed=1
+    )
+    bootstrap_metrics, pe_metric = experiments_service._generate_bootstrap_metrics(data_one, data_two, design)
+    assert bootstrap_metrics.shape == (design.bootstrap_iter, 2) and pe_metric.shape == (2,)
+    for ci_type in ['normal', 'percentile', 'pivotal']:
+        design.bootstrap_ci_type = ci_type
+        ci, pvalues = experiments_service._run_bootstrap(bootstrap_metrics, pe_metric, design)
+        assert pvalues.shape == (2,), 'Для каждого уровня квантиля должен быть свой pvalue'
+        for level in range(2):
+            ideal_ci, ideal_pvalue = experiments_service._run_bootstrap(
+                bootstrap_metrics[:, level], pe_metric[level], design
+            )
+            np.testing.assert_allclose([ci[0][level], ci[1][level]], ideal_ci, err_msg='Неверный интервал уровня')
+            assert pvalues[level] == ideal_pvalue, 'Неверный pvalue уровня'
+    pvalues = experiments_service.get_pvalue(data_one, data_two, design)
+    assert pvalues.shape == (2,) and np.isin(pvalues, [0., 1.]).all()
+    sorted_data = np.sort(data_one)
+    bootstrap_quantiles = _bootstrap_statistic(sorted_data, 10, [0.95], 'resample', np.random.default_rng(2))
+    indexes = np.random.default_rng(2).integers(0, len(sorted_data), (len(sorted_data), 10))
+    np.testing.assert_array_equal(bootstrap_quantiles, np.quantile(sorted_data[indexes], 0.95, axis=0))
     print('simple test passed')
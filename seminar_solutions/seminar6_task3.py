@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel
 
@@ -17,6 +18,10 @@ class Design(BaseModel):
     metric_outlier_upper_bound - верхняя допустимая граница метрики, всё что выше считаем выбросами
     metric_outlier_process_type - способ обработки выбросов. ['drop', 'clip'].
         'drop' - удаляем измерение, 'clip' - заменяем выброс на значение ближайшей границы (lower_bound, upper_bound).
+    metric_outlier_bound_type - способ задания границ. ['fixed', 'quantile'].
+        'fixed' - границы равны metric_outlier_lower_bound и metric_outlier_upper_bound,
+        'quantile' - metric_outlier_lower_bound и metric_outlier_upper_bound - уровни квантилей от 0 до 1,
+            границы - квантили значений каждой метрики.
     """
     statistical_test: str = 'ttest'
     effect: float = 3.
@@ -29,6 +34,7 @@ class Design(BaseModel):
     metric_outlier_lower_bound: float
     metric_outlier_upper_bound: float
     metric_outlier_process_type: str
+    metric_outlier_bound_type: str = 'fixed'
 
 
 class MetricsService:
@@ -41,15 +47,50 @@ class MetricsService:
         :return df: columns=['user_id', 'metric']
         """
         # YOUR_CODE_HERE
+        values = metrics[['metric']].to_numpy(dtype=float)
         if design.metric_outlier_process_type == 'drop':
-            df = metrics.loc[(metrics['metric'] >= design.metric_outlier_lower_bound) & (metrics['metric'] <= design.metric_outlier_upper_bound)]
-        
-        elif design.metric_outlier_process_type == 'clip':
-            metrics.loc[metrics['metric'] > design.metric_outlier_upper_bound, 'metric'] = design.metric_outlier_upper_bound
-            metrics.loc[metrics['metric'] < design.metric_outlier_lower_bound, 'metric'] = design.metric_outlier_lower_bound
-            df = metrics
-        # print(df)
-        return df
+            dropped = self.process_outliers_batch(values, design, lazy=True)
+            return metrics.loc[~dropped.mask[:, 0]]
+        return metrics.assign(metric=self.process_outliers_batch(values, design)[:, 0])
+
+    def get_outlier_bounds(self, values, design):
+        """Возвращает границы выбросов для каждой метрики.
+
+        :param values (np.ndarray): значения метрик, shape=(n, m), столбец - метрика.
+        :param design (Design): объект с данными, описывающий параметры эксперимента.
+        :return lower_bounds, upper_bounds (np.ndarray): границы метрик, shape=(m,).
+        """
+        lower_bound, upper_bound = design.metric_outlier_lower_bound, design.metric_outlier_upper_bound
+        if design.metric_outlier_bound_type == 'fixed':
+            return np.full(values.shape[1], float(lower_bound)), np.full(values.shape[1], float(upper_bound))
+        elif design.metric_outlier_bound_type == 'quantile':
+            lower_bounds, upper_bounds = np.nanquantile(values, [lower_bound, upper_bound], axis=0)
+            return lower_bounds, upper_bounds
+        raise ValueError('Неверный design.metric_outlier_bound_type')
+
+    def process_outliers_batch(self, values, design, lazy=False):
+        """Обрабатывает выбросы сразу во всех метриках, не изменяя values.
+
+        'clip' - возвращает новый массив np.clip(values, lower_bounds, upper_bounds).
+        'drop' - выбросы и пропуски исключаются: при lazy=True возвращается np.ma.MaskedArray
+            над values без копирования данных, иначе новый массив с np.nan на месте выбросов.
+        Границы метрик считаются за один проход, см. get_outlier_bounds.
+
+        :param values (np.ndarray): значения метрик, shape=(n, m), столбец - метрика.
+        :param design (Design): объект с данными, описывающий параметры эксперимента.
+        :param lazy (bool): для 'drop' вернуть маскированный массив вместо копии, для 'clip' не используется.
+        :return (np.ndarray, np.ma.MaskedArray): обработанные значения, shape=(n, m).
+        """
+        values = np.asarray(values, dtype=float)
+        lower_bounds, upper_bounds = self.get_outlier_bounds(values, design)
+        if design.metric_outlier_process_type == 'clip':
+            return np.clip(values, lower_bounds, upper_bounds)
+        elif design.metric_outlier_process_type == 'drop':
+            is_outlier = ~((values >= lower_bounds) & (values <= upper_bounds))
+            if lazy:
+                return np.ma.masked_array(values, mask=is_outlier, copy=False)
+            return np.where(is_outlier, np.nan, values)
+        raise ValueError('Неверный design.metric_outlier_process_type')
 
 def _chech_df(df, df_ideal, sort_by, reindex=False, set_dtypes=False):
     assert isinstance(df, pd.DataFrame), 'Функция вернула не pd.DataFrame.'
@@ -87,4 +128,30 @@ if __name__ == '__main__':
     metrics_service = MetricsService()
     processed_metrics = metrics_service.process_outliers(metrics, design)
     _chech_df(processed_metrics, ideal_processed_metrics, ['user_id', 'metric'], True, True)
+
+    design.metric_outlier_process_type = 'clip'
+    processed_metrics = metrics_service.process_outliers(metrics, design)
+    _chech_df(processed_metrics, metrics.assign(metric=[1., 2, 2.2]), ['user_id', 'metric'], True, True)
+    assert metrics['metric'].tolist() == [1., 2, 3], 'Исходный датафрейм не должен изменяться'
+
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(0, 1, (1000, 100)) * np.arange(1, 101)
+    values_copy = values.copy()
+    design = Design(
+        metric_name='many', metric_outlier_lower_bound=0.01, metric_outlier_upper_bound=0.99,
+        metric_outlier_process_type='drop', metric_outlier_bound_type='quantile',
+    )
+    dropped = metrics_service.process_outliers_batch(values, design, lazy=True)
+    assert np.shares_memory(dropped.data, values), 'Маскированный массив не должен копировать данные'
+    lower_bounds, upper_bounds = np.quantile(values, [0.01, 0.99], axis=0)
+    for index in [0, 57, 99]:
+        column = values[:, index]
+        ideal_values = column[(column >= lower_bounds[index]) & (column <= upper_bounds[index])]
+        np.testing.assert_array_equal(dropped[:, index].compressed(), ideal_values)
+    dropped_copy = metrics_service.process_outliers_batch(values, design)
+    np.testing.assert_allclose(dropped.mean(axis=0), np.nanmean(dropped_copy, axis=0))
+    design.metric_outlier_process_type = 'clip'
+    clipped = metrics_service.process_outliers_batch(values, design)
+    np.testing.assert_array_equal(clipped, np.clip(values, lower_bounds, upper_bounds))
+    np.testing.assert_array_equal(values, values_copy)
     print('simple test passed')
\ No newline at end of file
@@ -1,28 +1,155 @@
+from itertools import combinations, product
+
 import pandas as pd
 import numpy as np
 
 
-def get_strats(df: pd.DataFrame):
+# лучший набор признаков и границы его интервалов, найденные search_strats на data/stratification_task_data_public.csv
+STRAT_FEATURES = ['x2:q10']
+STRAT_EDGES = {'x2:q10': [24, 26, 28, 29, 30, 31, 32, 34, 36]}
+
+
+def get_strats(df: pd.DataFrame, features=STRAT_FEATURES, edges=STRAT_EDGES):
     """Возвращает страты объектов.
-    
+
+    :param features (list[str]): признаки для построения страт, см. encode_strats.
+    :param edges (dict[str, list[float]]): границы интервалов признаков 'column:qK', см. encode_strats.
     :return (list | np.array | pd.Series): список страт объектов размера len(df).
     """
     # YOUR_CODE_HERE
-    for i in df.index:
-        if df['x4'][i] == 0 and df['x8'][i] == 0:
-            df.loc[i, 'strat'] = 1
-        elif df['x4'][i] == 0 and df['x8'][i] == 1:
-            df.loc[i, 'strat'] = 2
-        elif df['x4'][i] == 1 and df['x8'][i] == 0:
-            df.loc[i, 'strat'] = 3
-        elif df['x4'][i] == 1 and df['x8'][i] == 1:
-            df.loc[i, 'strat'] = 4
-        elif df['x4'][i] == 2 and df['x8'][i] == 0:
-            df.loc[i, 'strat'] = 5
-        elif df['x4'][i] == 2 and df['x8'][i] == 1:
-            df.loc[i, 'strat'] = 6
-
-        return df['strat']
+    return pd.Series(encode_strats(df, features, edges), index=df.index, name='strat')
+
+
+def encode_strats(df, features, edges=None):
+    """Кодирует сочетания значений признаков номерами страт за один проход по столбцам.
+
+    Признак задаётся названием столбца, тогда стратой служит значение признака,
+    или строкой 'column:qK', тогда значения разбиваются на K интервалов по квантилям.
+    Границы интервалов берутся из edges, а для признаков не из edges считаются по квантилям df.
+    Страты нумеруются с 1 в лексикографическом порядке кодов признаков, поэтому при заданных
+    границах номер страты объекта не зависит от остальных объектов df.
+
+    :param df (pd.DataFrame): таблица с признаками.
+    :param features (list[str]): признаки, например ['x4', 'x1:q4'].
+    :param edges (dict[str, list[float]]): границы интервалов признаков, например из search_strats.
+    :return (np.array): номера страт, shape=(len(df),).
+    """
+    edges = edges or {}
+    codes = np.zeros(len(df), dtype=np.int64)
+    for feature in features:
+        feature_codes, n_levels, _ = _encode_feature(df, feature, edges.get(feature))
+        codes = codes * n_levels + feature_codes
+    return codes + 1
+
+
+def search_strats(df, target='y', features=None, max_features=2, n_bins=range(2, 11), max_levels=10,
+                  min_part=0.05, chunk_size=64):
+    """Перебирает наборы признаков и способы их разбиения, ранжирует их по стратифицированной дисперсии.
+
+    Для каждого признака рассматриваются его значения, если их не больше max_levels,
+    и разбиения на K интервалов по квантилям для K из n_bins. Кандидаты - все сочетания
+    не более max_features разных признаков. Дисперсии кандидатов считаются пачками по chunk_size
+    через np.bincount сумм и сумм квадратов по стратам всех кандидатов пачки сразу.
+
+    :param df (pd.DataFrame): таблица с признаками и целевой переменной.
+    :param target (str): целевая переменная.
+    :param features (list[str]): столбцы-признаки, по умолчанию все кроме target.
+    :param max_features (int): максимальное количество признаков в кандидате.
+    :param n_bins (list[int]): количества интервалов для разбиения по квантилям.
+    :param max_levels (int): максимальное количество значений признака, используемых без разбиения.
+    :param min_part (float): минимальная доля объектов в страте, кандидаты с меньшей долей отбрасываются.
+    :param chunk_size (int): количество кандидатов, обрабатываемых за одно вычисление.
+    :return (pd.DataFrame): кандидаты по возрастанию дисперсии,
+        columns=['features', 'edges', 'strat_var', 'min_part', 'n_strats'], features и edges подходят
+        для encode_strats, edges - границы интервалов признаков 'column:qK', найденные на df.
+    """
+    if features is None:
+        features = [column for column in df.columns if column != target]
+    options = {}
+    for column in features:
+        n_unique = df[column].nunique()
+        column_options = [column] if n_unique <= max_levels else []
+        column_options += [f'{column}:q{k}' for k in n_bins if k < n_unique]
+        options[column] = {option: _encode_feature(df, option) for option in column_options}
+
+    candidates = []
+    for n_features in range(1, max_features + 1):
+        for columns in combinations(features, n_features):
+            candidates += product(*(options[column] for column in columns))
+
+    # центрирование уменьшает ошибки округления в суммах квадратов
+    values = df[target].to_numpy(dtype=float)
+    values = values - values.mean()
+    results = []
+    for begin in range(0, len(candidates), chunk_size):
+        chunk = candidates[begin:begin + chunk_size]
+        codes, sizes = [], []
+        for candidate in chunk:
+            candidate_codes, size = np.zeros(len(df), dtype=np.int64), 1
+            for option in candidate:
+                feature_codes, n_levels, _ = options[option.split(':')[0]][option]
+                candidate_codes = candidate_codes * n_levels + feature_codes
+                size *= n_levels
+            codes.append(candidate_codes)
+            sizes.append(size)
+        results.append(_get_strat_vars(values, np.array(codes), np.array(sizes)))
+    strat_vars, min_parts, n_strats = np.concatenate(results, axis=1) if results else np.zeros((3, 0))
+
+    result = pd.DataFrame({
+        'features': [list(candidate) for candidate in candidates],
+        'edges': [
+            {option: list(options[option.split(':')[0]][option][2]) for option in candidate if ':' in option}
+            for candidate in candidates
+        ],
+        'strat_var': strat_vars,
+        'min_part': min_parts,
+        'n_strats': n_strats.astype(int),
+    })
+    result = result[result['min_part'] >= min_part]
+    return result.sort_values('strat_var', kind='stable').reset_index(drop=True)
+
+
+def _encode_feature(df, feature, edges=None):
+    """Возвращает коды значений признака от 0, количество возможных кодов и границы интервалов.
+
+    Для признака 'column:qK' без edges границы считаются по квантилям df, для признака-столбца edges равны None.
+    """
+    column, _, binning = feature.partition(':')
+    values = df[column].to_numpy()
+    if binning:
+        if edges is None:
+            n_bins = int(binning.removeprefix('q'))
+            edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1]))
+        edges = np.asarray(edges, dtype=float)
+        return np.searchsorted(edges, values, side='right'), len(edges) + 1, edges
+    codes, uniques = pd.factorize(values, sort=True)
+    return codes, len(uniques), None
+
+
+def _get_strat_vars(values, codes, sizes):
+    """Стратифицированные дисперсии для пачки разбиений на страты, как calculate_strat_var.
+
+    :param values (np.array): значения целевой переменной, shape=(n,).
+    :param codes (np.ndarray): номера страт кандидатов, shape=(m, n), коды кандидата i меньше sizes[i].
+    :param sizes (np.array): количество возможных страт кандидатов, shape=(m,).
+    :return (np.ndarray): дисперсии, минимальные доли страт и количества страт, shape=(3, m).
+    """
+    n = len(values)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    cells = (codes + offsets[:, None]).ravel()
+    counts = np.bincount(cells, minlength=sizes.sum())
+    sums = np.bincount(cells, np.tile(values, len(codes)), minlength=sizes.sum())
+    sumsqs = np.bincount(cells, np.tile(values ** 2, len(codes)), minlength=sizes.sum())
+    has_var = counts > 1
+    # вклад страты - доля страты на её дисперсию с ddof=1
+    contributions = np.zeros(len(counts))
+    contributions[has_var] = (
+        (sumsqs[has_var] - sums[has_var] ** 2 / counts[has_var]) / (counts[has_var] - 1) * counts[has_var] / n
+    )
+    strat_vars = np.add.reduceat(contributions, offsets)
+    min_parts = np.minimum.reduceat(np.where(counts > 0, counts, n), offsets) / n
+    n_strats = np.add.reduceat(counts > 0, offsets)
+    return np.array([strat_vars, min_parts, n_strats])
 
 
 def calculate_strat_var(df):
@@ -36,6 +163,19 @@ def calculate_strat_var(df):
 if __name__ == "__main__":
     bound = 50000
     df = pd.read_csv('data/stratification_task_data_public.csv')
+    candidates = search_strats(df)
+    assert candidates['features'][0] == STRAT_FEATURES, 'Поиск должен находить STRAT_FEATURES'
+    assert candidates['edges'][0].keys() == STRAT_EDGES.keys(), 'Поиск должен находить STRAT_EDGES'
+    for feature, edges in STRAT_EDGES.items():
+        np.testing.assert_allclose(candidates['edges'][0][feature], edges, err_msg='Неверные STRAT_EDGES')
+    for _, (features, edges, strat_var) in candidates[['features', 'edges', 'strat_var']][:20].iterrows():
+        np.testing.assert_allclose(
+            strat_var, calculate_strat_var(df.assign(strat=encode_strats(df, features, edges))), rtol=1e-9,
+            err_msg='Неверная дисперсия кандидата'
+        )
+    subset = df.sample(300, random_state=0)
+    assert (get_strats(subset) == get_strats(df).loc[subset.index]).all(), 'Страты зависят от состава таблицы'
+    assert (get_strats(df, ['x4', 'x8']) == 2 * df['x4'] + df['x8'] + 1).all(), 'Неверные номера страт'
     strats = get_strats(df.drop('y', axis=1))
     assert len(strats) == len(df), "Неверный размер списка страт"
     min_part = pd.Series(strats).value_counts(normalize=True).min()
@@ -44,4 +184,4 @@ if __name__ == "__main__":
     strat_var = calculate_strat_var(df)
     err_msg = f"Дисперсия равна {strat_var:0.1f}, её нужно снизить до {bound}"
     assert strat_var <= bound, err_msg
-    print(f'Отлично! Дисперсия равна {strat_var:0.1f}, меньше порога {bound}')
\ No newline at end of file
+    print(f'Отлично! Дисперсия равна {strat_var:0.1f}, меньше порога {bound}')
@@ -1,33 +1,78 @@
+from hashlib import md5
+
 import numpy as np
 import pandas as pd
 
 
-def split_stratified(strats: np.array) -> np.array:
+class StratifiedSplitter:
+
+    def __init__(self, salt: str=''):
+        """Детерминированное стратифицированное распределение пользователей по группам.
+
+        Случайный ключ пользователя - md5 от user_id + salt, как в SplittingService.get_bucket.
+        Внутри страты пользователи сортируются по ключу и по очереди попадают в группы 0 и 1,
+        продолжая чередование с уже распределённых пользователей страты. Группа первого пользователя
+        страты - младший бит md5 от страты + salt, поэтому лишний пользователь нечётной страты
+        с равной вероятностью попадает в любую группу и общий перекос по стратам в среднем нулевой.
+        Поэтому в каждой страте размеры групп отличаются не больше чем на 1, в том числе
+        после распределения новых пользователей, а повторный вызов даёт тот же результат.
+
+        :param salt: соль для хеширования идентификаторов пользователей.
+        """
+        self.salt = salt
+        self.strat_counts = {}
+        self.user2group = {}
+
+    def assign(self, strats, user_ids=None) -> np.array:
+        """Распределяет пользователей по группам, для уже распределённых возвращает их группы.
+
+        :param strats: массив с разбиением на страты.
+        :param user_ids: идентификаторы пользователей, если None - номера объектов в strats.
+            Номера не отличают объекты разных вызовов, поэтому без user_ids можно распределять
+            только в первом вызове.
+        :return: массив из 0 и 1, 0 - контрольная группа, 1 - экспериментальная.
+        """
+        if user_ids is None and self.user2group:
+            raise ValueError('Для повторного распределения нужно указать user_ids')
+        strats = np.asarray(strats)
+        user_ids = [str(user_id) for user_id in (range(len(strats)) if user_ids is None else user_ids)]
+        new_users = {}
+        for user_id, strat in zip(user_ids, strats):
+            if user_id not in self.user2group:
+                new_users.setdefault(user_id, strat)
+        if new_users:
+            self._assign_new(list(new_users), np.array(list(new_users.values())))
+        return np.array([self.user2group[user_id] for user_id in user_ids], dtype=int)
+
+    def _assign_new(self, user_ids, strats):
+        """Распределяет новых пользователей одной сортировкой по (страта, ключ)."""
+        digests = b''.join(md5((user_id + self.salt).encode()).digest() for user_id in user_ids)
+        keys = np.frombuffer(digests, dtype='>u8').reshape(-1, 2)
+        codes, uniques = pd.factorize(strats)
+        order = np.lexsort((keys[:, 1], keys[:, 0], codes))
+        sorted_codes = codes[order]
+        is_first = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+        first_positions = np.flatnonzero(is_first)
+        ranks = np.arange(len(order)) - np.repeat(first_positions, np.diff(np.r_[first_positions, len(order)]))
+        offsets = np.array([self.strat_counts.get(strat, 0) for strat in uniques], dtype=int)
+        starts = np.array([md5((str(strat) + self.salt).encode()).digest()[-1] & 1 for strat in uniques], dtype=int)
+        groups = np.empty(len(order), dtype=int)
+        groups[order] = (starts[sorted_codes] + offsets[sorted_codes] + ranks) % 2
+        self.user2group.update(zip(user_ids, groups.tolist()))
+        for strat, count in zip(uniques, offsets + np.bincount(codes, minlength=len(uniques))):
+            self.strat_counts[strat] = int(count)
+
+
+def split_stratified(strats: np.array, user_ids=None, salt: str='') -> np.array:
     """Распределяет объекты по группам (контрольная и экспериментальная).
     
     :param strats: массив с разбиением на страты.
+    :param user_ids: идентификаторы объектов для хеширования, если None - номера объектов в strats.
+    :param salt: соль для хеширования идентификаторов.
     :return: массив из 0 и 1, 0 - контрольная группа, 1 - экспериментальная.
     """
     # YOUR_CODE_HERE
-    strats = pd.DataFrame(strats, columns=['strat'])
-    a_indexes = []
-    b_indexes = []
-    indexes = {}
-
-    for strat in strats['strat'].unique():
-        indexes[strat] = strats.index[strats['strat'] == strat].tolist()
-    
-    strats['split'] = 0
-    
-    for strat in indexes:
-        a, b = np.random.choice(indexes[strat], (2, len(indexes[strat])//2), replace=False).tolist()
-        a_indexes.append(a)
-        b_indexes.append(b)
-
-    strats.loc[[item for sublist in a_indexes for item in sublist], 'split'] = 1
-    strats.loc[[item for sublist in b_indexes for item in sublist], 'split'] = 0
-    
-    return strats['split']
+    return StratifiedSplitter(salt).assign(strats, user_ids)
 
 
 def check_split(df: pd.DataFrame):
@@ -50,4 +95,30 @@ if __name__ == "__main__":
     df = pd.DataFrame({'strat': [1, 2, 2, 2, 1, 1, 1, 3, 3]})
     df['group'] = split_stratified(df['strat'].values)
     check_split(df)
+    assert (split_stratified(df['strat'].values) == df['group']).all(), 'Разбиение должно быть воспроизводимым'
+
+    rng = np.random.default_rng(0)
+    users = pd.DataFrame({'user_id': [f'user_{i}' for i in range(3000)], 'strat': rng.integers(0, 7, 3000)})
+    users['group'] = split_stratified(users['strat'].values, users['user_id'], salt='exp_1')
+    check_split(users)
+    splitter = StratifiedSplitter(salt='exp_1')
+    bounds = [0, 1000, 1001, 2500, len(users)]
+    users['group'] = np.concatenate([
+        splitter.assign(users['strat'][begin:end], users['user_id'][begin:end])
+        for begin, end in zip(bounds[:-1], bounds[1:])
+    ])
+    check_split(users)
+    repeated = splitter.assign(users['strat'][:100], users['user_id'][:100])
+    assert (repeated == users['group'][:100]).all(), 'Группа пользователя не должна меняться'
+    # в нечётных стратах лишний пользователь не должен всегда попадать в контрольную группу
+    odd_strats = np.repeat(np.arange(400), 3)
+    groups = split_stratified(odd_strats, [f'user_{i}' for i in range(len(odd_strats))], salt='exp_2')
+    check_split(pd.DataFrame({'strat': odd_strats, 'group': groups}))
+    assert abs((groups == 0).sum() - (groups == 1).sum()) < 100, 'Контрольная группа систематически больше'
+    try:
+        splitter.assign(users['strat'][:100])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Повторное распределение без user_ids должно падать')
     print('simple test passed')
\ No newline at end of file
@@ -37,70 +37,39 @@ class ExperimentsService:
         :return (float): значение p-value
         """
         # YOUR_CODE_HERE
-        a = pd.DataFrame(metrics_strat_a_group, columns=['metric', 'strat'])
-        b = pd.DataFrame(metrics_strat_b_group, columns=['metric', 'strat'])
-        df = pd.concat([a, b], ignore_index=False)
-        weights = df['strat'].value_counts(normalize=True)
-        
-        # Stratified mean - a
-        a_strat_mean = a.groupby('strat')['metric'].mean()
-        a_means_weights = pd.merge(
-            a_strat_mean,
-            pd.Series(weights, name='weight'),
-            how='inner',
-            left_index=True,
-            right_index=True
+        pvalues = self.get_pvalues_strat(
+            metrics_strat_a_group[:, :1], metrics_strat_a_group[:, 1],
+            metrics_strat_b_group[:, :1], metrics_strat_b_group[:, 1]
         )
+        return pvalues[0]
 
-        a_means_weights['weight'] = a_means_weights['weight'] / a_means_weights['weight'].sum()
-        a_mean_final = (a_means_weights['weight'] * a_means_weights['metric']).sum()
-        
-        # Stratified var - a
-        a_strat_var = a.groupby('strat')['metric'].var()
-        a_vars_weights = pd.merge(
-            a_strat_var,
-            pd.Series(weights, name='weight'),
-            how='inner',
-            left_index=True,
-            right_index=True
-        )
-
-        a_vars_weights['weight'] = a_vars_weights['weight'] / a_vars_weights['weight'].sum()
-        a_var_final = (a_vars_weights['weight'] * a_vars_weights['metric']).sum()
-        
-        # Stratified mean - b
-        b_strat_mean = b.groupby('strat')['metric'].mean()
-        b_means_weights = pd.merge(
-            b_strat_mean,
-            pd.Series(weights, name='weight'),
-            how='inner',
-            left_index=True,
-            right_index=True
-        )
+    def get_pvalues_strat(self, metrics_a_group, strata_a_group, metrics_b_group, strata_b_group):
+        """Применяет постстратификацию сразу к нескольким метрикам, возвращает pvalue для каждой.
 
-        b_means_weights['weight'] = b_means_weights['weight'] / b_means_weights['weight'].sum()
-        b_mean_final = (b_means_weights['weight'] * b_means_weights['metric']).sum()
-        
-        # Stratified var - b
-        b_strat_var = b.groupby('strat')['metric'].var()
-        b_vars_weights = pd.merge(
-            b_strat_var,
-            pd.Series(weights, name='weight'),
-            how='inner',
-            left_index=True,
-            right_index=True
-        )
+        Страты один раз кодируются целыми числами, затем для каждой страты и метрики
+        через np.bincount считаются количество, сумма и сумма квадратов отклонений от среднего страты.
+        Веса страт считаются по данным обеих групп и нормируются по стратам, которые есть в группе.
+        Дисперсия страты с одним наблюдением не определена, такие страты в дисперсию не входят.
 
-        b_vars_weights['weight'] = b_vars_weights['weight'] / b_vars_weights['weight'].sum()
-        b_var_final = (b_vars_weights['weight'] * b_vars_weights['metric']).sum()
-        
-        # Stratified t-test
-        se = (a_var_final / len(a) + b_var_final / len(b)) ** 0.5
-        t = (a_mean_final - b_mean_final) / se
-        pvalue = (1 - stats.norm.cdf(np.abs(t))) * 2
-        # print(pvalue)
-        return pvalue
-        
+        :param metrics_a_group (np.ndarray): значения метрик группы A, shape = (n_a, k).
+        :param strata_a_group (np.ndarray): страты группы A, shape = (n_a,).
+        :param metrics_b_group (np.ndarray): значения метрик группы B, shape = (n_b, k).
+        :param strata_b_group (np.ndarray): страты группы B, shape = (n_b,).
+        :return (np.ndarray): значения p-value, shape = (k,).
+        """
+        codes, uniques = pd.factorize(np.concatenate([strata_a_group, strata_b_group]))
+        n_strata = len(uniques)
+        codes_a, codes_b = codes[:len(strata_a_group)], codes[len(strata_a_group):]
+        stats_a = _get_strata_stats(np.asarray(metrics_a_group, dtype=float), codes_a, n_strata)
+        stats_b = _get_strata_stats(np.asarray(metrics_b_group, dtype=float), codes_b, n_strata)
+        weights = stats_a[0] + stats_b[0]
+        weights = weights / weights.sum()
+
+        mean_a, var_a = _get_strat_mean_var(*stats_a, weights)
+        mean_b, var_b = _get_strat_mean_var(*stats_b, weights)
+        se = (var_a / len(codes_a) + var_b / len(codes_b)) ** 0.5
+        t = (mean_a - mean_b) / se
+        return (1 - stats.norm.cdf(np.abs(t))) * 2
 
     def get_pvalue(self, metrics_strat_a_group, metrics_strat_b_group, design):
         """Применяет статтест, возвращает pvalue.
@@ -124,6 +93,42 @@ class ExperimentsService:
             raise ValueError('Неверный design.statistical_test')
 
 
+def _get_strata_stats(values, codes, n_strata):
+    """Считает количество, сумму и сумму квадратов отклонений от среднего для каждой страты.
+
+    :param values (np.ndarray): значения метрик, shape = (n, k).
+    :param codes (np.ndarray): номера страт, shape = (n,), -1 - страта не задана.
+    :param n_strata (int): количество страт.
+    :return counts, sums, sumsqs:
+        counts (np.ndarray) - количество наблюдений, shape = (n_strata,)
+        sums, sumsqs (np.ndarray) - суммы и суммы квадратов отклонений, shape = (k, n_strata)
+    """
+    values = values[codes >= 0].T
+    codes = codes[codes >= 0]
+    k = len(values)
+    # номер ячейки (метрика, страта), чтобы посчитать все метрики одним вызовом np.bincount
+    cells = (codes + np.arange(k)[:, None] * n_strata).ravel()
+    counts = np.bincount(codes, minlength=n_strata)
+    sums = np.bincount(cells, values.ravel(), minlength=k * n_strata).reshape(k, n_strata)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    deviations = values - means[:, codes]
+    sumsqs = np.bincount(cells, (deviations ** 2).ravel(), minlength=k * n_strata).reshape(k, n_strata)
+    return counts, sums, sumsqs
+
+
+def _get_strat_mean_var(counts, sums, sumsqs, weights):
+    """Стратифицированные среднее и дисперсия группы по статистикам страт, shape = (k,)."""
+    present = counts > 0
+    group_weights = np.where(present, weights, 0.) / weights[present].sum()
+    counts = counts[present]
+    weights = group_weights[present]
+    mean = (sums[:, present] / counts * weights).sum(axis=1)
+    has_var = counts > 1
+    var = (sumsqs[:, present][:, has_var] / (counts[has_var] - 1) * weights[has_var]).sum(axis=1)
+    return mean, var
+
+
 if __name__ == '__main__':
     metrics_strat_a_group = np.zeros((10, 2,))
     metrics_strat_a_group[:, 0] = np.arange(10)
@@ -138,4 +143,29 @@ if __name__ == '__main__':
     pvalue = experiments_service.get_pvalue(metrics_strat_a_group, metrics_strat_b_group, design)
 
     np.testing.assert_almost_equal(ideal_pvalue, pvalue, decimal=4, err_msg='Неверное значение pvalue')
+
+    def get_pvalue_groupby(a, b):
+        a = pd.DataFrame(a, columns=['metric', 'strat'])
+        b = pd.DataFrame(b, columns=['metric', 'strat'])
+        weights = pd.concat([a, b])['strat'].value_counts(normalize=True)
+        results = []
+        for group in [a, b]:
+            group_weights = weights[group['strat'].unique()]
+            group_weights = group_weights / group_weights.sum()
+            results.append((group.groupby('strat')['metric'].mean() * group_weights).sum())
+            results.append((group.groupby('strat')['metric'].var() * group_weights).sum())
+        se = (results[1] / len(a) + results[3] / len(b)) ** 0.5
+        return (1 - stats.norm.cdf(np.abs((results[0] - results[2]) / se))) * 2
+
+    rng = np.random.default_rng(0)
+    metrics_a, metrics_b = rng.exponential(10, (1000, 3)), rng.exponential(10.5, (1200, 3))
+    # страта 7 только в группе A, страты 8 и 9 по одному наблюдению
+    strata_a = np.concatenate([rng.integers(0, 7, 998), [7, 8]]).astype(float)
+    strata_b = np.concatenate([rng.integers(0, 7, 1199), [9]]).astype(float)
+    pvalues = experiments_service.get_pvalues_strat(metrics_a, strata_a, metrics_b, strata_b)
+    for index, pvalue in enumerate(pvalues):
+        ideal_pvalue = get_pvalue_groupby(
+            np.column_stack([metrics_a[:, index], strata_a]), np.column_stack([metrics_b[:, index], strata_b])
+        )
+        np.testing.assert_allclose(pvalue, ideal_pvalue, rtol=1e-10, err_msg='Неверное значение pvalue')
     print('simple test passed')
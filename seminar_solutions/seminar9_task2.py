@@ -1,34 +1,205 @@
 import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from seminar1_task4 import DataService as IndexedDataService
+from seminar1_task5 import DailyRollups, DAY, get_activity
 
-class DataService:
 
-    def __init__(self, table_name_2_table):
-        self.table_name_2_table = table_name_2_table
+class DataService(IndexedDataService):
 
     def get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None):
-        df = self.table_name_2_table[table_name]
-        if begin_date:
-            df = df[df['date'] >= begin_date]
-        if end_date:
-            df = df[df['date'] < end_date]
-        if user_ids:
-            df = df[df['user_id'].isin(user_ids)]
-        if columns:
-            df = df[columns]
-        return df.copy()
+        # пустые значения фильтров означают, что фильтровать не нужно
+        return super().get_data_subset(
+            table_name, begin_date or None, end_date or None, user_ids or None, columns or None
+        )
+
+
+class CovariateStore:
+
+    covariate_names = ['revenue (web)', 'revenue', 'purchases', 'visits']
+
+    def __init__(self, data_service, period=timedelta(days=7), max_dates=16, rollups=None):
+        """Поюзерные признаки за период до начала эксперимента для CUPED.
+
+        Признаки всех пользователей считаются один раз для даты начала эксперимента
+        по интервалу [начало суток begin_date - period, begin_date) и дальше только выбираются из памяти:
+            'revenue (web)' - выручка для заходивших на сайт в этом интервале, иначе 0
+            'revenue' - выручка
+            'purchases' - количество покупок
+            'visits' - количество заходов на сайт
+        У пользователей без событий в интервале все признаки равны 0.
+
+        :param data_service (DataService): объект класса, предоставляющий доступ с данным.
+        :param period (timedelta): длина интервала до начала эксперимента.
+        :param max_dates (int): количество дат начала, для которых признаки хранятся в памяти.
+        :param rollups (None, DailyRollups): дневные агрегаты, по которым считаются признаки за целые сутки.
+        """
+        self.data_service = data_service
+        self.period = period
+        self.max_dates = max_dates
+        self.rollups = rollups
+        self.date2covariates = {}
+
+    def get_covariates(self, begin_date, user_ids=None, names=None):
+        """Возвращает признаки пользователей.
+
+        :param begin_date (datetime): дата начала эксперимента.
+        :param user_ids (None, list[str]): пользователи, если None - все с событиями до начала эксперимента.
+        :param names (None, list[str]): названия признаков, если None - все.
+        :return (pd.DataFrame): index - user_id в порядке user_ids, columns - признаки, dtype float64.
+        """
+        covariates = self.date2covariates.get(begin_date)
+        if covariates is None:
+            covariates = self._calculate_covariates(begin_date)
+            if len(self.date2covariates) >= self.max_dates:
+                self.date2covariates.pop(next(iter(self.date2covariates)))
+            self.date2covariates[begin_date] = covariates
+        covariates = covariates[names or self.covariate_names]
+        if user_ids is None:
+            return covariates
+        return covariates.reindex(pd.Index(user_ids, name='user_id'), fill_value=0.)
+
+    def _calculate_covariates(self, begin_date):
+        # интервал начинается в полночь, как у ковариаты 'previous week revenue' в StreamingMetricsService
+        begin_cov_date = begin_date.replace(hour=0, minute=0, second=0, microsecond=0) - self.period
+        if self.rollups is not None:
+            covariates = self.rollups.get_activity(begin_cov_date, begin_date)
+        else:
+            covariates = get_activity(self.data_service, begin_cov_date, begin_date)
+        covariates['revenue (web)'] = covariates['revenue'].where(covariates['visits'] > 0, 0.)
+        covariates.index.name = 'user_id'
+        return covariates.sort_index()
+
+
+class PrefixSumCovariates:
+
+    covariate_names = CovariateStore.covariate_names
+
+    def __init__(self, data_service, period=timedelta(days=7)):
+        """Признаки пользователей до начала эксперимента для любых интервалов по накопленным суммам.
+
+        При создании таблицы 'sales' и 'web-logs' читаются один раз, события группируются в ячейки
+        (пользователь, день), и по ячейкам в порядке пользователей и дней строятся накопленные суммы
+        выручки, количества покупок и заходов на сайт. Признаки пользователя за целые дни [day - L, day)
+        - разность двух накопленных сумм, поэтому перебор длин интервалов не читает сырые данные.
+        Если begin_date не начало суток, то события за [начало суток, begin_date) читаются из data_service,
+        поэтому признаки те же, что у CovariateStore, и get_covariates совместим с CovariateStore.get_covariates.
+        Память - 4 массива длины количество ячеек (пользователь, день) с событиями,
+        она не зависит от количества дней, в которые пользователь не был активен.
+
+        :param data_service (DataService): объект класса, предоставляющий доступ с данным.
+        :param period (timedelta): длина интервала до начала эксперимента для get_covariates.
+        """
+        self.data_service = data_service
+        self.period = period
+        sales = data_service.get_data_subset('sales', None, None, None, ['date', 'user_id', 'price'])
+        web_logs = data_service.get_data_subset('web-logs', None, None, None, ['date', 'user_id'])
+        sales = sales[sales['date'].notna() & sales['user_id'].notna()]
+        web_logs = web_logs[web_logs['date'].notna() & web_logs['user_id'].notna()]
+        events = pd.concat([
+            sales.assign(revenue=sales['price'].fillna(0.), purchases=1., visits=0.),
+            web_logs.assign(revenue=0., purchases=0., visits=1.),
+        ])
+        self.first_day = events['date'].min().floor('D')
+        self.n_days = (events['date'].max().floor('D') - self.first_day) // DAY + 1
+        self.users = pd.Index(events['user_id'].unique(), name='user_id').sort_values()
+        days = ((events['date'] - self.first_day) // DAY).to_numpy()
+        cells = self.users.get_indexer(events['user_id']) * self.n_days + days
+        self.cells, cell_indices = np.unique(cells, return_inverse=True)
+        self.cumsums = {
+            name: np.concatenate([
+                [0.], np.cumsum(np.bincount(cell_indices, events[name].to_numpy(dtype=float), len(self.cells)))
+            ])
+            for name in ['revenue', 'purchases', 'visits']
+        }
+
+    def _get_day(self, date):
+        """Номер дня от first_day для начала суток date, ограниченный диапазоном данных."""
+        return int(np.clip((date - self.first_day) // DAY, 0, self.n_days))
+
+    def get_covariates_sweep(self, begin_date, lookbacks, user_ids=None, names=None):
+        """Возвращает признаки пользователей сразу для нескольких длин интервала до начала эксперимента.
+
+        Интервал для длины L - [начало суток begin_date - L дней, begin_date), как у CovariateStore.
+
+        :param begin_date (datetime): дата начала эксперимента.
+        :param lookbacks (list[int]): длины интервалов в днях.
+        :param user_ids (None, list[str]): пользователи, если None - все пользователи из данных.
+        :param names (None, list[str]): названия признаков, если None - все.
+        :return (pd.DataFrame): index - user_id в порядке user_ids,
+            columns - MultiIndex (длина интервала, признак), dtype float64.
+        """
+        names = names or self.covariate_names
+        begin_day = pd.Timestamp(begin_date).floor('D')
+        end_day = self._get_day(begin_day)
+        begin_days = np.array([self._get_day(begin_day - lookback * DAY) for lookback in lookbacks])
+        if user_ids is None:
+            user_ids, codes = self.users, np.arange(len(self.users))
+        else:
+            user_ids = pd.Index(user_ids, name='user_id')
+            codes = self.users.get_indexer(user_ids)
+        # пользователи без событий отсутствуют в ячейках, их суммы за целые дни равны 0
+        is_known = codes >= 0
+        cell_offsets = np.where(is_known, codes, 0) * self.n_days
+        end_positions = np.searchsorted(self.cells, cell_offsets + end_day)
+        begin_positions = np.searchsorted(self.cells, cell_offsets + begin_days[:, None])
+        sums = {
+            name: np.where(is_known, cumsums[end_positions] - cumsums[begin_positions], 0.)
+            for name, cumsums in self.cumsums.items()
+        }
+        if begin_date != begin_day:
+            activity = get_activity(self.data_service, begin_day, begin_date).reindex(user_ids, fill_value=0.)
+            for name in sums:
+                sums[name] = sums[name] + activity[name].to_numpy()
+        sums['revenue (web)'] = np.where(sums['visits'] > 0, sums['revenue'], 0.)
+        values = np.stack([sums[name] for name in names], axis=1).reshape(len(lookbacks) * len(names), -1)
+        return pd.DataFrame(
+            values.T, index=user_ids, columns=pd.MultiIndex.from_product([list(lookbacks), names])
+        )
+
+    def get_covariates(self, begin_date, user_ids=None, names=None):
+        """Возвращает признаки пользователей за период перед begin_date, см. CovariateStore.get_covariates.
+
+        :param user_ids (None, list[str]): пользователи, если None - все пользователи из данных.
+        """
+        lookback = self.period // DAY
+        return self.get_covariates_sweep(begin_date, [lookback], user_ids, names)[lookback]
+
+
+def cuped_adjust(values, covariates):
+    """CUPED сразу для нескольких метрик с несколькими ковариатами.
+
+    Коэффициенты всех метрик находятся одним решением нормальных уравнений
+    (X_c^T X_c) theta = X_c^T Y_c, где X_c и Y_c - центрированные ковариаты и метрики.
+    Для вырожденной матрицы ковариат берётся решение наименьших квадратов.
+
+    :param values (np.ndarray): значения метрик, shape=(n, m).
+    :param covariates (np.ndarray): значения ковариат, shape=(n, p).
+    :return adjusted, theta:
+        adjusted (np.ndarray) - values - (covariates - mean(covariates)) @ theta, shape=(n, m)
+        theta (np.ndarray) - коэффициенты, shape=(p, m)
+    """
+    covariates_centered = covariates - covariates.mean(axis=0)
+    values_centered = values - values.mean(axis=0)
+    gram = covariates_centered.T @ covariates_centered
+    theta = np.linalg.lstsq(gram, covariates_centered.T @ values_centered, rcond=None)[0]
+    return values - covariates_centered @ theta, theta
 
 
 class MetricsService:
 
-    def __init__(self, data_service):
+    def __init__(self, data_service, rollups=None, covariate_store=None):
         """Класс для вычисления метрик.
 
         :param data_service (DataService): объект класса, предоставляющий доступ с данным.
+        :param rollups (None, DailyRollups): дневные агрегаты, по которым считается выручка за целые сутки.
+        :param covariate_store (None, CovariateStore): признаки пользователей до начала эксперимента для CUPED.
+            Если None, то создаётся по data_service и rollups.
         """
         self.data_service = data_service
+        self.rollups = rollups
+        self.covariate_store = covariate_store or CovariateStore(data_service, rollups=rollups)
 
     def _get_data_subset(self, table_name, begin_date, end_date, user_ids=None, columns=None):
         """Возвращает часть таблицы с данными."""
@@ -51,61 +222,42 @@ class MetricsService:
         
         :return (pd.DataFrame): датафрейм с двумя столбцами ['user_id', 'metric']
         """
-        user_ids_ = (
-            self._get_data_subset('web-logs', begin_date, end_date, user_ids, ['user_id'])
-            ['user_id'].unique()
-        )
-        df = (
-            self._get_data_subset('sales', begin_date, end_date, user_ids, ['user_id', 'price'])
-            .groupby('user_id')[['price']].sum().reset_index() 
-            .rename(columns={'price': 'metric'})
-        )
+        user_ids_, df = self._get_visitors_revenue(begin_date, end_date, user_ids)
+        df = df.rename(columns={'price': 'metric'})
         df = pd.merge(pd.DataFrame({'user_id': user_ids_}), df, on='user_id', how='left').fillna(0)
         return df[['user_id', 'metric']]
-    
-    def _calculate_covariate(self, begin_date, end_date, user_ids):
-        """Вычисляет метрику суммарная выручка с пользователя за указанный период
-        для заходивших на сайт в указанный период.
-
-        Эта метрика нужна для экспериментов на сайте, когда в эксперимент попадают только те, кто заходил на сайт.
-        
-        Нужно вернуть значения user_id и суммарной выручки (sum(price)).
-        Данный о ценах в таблице 'sales'. Данные о заходивших на сайт в таблице 'web-logs'.
-        Если пользователь зашёл на сайт и ничего не купил, его суммарная стоимость покупок равна нулю.
-        Для каждого user_id должно быть ровно одно значение.
 
-        :param begin_date, end_date (datetime): период времени, за который нужно считать метрику.
-            Также за этот период времени нужно выбирать пользователей, которые заходили на сайт.
-        :param user_id (None, list[str]): id пользователей, по которым нужно отфильтровать полученные значения.
-        
-        :return (pd.DataFrame): датафрейм с двумя столбцами ['user_id', 'metric']
-        """
-        begin_cov_date = datetime(begin_date.year, begin_date.month, begin_date.day - 7)
-        
+    def _get_visitors_revenue(self, begin_date, end_date, user_ids):
+        """Возвращает заходивших на сайт пользователей и их суммарную выручку, columns=['user_id', 'price']."""
+        if self.rollups is not None:
+            return (
+                self.rollups.get_visitors(begin_date, end_date, user_ids),
+                self.rollups.get_revenue(begin_date, end_date, user_ids)
+            )
         user_ids_ = (
-            self._get_data_subset('web-logs', begin_cov_date, begin_date, user_ids, ['user_id'])
+            self._get_data_subset('web-logs', begin_date, end_date, user_ids, ['user_id'])
             ['user_id'].unique()
         )
         df = (
-            self._get_data_subset('sales', begin_cov_date, begin_date, user_ids, ['user_id', 'price'])
+            self._get_data_subset('sales', begin_date, end_date, user_ids, ['user_id', 'price'])
             .groupby('user_id')[['price']].sum().reset_index() 
-            .rename(columns={'price': 'cov'})
         )
-        df = pd.merge(pd.DataFrame({'user_id': user_ids_}), df, on='user_id', how='left').fillna(0)
-        return df[['user_id', 'cov']]
-
-    def calculate_metric(self, metric_name, begin_date, end_date, cuped, user_ids=None):
+        return user_ids_, df
+    
+    def calculate_metric(self, metric_name, begin_date, end_date, cuped, user_ids=None, covariates=None):
         """Считает значения метрики.
 
         :param metric_name (str): название метрики
         :param begin_date (datetime): дата начала периода (включая границу)
         :param end_date (datetime): дата окончания периода (не включая границу)
-        :param cuped (str): применение CUPED. ['off', 'on (previous week revenue)']
+        :param cuped (str): применение CUPED. ['off', 'on (previous week revenue)', 'on (multiple covariates)']
             'off' - не применять CUPED
             'on (previous week revenue)' - применяем CUPED, в качестве ковариаты
                 используем выручку за прошлые 7 дней
+            'on (multiple covariates)' - применяем CUPED с ковариатами covariates, см. apply_cuped
         :param user_ids (list[str], None): список пользователей.
             Если None, то вычисляет метрику для всех пользователей.
+        :param covariates (None, list[str]): ковариаты из CovariateStore, если None - все.
         :return df: columns=['user_id', 'metric']
         """
         if metric_name == 'revenue (web)':
@@ -114,26 +266,36 @@ class MetricsService:
             elif cuped == 'on (previous week revenue)':
                 # YOUR_CODE_HERE
                 metric = self._calculate_revenue_web(begin_date, end_date, user_ids)
-                cov = self._calculate_covariate(begin_date, end_date, user_ids)
-                
-                metric_cov = pd.merge(metric, cov, on='user_id', how='left')
-                metric_cov.fillna(0, inplace=True)
-                x_var = np.var(metric_cov['cov'])
-                x_m = np.mean(metric_cov['cov'])
-                
-                covariance = np.cov(metric_cov['cov'], metric_cov['metric'])[0, 1]
-                theta = covariance / x_var
-                
-                metric_cov['metric'] = metric_cov['metric'] - theta * (metric_cov['cov'] - x_m)
-                
-                return metric_cov[['user_id', 'metric']]
-                
-                
+                cov = self.covariate_store.get_covariates(begin_date, metric['user_id'], ['revenue (web)'])
+                cov = cov['revenue (web)'].to_numpy()
+                values = metric['metric'].to_numpy(dtype=float)
+
+                theta = np.cov(cov, values)[0, 1] / np.var(cov)
+                metric['metric'] = values - theta * (cov - cov.mean())
+                return metric
+            elif cuped == 'on (multiple covariates)':
+                metric = self._calculate_revenue_web(begin_date, end_date, user_ids)
+                return self.apply_cuped(metric, begin_date, covariates)
             else:
                 raise ValueError('Wrong cuped')
         else:
             raise ValueError('Wrong metric name')
 
+    def apply_cuped(self, metrics, begin_date, covariates=None):
+        """Применяет CUPED ко всем метрикам таблицы одним решением нормальных уравнений.
+
+        :param metrics (pd.DataFrame): columns=['user_id', *названия метрик], одна строка на пользователя.
+        :param begin_date (datetime): дата начала эксперимента, ковариаты считаются до неё.
+        :param covariates (None, list[str]): ковариаты из CovariateStore, если None - все.
+        :return (pd.DataFrame): таблица с теми же столбцами и скорректированными значениями метрик.
+        """
+        metric_columns = [column for column in metrics.columns if column != 'user_id']
+        covariate_values = self.covariate_store.get_covariates(begin_date, metrics['user_id'], covariates)
+        adjusted, _ = cuped_adjust(metrics[metric_columns].to_numpy(dtype=float), covariate_values.to_numpy())
+        metrics = metrics.copy()
+        metrics[metric_columns] = adjusted
+        return metrics
+
 
 def _chech_df(df, df_ideal, sort_by, reindex=False, set_dtypes=False, decimal=None):
     assert isinstance(df, pd.DataFrame), 'Функция вернула не pd.DataFrame.'
@@ -182,4 +344,85 @@ if __name__ == '__main__':
         'revenue (web)', begin_date, end_date, 'on (previous week revenue)'
     )
     _chech_df(metrics, ideal_metrics, ['user_id', 'metric'], True, True, decimal=1)
+
+    metrics_service = MetricsService(data_service, DailyRollups(data_service))
+    metrics = metrics_service.calculate_metric(
+        'revenue (web)', begin_date, end_date, 'on (previous week revenue)'
+    )
+    _chech_df(metrics, ideal_metrics, ['user_id', 'metric'], True, True, decimal=1)
+
+    rng = np.random.default_rng(0)
+    n_users = 2000
+    df_web_logs = pd.DataFrame({
+        'date': pd.Timestamp(2022, 3, 1) + pd.to_timedelta(rng.uniform(0, 20, 20000), unit='D'),
+        'user_id': rng.integers(0, n_users, 20000).astype(str),
+    })
+    buyers = rng.integers(0, n_users, 8000)
+    df_sales = pd.DataFrame({
+        'date': pd.Timestamp(2022, 3, 1) + pd.to_timedelta(rng.uniform(0, 20, 8000), unit='D'),
+        'price': rng.exponential(1000, 8000) * (1 + buyers % 5),
+        'user_id': buyers.astype(str),
+    })
+    data_service = DataService({'sales': df_sales, 'web-logs': df_web_logs})
+    metrics_service = MetricsService(data_service)
+    begin_date, end_date = datetime(2022, 3, 12), datetime(2022, 3, 19)
+    metrics = metrics_service.calculate_metric('revenue (web)', begin_date, end_date, 'off')
+    metrics['revenue_x2'] = metrics['metric'] * 2 + rng.normal(0, 100, len(metrics))
+    adjusted = metrics_service.apply_cuped(metrics, begin_date)
+    covariates = metrics_service.covariate_store.get_covariates(begin_date, metrics['user_id']).to_numpy()
+    design = np.column_stack([np.ones(len(covariates)), covariates])
+    for column in ['metric', 'revenue_x2']:
+        coefs = np.linalg.lstsq(design, metrics[column].to_numpy(), rcond=None)[0]
+        ideal_values = metrics[column] - (covariates - covariates.mean(axis=0)) @ coefs[1:]
+        np.testing.assert_allclose(adjusted[column], ideal_values, rtol=1e-9, atol=1e-6)
+        assert adjusted[column].var() < metrics[column].var(), 'CUPED должен уменьшать дисперсию'
+    metric = metrics_service.calculate_metric(
+        'revenue (web)', begin_date, end_date, 'on (multiple covariates)', covariates=['revenue', 'visits']
+    )
+    assert len(metric) == len(metrics) and list(metric.columns) == ['user_id', 'metric']
+    assert len(metrics_service.covariate_store.date2covariates) == 1, 'Ковариаты должны считаться один раз'
+
+    def calculate_metric_cuped(data_service, begin_date, end_date):
+        """CUPED с выручкой за прошлую неделю, как в исходном MetricsService."""
+        begin_cov_date = datetime(begin_date.year, begin_date.month, begin_date.day - 7)
+        metric = MetricsService(data_service).calculate_metric('revenue (web)', begin_date, end_date, 'off')
+        visitors = data_service.get_data_subset('web-logs', begin_cov_date, begin_date, None, ['user_id'])
+        revenue = (
+            data_service.get_data_subset('sales', begin_cov_date, begin_date, None, ['user_id', 'price'])
+            .groupby('user_id')['price'].sum().rename('cov').reset_index()
+        )
+        cov = pd.merge(pd.DataFrame({'user_id': visitors['user_id'].unique()}), revenue, on='user_id', how='left')
+        metric_cov = pd.merge(metric, cov, on='user_id', how='left').fillna(0)
+        theta = np.cov(metric_cov['cov'], metric_cov['metric'])[0, 1] / np.var(metric_cov['cov'])
+        metric_cov['metric'] = metric_cov['metric'] - theta * (metric_cov['cov'] - metric_cov['cov'].mean())
+        return metric_cov[['user_id', 'metric']]
+
+    # начало эксперимента не в полночь: интервал ковариаты начинается с начала суток
+    begin_date_hours = datetime(2022, 3, 12, 15)
+    ideal_metrics = calculate_metric_cuped(data_service, begin_date_hours, end_date)
+    for rollups in [None, DailyRollups(data_service)]:
+        metrics_hours = MetricsService(data_service, rollups).calculate_metric(
+            'revenue (web)', begin_date_hours, end_date, 'on (previous week revenue)'
+        )
+        _chech_df(metrics_hours, ideal_metrics, ['user_id', 'metric'], True, True, decimal=6)
+
+    prefix_sum_covariates = PrefixSumCovariates(data_service)
+    lookbacks = [7, 14, 28, 56]
+    user_ids = metrics['user_id'].tolist() + ['unknown']
+    sweep = prefix_sum_covariates.get_covariates_sweep(begin_date, lookbacks, user_ids)
+    for lookback in lookbacks:
+        covariate_store = CovariateStore(data_service, period=timedelta(days=lookback))
+        ideal_covariates = covariate_store.get_covariates(begin_date, user_ids)
+        pd.testing.assert_frame_equal(sweep[lookback], ideal_covariates, check_exact=False, rtol=1e-9)
+    metrics_service = MetricsService(data_service, covariate_store=prefix_sum_covariates)
+    pd.testing.assert_frame_equal(metrics_service.apply_cuped(metrics, begin_date), adjusted, rtol=1e-9)
+    sweep = prefix_sum_covariates.get_covariates_sweep(begin_date_hours, lookbacks, user_ids)
+    for lookback in lookbacks:
+        covariate_store = CovariateStore(data_service, period=timedelta(days=lookback))
+        ideal_covariates = covariate_store.get_covariates(begin_date_hours, user_ids)
+        pd.testing.assert_frame_equal(sweep[lookback], ideal_covariates, check_exact=False, rtol=1e-9)
+    metrics_hours = metrics_service.calculate_metric(
+        'revenue (web)', begin_date_hours, end_date, 'on (previous week revenue)'
+    )
+    _chech_df(metrics_hours, ideal_metrics, ['user_id', 'metric'], True, True, decimal=6)
     print('simple test passed')